@@ -0,0 +1,251 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import models
+from models import scheduler, search
+from sklearn.model_selection import StratifiedKFold
+from main import CATEGORICAL_FIELDS, TIME_CYCLE_FIELDS, SEARCH_PARAMS
+from cli import SCORE_COLD_START_BUDGET
+from utils import data_loader, data_analyzer, serving, synthetic_data, tree_evaluator
+
+# Offline benchmark of the pipeline stages on synthetic releases, written as
+# JSON so that runs can be compared with `--compare`.
+
+SIZES = [100_000, 1_000_000, 5_000_000, 20_000_000]
+RESULTS_PATH = "benchmarks/results.json"
+WORK_DIR = "data/benchmark"
+BACKENDS = ["xgboost", "catboost", "decision_tree"]
+SCALING_PATH = "benchmarks/scaling.json"
+# Fixed grids of the scaling benchmark: 4 candidates x 5 folds per run.
+SCALING_GRIDS = {
+    "xgboost": {"n_estimators": [100], "max_depth": [3, 5], "learning_rate": [0.1, 0.2]},
+    "catboost": {"n_estimators": [100], "max_depth": [4, 6], "learning_rate": [0.1, 0.2]},
+    "decision_tree": {"max_depth": [5, 10], "min_samples_leaf": [1, 4]},
+}
+CLI_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cli.py")
+COLD_START_REPEATS = 5
+SAMPLE_INCIDENT = {
+    "timestamp": "2024-03-15T08:30:00",
+    "road_type": 6,
+    "speed_limit": 30,
+    "light_conditions": 1,
+    "weather_conditions": 1,
+    "urban_or_rural_area": 1,
+    "sex_of_driver": 1,
+    "age_of_driver": 35,
+    "age_of_vehicle": 4,
+}
+
+def timed(stages:dict, name:str, function, *args, **kwargs):
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    result = function(*args, **kwargs)
+    stages[name] = {
+        "seconds": time.perf_counter() - start,
+        "cpu_seconds": time.process_time() - cpu_start,
+    }
+    print(f"{name}: {stages[name]['seconds']:.2f}s")
+    return result
+
+def cold_start_score(bundle_path:str, incidents_path:str=None, budget:float=None, repeats:int=COLD_START_REPEATS) -> dict:
+    # Wall-clock time of `cli.py score` in fresh interpreters: imports, bundle
+    # loading and scoring, as paid by a batch job or a restarted service.
+    with tempfile.TemporaryDirectory() as tmp:
+        if incidents_path is None:
+            incidents_path = os.path.join(tmp, "incident.json")
+            with open(incidents_path, "w") as f:
+                json.dump([SAMPLE_INCIDENT], f)
+        runs = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, CLI_PATH, "score", incidents_path, "--bundle", bundle_path], check=True, capture_output=True)
+            runs.append(time.perf_counter() - start)
+    result = {"seconds": statistics.median(runs), "min_seconds": min(runs), "budget_seconds": budget}
+    if budget is not None:
+        result["within_budget"] = result["seconds"] <= budget
+    status = "" if budget is None else f" (budget {budget:.2f}s: {'ok' if result['within_budget'] else 'exceeded'})"
+    print(f"cold_start_score: {result['seconds']:.2f}s{status}")
+    return result
+
+def compiled_parity(one_hot_patterns) -> dict:
+    # XGBoost on the one-hot and sin/cos columns, whose values sit exactly on
+    # the split thresholds: the compiled evaluator must match predict_proba.
+    from xgboost import XGBClassifier
+    X, y, sample_weight = data_loader.expand_pattern_table(one_hot_patterns)
+    model = XGBClassifier(n_estimators=100, max_depth=5, learning_rate=0.2, random_state=42).fit(X, y, sample_weight=sample_weight)
+    difference = tree_evaluator.check_parity(model, tree_evaluator.export_model(model), X)
+    print(f"compiled_parity: max abs difference {difference:.2g}")
+    return {"max_abs_difference": difference}
+
+def benchmark_size(n_collisions:int, work_dir:str=WORK_DIR, backends:list=BACKENDS, seed:int=42) -> dict:
+    stages = {}
+    size_dir = os.path.join(work_dir, str(n_collisions))
+    collision_path, vehicle_path = timed(stages, "generate", synthetic_data.generate_synthetic_csvs, size_dir, n_collisions, seed)
+    parquet_path = os.path.join(size_dir, "clean.parquet")
+
+    timed(stages, "load_datset_pandas", data_loader.load_datset, collision_path, vehicle_path, parquet_path, engine="pandas")
+    df = timed(stages, "load_datset_arrow", data_loader.load_datset, collision_path, vehicle_path, parquet_path, engine="arrow")
+
+    # Figures and training plots are written to the benchmark directory.
+    cwd = os.getcwd()
+    os.chdir(size_dir)
+    os.makedirs("pictures", exist_ok=True)
+    try:
+        data_analyzer.set_quality("draft")
+        timed(stages, "generate_plots", data_analyzer.generate_plots, df, "eda_cube", force=True)
+
+        patterns = timed(stages, "compress_dataset", data_loader.compress_dataset, df)
+        time_cycle_encoder = data_loader.fit_sin_cos_encoder(patterns, TIME_CYCLE_FIELDS)
+        patterns = timed(stages, "sin_cos_encode", data_loader.sin_cos_encode_dataset, patterns, TIME_CYCLE_FIELDS, time_cycle_encoder)
+        one_hot_encoder = data_loader.fit_one_hot_encoder(patterns, CATEGORICAL_FIELDS)
+        one_hot_patterns = timed(stages, "one_hot_encode", data_loader.one_hot_encode_dataset, patterns, CATEGORICAL_FIELDS, one_hot_encoder)
+        category_encoder = data_loader.fit_category_encoder(patterns, CATEGORICAL_FIELDS)
+        category_patterns = timed(stages, "category_encode", data_loader.category_encode_dataset, patterns, CATEGORICAL_FIELDS, category_encoder)
+        stages["encoding_memory"] = data_loader.encoding_memory_report(patterns, CATEGORICAL_FIELDS)
+        print(f"encoding_memory: {stages['encoding_memory']}")
+
+        if "xgboost" in backends:
+            stages["compiled_parity"] = compiled_parity(one_hot_patterns)
+
+        X = time_cycle_encoder.transform(df.drop(columns=[data_loader.TARGET_FIELD]))
+        for backend in backends:
+            if backend == "xgboost":
+                model = timed(stages, "train_xgboost", models.xgboost.train_and_save_results, category_patterns, compressed=True, **SEARCH_PARAMS)
+                X_backend = category_encoder.transform(X)
+            elif backend == "catboost":
+                model = timed(stages, "train_catboost", models.catboost.train_and_save_results, patterns, CATEGORICAL_FIELDS, compressed=True, **SEARCH_PARAMS)
+                X_backend = X
+                try:
+                    compiled = tree_evaluator.export_model(model, {field: patterns[field].unique() for field in CATEGORICAL_FIELDS})
+                    timed(stages, "inference_catboost_compiled", tree_evaluator.predict_proba, compiled, X_backend)
+                except NotImplementedError:
+                    compiled = None
+                serving.save_scoring_bundle("scoring_bundle.joblib", model, model.feature_names_, time_cycle_encoder, CATEGORICAL_FIELDS, compiled_model=compiled)
+                stages["cold_start_score"] = cold_start_score(os.path.abspath("scoring_bundle.joblib"), budget=SCORE_COLD_START_BUDGET)
+            elif backend == "decision_tree":
+                model = timed(stages, "train_decision_tree", models.decision_tree.train_and_save_results, one_hot_patterns, compressed=True, strategy="halving")
+                X_backend = data_loader.one_hot_encode_dataset(X, CATEGORICAL_FIELDS, one_hot_encoder)
+            else:
+                raise ValueError(f"Unknown backend: {backend}")
+            timed(stages, f"inference_{backend}", model.predict_proba, X_backend)
+    finally:
+        os.chdir(cwd)
+
+    return {
+        "collisions": n_collisions,
+        "clean_rows": len(df),
+        "stages": stages,
+    }
+
+def scaling_core_counts() -> list:
+    cores = scheduler.available_cores()
+    return sorted({2 ** i for i in range(cores.bit_length()) if 2 ** i <= cores} | {cores})
+
+def scaling_benchmark(n_collisions:int=SIZES[0], backend:str="xgboost", core_counts:list=None, work_dir:str=WORK_DIR, results_path:str=SCALING_PATH) -> dict:
+    # Fits per minute of the cross-validated grid search when the scheduler is
+    # limited to 1, 2, 4, ... cores through COLLISION_CORES.
+    size_dir = os.path.join(work_dir, str(n_collisions))
+    collision_path, vehicle_path = os.path.join(size_dir, "collision.csv"), os.path.join(size_dir, "vehicle.csv")
+    if not os.path.exists(collision_path):
+        synthetic_data.generate_synthetic_csvs(size_dir, n_collisions)
+    df = data_loader.read_merged_dataset(collision_path, vehicle_path, engine="arrow")
+    patterns = data_loader.sin_cos_encode_dataset(data_loader.compress_dataset(data_loader.clean_dataset(df)[0]), TIME_CYCLE_FIELDS)
+    if backend == "xgboost":
+        patterns = data_loader.category_encode_dataset(patterns, CATEGORICAL_FIELDS)
+    elif backend == "decision_tree":
+        patterns = data_loader.one_hot_encode_dataset(patterns, CATEGORICAL_FIELDS)
+    X, y, sample_weight = data_loader.expand_pattern_table(patterns)
+    pos_class_weight = (sample_weight.sum() - (sample_weight * y).sum()) / (sample_weight * y).sum()
+    if backend == "catboost":
+        estimator_backend = models.catboost.make_backend(pos_class_weight, CATEGORICAL_FIELDS)
+    else:
+        estimator_backend = models.get_backend(backend).make_backend(pos_class_weight)
+
+    runs = []
+    previous = os.environ.get(scheduler.CORES_ENV)
+    try:
+        for cores in core_counts or scaling_core_counts():
+            os.environ[scheduler.CORES_ENV] = str(cores)
+            cv = StratifiedKFold(n_splits=5, shuffle=True, random_state=42)
+            grid_search = search.CachedGridSearchCV(estimator_backend, SCALING_GRIDS[backend], cv, verbose=0)
+            start = time.perf_counter()
+            grid_search.fit(X, y, sample_weight=sample_weight)
+            seconds = time.perf_counter() - start
+            n_candidates = len(grid_search.cv_results_["params"])
+            n_tasks = cv.get_n_splits() * scheduler.plan_chunks(cv.get_n_splits(), n_candidates, estimator_backend.threaded)
+            n_workers, threads = scheduler.plan_threads(n_tasks, estimator_backend.threaded)
+            fits = n_candidates * cv.get_n_splits() + 1
+            runs.append({"cores": cores, "workers": n_workers, "threads": threads, "seconds": seconds, "fits_per_minute": fits / seconds * 60})
+            print(f"{cores:>3} cores: {n_workers} workers x {threads} threads, {runs[-1]['fits_per_minute']:.1f} fits/min")
+    finally:
+        if previous is None:
+            os.environ.pop(scheduler.CORES_ENV, None)
+        else:
+            os.environ[scheduler.CORES_ENV] = previous
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "backend": backend,
+        "collisions": n_collisions,
+        "available_cores": scheduler.available_cores(),
+        "runs": runs,
+    }
+    os.makedirs(os.path.dirname(results_path) or ".", exist_ok=True)
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Scaling results saved in the following path: {results_path}")
+    return results
+
+def run_benchmarks(sizes:list=SIZES[:1], work_dir:str=WORK_DIR, backends:list=BACKENDS, results_path:str=RESULTS_PATH) -> dict:
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "runs": [benchmark_size(n, work_dir, backends) for n in sizes],
+    }
+    os.makedirs(os.path.dirname(results_path) or ".", exist_ok=True)
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Benchmark results saved in the following path: {results_path}")
+    return results
+
+def compare_results(baseline_path:str, current_path:str) -> dict:
+    # Ratio current / baseline of every stage timed in both runs, per size;
+    # measurements without a duration (parity, memory) are left out.
+    with open(baseline_path) as f:
+        baseline = {run["collisions"]: run["stages"] for run in json.load(f)["runs"]}
+    with open(current_path) as f:
+        current = {run["collisions"]: run["stages"] for run in json.load(f)["runs"]}
+    comparison = {}
+    for size in sorted(baseline.keys() & current.keys()):
+        comparison[size] = {
+            stage: current[size][stage]["seconds"] / baseline[size][stage]["seconds"]
+            for stage in baseline[size].keys() & current[size].keys()
+            if "seconds" in baseline[size][stage] and "seconds" in current[size][stage]
+        }
+        for stage, ratio in sorted(comparison[size].items()):
+            print(f"{size:>10} {stage:<30} {ratio:6.2f}x")
+    return comparison
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pipeline benchmark on synthetic data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES[:1])
+    parser.add_argument("--backends", nargs="+", default=BACKENDS, choices=BACKENDS)
+    parser.add_argument("--work-dir", default=WORK_DIR)
+    parser.add_argument("--output", default=RESULTS_PATH)
+    parser.add_argument("--compare", metavar="BASELINE", help="compare --output against a previous results file")
+    parser.add_argument("--scaling", action="store_true", help="fits per minute from 1 to N cores, first size and backend only")
+    args = parser.parse_args()
+    if args.scaling:
+        scaling_benchmark(args.sizes[0], args.backends[0], work_dir=args.work_dir)
+    elif args.compare:
+        compare_results(args.compare, args.output)
+    else:
+        run_benchmarks(args.sizes, args.work_dir, args.backends, args.output)
@@ -0,0 +1,149 @@
+import sys
+import json
+import time
+import argparse
+
+# Command-line entry point. Every subcommand imports what it needs inside its
+# handler, so `score` only loads pandas, the encoders and the library of the
+# served model, never the training stack or the plotting libraries.
+
+BACKENDS = ["xgboost", "catboost", "decision_tree"]
+# Wall-clock budget of `cli.py score` for one incident in a fresh process,
+# checked by `cli.py bench --cold-start`.
+SCORE_COLD_START_BUDGET = 2.5
+
+def run_stages(targets:list, force:list=(), plot_quality:str=None):
+    import main
+    from utils import instrumentation, pipeline
+    stages = main.build_stages(plot_quality or main.PLOT_QUALITY)
+    instrumentation.start_trace(main.TRACE_PATH, main.PROFILE_STAGES)
+    try:
+        pipeline.run_pipeline(stages, targets, force=force)
+    finally:
+        instrumentation.stop_trace(main.CHROME_TRACE_PATH)
+
+def ingest(args):
+    run_stages(["ingest"], ["ingest"] if args.force else [])
+
+def plot(args):
+    run_stages(["plot"], ["plot"] if args.force else [], args.quality)
+
+def train(args):
+    # --external-memory streams the clean parquet dataset into XGBoost instead
+    # of training on the encoded frame.
+    names = [f"{backend}_external" if backend == "xgboost" and args.external_memory else backend for backend in args.backend]
+    targets = [f"register_{name}" for name in names]
+    if "catboost" in args.backend:
+        targets.append("export_bundle")
+    run_stages(targets, [f"train_{name}" for name in names] if args.force else [])
+
+def load_bundle(args) -> dict:
+    # From the registry when a backend is given, else from the bundle file.
+    if args.backend is not None:
+        from utils import model_registry
+        return model_registry.load_model(args.backend, args.version)
+    from utils import serving
+    return serving.load_scoring_bundle(args.bundle)
+
+def refresh(args):
+    # Continued boosting of the deployed model on the last ingested years,
+    # instead of a full search.
+    import main
+    from models import refresh
+    refresh.refresh_model(args.backend, main.DATASET_PATH, args.years, args.rounds, args.holdout_months)
+
+def score(args):
+    start = time.perf_counter()
+    from utils import serving
+    bundle = load_bundle(args)
+    if args.input == "-":
+        incidents = json.load(sys.stdin)
+    else:
+        with open(args.input) as f:
+            incidents = json.load(f)
+    if isinstance(incidents, dict):
+        incidents = [incidents]
+    scores = serving.score_incidents(bundle, incidents)
+    print(json.dumps({"scores": [float(s) for s in scores]}))
+    print(f"score: {time.perf_counter() - start:.3f}s after startup", file=sys.stderr)
+
+def batch(args):
+    from utils import batch_scoring, instrumentation
+    if args.trace:
+        instrumentation.start_trace(args.trace)
+    try:
+        batch_scoring.score_extract(load_bundle(args), args.collision, args.vehicle, args.output, args.block_size * 1024 * 1024)
+    finally:
+        instrumentation.stop_trace()
+
+def bench(args):
+    import benchmark
+    if args.cold_start:
+        benchmark.cold_start_score(args.bundle, args.input, SCORE_COLD_START_BUDGET)
+    elif args.scaling:
+        benchmark.scaling_benchmark(args.sizes[0], args.backend[0], work_dir=args.work_dir)
+    elif args.compare:
+        benchmark.compare_results(args.compare, args.output)
+    else:
+        benchmark.run_benchmarks(args.sizes, args.work_dir, args.backend, args.output)
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Collision severity pipeline")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = commands.add_parser("ingest", help="clean and partition a release")
+    ingest_parser.add_argument("--force", action="store_true")
+    ingest_parser.set_defaults(handler=ingest)
+
+    plot_parser = commands.add_parser("plot", help="draw the EDA figures")
+    plot_parser.add_argument("--quality", choices=["draft", "publication"])
+    plot_parser.add_argument("--force", action="store_true")
+    plot_parser.set_defaults(handler=plot)
+
+    train_parser = commands.add_parser("train", help="train and register models")
+    train_parser.add_argument("--backend", nargs="+", choices=BACKENDS, default=["catboost"])
+    train_parser.add_argument("--external-memory", action="store_true", help="train XGBoost out of core from the parquet row groups")
+    train_parser.add_argument("--force", action="store_true")
+    train_parser.set_defaults(handler=train)
+
+    refresh_parser = commands.add_parser("refresh", help="continue boosting the deployed model on new years")
+    refresh_parser.add_argument("--backend", choices=["xgboost", "catboost"], default="catboost")
+    refresh_parser.add_argument("--years", type=int, nargs="+", help="default: the years of the last ingested release")
+    refresh_parser.add_argument("--rounds", type=int, default=100, help="trees added to the deployed model")
+    refresh_parser.add_argument("--holdout-months", type=int, default=2, help="most recent months held out for validation")
+    refresh_parser.set_defaults(handler=refresh)
+
+    score_parser = commands.add_parser("score", help="score incidents given as JSON")
+    score_parser.add_argument("input", help="JSON file of incidents, - for stdin")
+    score_parser.add_argument("--bundle", default="data/scoring_bundle.joblib")
+    score_parser.add_argument("--backend", choices=BACKENDS, help="score with the model registry")
+    score_parser.add_argument("--version", help="registry version, default: pinned or latest")
+    score_parser.set_defaults(handler=score)
+
+    batch_parser = commands.add_parser("batch", help="score a collision/vehicle CSV extract into parquet")
+    batch_parser.add_argument("collision")
+    batch_parser.add_argument("vehicle")
+    batch_parser.add_argument("--output", default="data/scores.parquet")
+    batch_parser.add_argument("--bundle", default="data/scoring_bundle.joblib")
+    batch_parser.add_argument("--backend", choices=BACKENDS, help="score with the model registry")
+    batch_parser.add_argument("--version", help="registry version, default: pinned or latest")
+    batch_parser.add_argument("--block-size", type=int, default=16, help="MB of vehicle CSV per block")
+    batch_parser.add_argument("--trace", help="JSONL file of the per-block records")
+    batch_parser.set_defaults(handler=batch)
+
+    bench_parser = commands.add_parser("bench", help="offline benchmark on synthetic data")
+    bench_parser.add_argument("--sizes", type=int, nargs="+", default=[100_000])
+    bench_parser.add_argument("--backend", nargs="+", choices=BACKENDS, default=BACKENDS)
+    bench_parser.add_argument("--work-dir", default="data/benchmark")
+    bench_parser.add_argument("--output", default="benchmarks/results.json")
+    bench_parser.add_argument("--compare", metavar="BASELINE")
+    bench_parser.add_argument("--cold-start", action="store_true", help="time `score` in fresh processes against its budget")
+    bench_parser.add_argument("--scaling", action="store_true", help="grid-search fits per minute from 1 to N cores")
+    bench_parser.add_argument("--bundle", default="data/scoring_bundle.joblib")
+    bench_parser.add_argument("--input", help="incidents file for --cold-start, default: one sample incident")
+    bench_parser.set_defaults(handler=bench)
+    return parser
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    args.handler(args)
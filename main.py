@@ -1,22 +1,158 @@
+import json
 import models
-from utils import data_loader, data_analyzer
+from utils import data_loader, data_analyzer, serving, tree_evaluator, instrumentation, pipeline, model_registry
 
 COLLISION_PATH = "data/collision.csv"
 VEHICLE_PATH = "data/vehicle.csv"
-SAVE_PATH = "data/clean_dataset.parquet"
+DATASET_PATH = "data/clean_dataset"
+BUNDLE_PATH = "data/scoring_bundle.joblib"
+CUBE_PATH = "data/eda_cube"
+PLOT_QUALITY = "publication"
 CATEGORICAL_FIELDS = ["road_type","weather_conditions","urban_or_rural_area","sex_of_driver"]
 TIME_CYCLE_FIELDS = ["month","day","hour"]
+SEARCH_PARAMS = {"strategy": "halving", "early_stopping_rounds": 20, "prune_margin": 0.01}
+TRACE_PATH = "data/trace.jsonl"
+CHROME_TRACE_PATH = "data/trace.chrome.json"
+# Stages run under the sampling profiler, e.g. ["fit", "merge"].
+PROFILE_STAGES = []
+# Stages run again even when their cached artifact is up to date.
+FORCE_STAGES = []
+# Training stages also draw their evaluation figures with utils.data_analyzer.
+TRAINING_CODE = ["models.training", "models.search", "utils.evaluation", "utils.data_analyzer"]
 
-if __name__ == '__main__':
-    df = data_loader.load_datset(COLLISION_PATH, VEHICLE_PATH, SAVE_PATH)
-    print("Main Dataframe loaded and cleaned.")
-    print(f"Main Dataframe saved in the following path: {SAVE_PATH}")
-    data_analyzer.generate_plots(df)
+def ingest(collision_path, vehicle_path, dataset_path):
+    data_loader.update_clean_dataset(collision_path, vehicle_path, dataset_path)
+    print(f"Clean dataset partitions up to date in the following path: {dataset_path}")
+    return data_loader.read_manifest(dataset_path)
+
+def aggregate(df_patterns, cube_path):
+    cube = data_analyzer.build_aggregation_cube(df_patterns)
+    data_analyzer.save_aggregation_cube(cube, cube_path)
+    return cube
+
+def plot(cube, quality):
+    data_analyzer.set_quality(quality)
+    rendered = data_analyzer.generate_plots(cube=cube)
     print("Plots generated and saved in ./pictures.")
+    return rendered
 
-    df_time_encoded = data_loader.sin_cos_encode_dataset(df,TIME_CYCLE_FIELDS)
+def compress(manifest, dataset_path):
+    return data_loader.compress_clean_dataset(dataset_path)
+
+def time_encode(df_patterns, time_cycle_fields, categorical_fields):
+    time_cycle_encoder = data_loader.fit_sin_cos_encoder(df_patterns,time_cycle_fields)
+    df_time_encoded = data_loader.sin_cos_encode_dataset(df_patterns,time_cycle_fields,time_cycle_encoder)
     print("Dataframe as successfully been time encoded using sin-cos transform.")
-    df_one_hot_time_encoded = data_loader.one_hot_encode_dataset(df_time_encoded,CATEGORICAL_FIELDS)
-    # xgboost_model = models.xgboost.train_and_save_results(df_one_hot_time_encoded)
-    # decision_tree_model = models.decision_tree.train_and_save_results(df_one_hot_time_encoded)
-    catboost_model = models.catboost.train_and_save_results(df_time_encoded,CATEGORICAL_FIELDS)
\ No newline at end of file
+    return time_cycle_encoder, df_time_encoded
+
+def one_hot_encode(time_encoded, categorical_fields):
+    _, df_time_encoded = time_encoded
+    one_hot_encoder = data_loader.fit_one_hot_encoder(df_time_encoded,categorical_fields)
+    return one_hot_encoder, data_loader.one_hot_encode_dataset(df_time_encoded,categorical_fields,one_hot_encoder)
+
+def category_encode(time_encoded, categorical_fields):
+    _, df_time_encoded = time_encoded
+    category_encoder = data_loader.fit_category_encoder(df_time_encoded,categorical_fields)
+    return category_encoder, data_loader.category_encode_dataset(df_time_encoded,categorical_fields,category_encoder)
+
+def train_xgboost(category_encoded, search_params):
+    _, df_category_time_encoded = category_encoded
+    return models.xgboost.train_and_save_results(df_category_time_encoded, compressed=True, **search_params)
+
+def train_decision_tree(one_hot_encoded):
+    _, df_one_hot_time_encoded = one_hot_encoded
+    return models.decision_tree.train_and_save_results(df_one_hot_time_encoded, compressed=True, strategy="halving")
+
+def train_catboost(time_encoded, categorical_fields, search_params):
+    _, df_time_encoded = time_encoded
+    return models.catboost.train_and_save_results(df_time_encoded,categorical_fields, compressed=True, **search_params)
+
+def train_xgboost_external(manifest, dataset_path, categorical_fields, time_cycle_fields):
+    return models.xgboost.train_external_memory(dataset_path, categorical_fields, time_cycle_fields)
+
+def compile_model(model, df_encoded, categorical_fields):
+    try:
+        return tree_evaluator.export_model(model, {field: df_encoded[field].unique() for field in categorical_fields})
+    except NotImplementedError as error:
+        print(f"Modèle non compilé, la bibliothèque sera utilisée pour le scoring : {error}")
+        return None
+
+def feature_names(model, df_encoded):
+    if hasattr(model, "feature_names_"):
+        return model.feature_names_
+    if hasattr(model, "get_booster"):
+        return model.get_booster().feature_names
+    return [c for c in df_encoded.columns if c not in (data_loader.PATTERN_TOTAL, data_loader.PATTERN_SEVERE)]
+
+def export_bundle(catboost_model, time_encoded, categorical_fields, bundle_path):
+    time_cycle_encoder, df_time_encoded = time_encoded
+    compiled_model = compile_model(catboost_model, df_time_encoded, categorical_fields)
+    serving.save_scoring_bundle(bundle_path, catboost_model, catboost_model.feature_names_, time_cycle_encoder, categorical_fields, compiled_model=compiled_model)
+    print(f"Scoring bundle saved in the following path: {bundle_path}")
+    return bundle_path
+
+def register(model, time_encoded, categorical_encoded=None, backend="catboost", categorical_fields=CATEGORICAL_FIELDS):
+    # `categorical_encoded` is the (encoder, frame) pair the model was trained
+    # on, None for CatBoost which splits on the raw categorical codes.
+    time_cycle_encoder, df_encoded = time_encoded
+    categorical_encoder = None
+    if categorical_encoded is not None:
+        categorical_encoder, df_encoded = categorical_encoded
+    with open(f"pictures/{backend}_evaluation.json") as f:
+        evaluation_report = json.load(f)
+    compiled_model = compile_model(model, df_encoded, categorical_fields) if categorical_encoded is None else None
+    return model_registry.register_model(backend, model, feature_names(model, df_encoded), time_cycle_encoder, categorical_fields,
+                                         categorical_encoder, compiled_model, evaluation_report)
+
+def register_xgboost_external(trained, categorical_fields):
+    model, time_cycle_encoder, category_encoder = trained
+    with open("pictures/xgboost_external_evaluation.json") as f:
+        evaluation_report = json.load(f)
+    return model_registry.register_model("xgboost", model, model.get_booster().feature_names, time_cycle_encoder, categorical_fields,
+                                         category_encoder, evaluation_report=evaluation_report)
+
+def training_outputs(path_img):
+    return [f"pictures/{path_img}_{name}" for name in ["evaluation.json", "confusion_matrix.png", "roc_curve.png", "precision_recall.png", "features_importance.png"]]
+
+def build_stages(plot_quality:str=PLOT_QUALITY) -> list:
+    categorical = {"categorical_fields": CATEGORICAL_FIELDS}
+    return [
+        pipeline.make_stage("ingest", ingest, params={"collision_path": COLLISION_PATH, "vehicle_path": VEHICLE_PATH, "dataset_path": DATASET_PATH},
+                            files=[COLLISION_PATH, VEHICLE_PATH], outputs=[DATASET_PATH], code=["utils.data_loader"]),
+        pipeline.make_stage("compress", compress, ["ingest"], {"dataset_path": DATASET_PATH}, code=["utils.data_loader"]),
+        pipeline.make_stage("aggregate", aggregate, ["compress"], {"cube_path": CUBE_PATH}, code=["utils.data_analyzer"]),
+        pipeline.make_stage("plot", plot, ["aggregate"], {"quality": plot_quality},
+                            outputs=[output for _, _, output in data_analyzer.EDA_FIGURES], code=["utils.data_analyzer"]),
+        pipeline.make_stage("time_encode", time_encode, ["compress"], {"time_cycle_fields": TIME_CYCLE_FIELDS, **categorical}, code=["utils.data_loader"]),
+        pipeline.make_stage("one_hot_encode", one_hot_encode, ["time_encode"], categorical, code=["utils.data_loader"]),
+        pipeline.make_stage("category_encode", category_encode, ["time_encode"], categorical, code=["utils.data_loader"]),
+        pipeline.make_stage("train_xgboost", train_xgboost, ["category_encode"], {"search_params": SEARCH_PARAMS},
+                            outputs=training_outputs("xgboost"), code=["models.xgboost"] + TRAINING_CODE),
+        pipeline.make_stage("train_decision_tree", train_decision_tree, ["one_hot_encode"],
+                            outputs=training_outputs("decision_tree"), code=["models.decision_tree"] + TRAINING_CODE),
+        pipeline.make_stage("train_catboost", train_catboost, ["time_encode"], {"search_params": SEARCH_PARAMS, **categorical},
+                            outputs=training_outputs("catboost"), code=["models.catboost"] + TRAINING_CODE),
+        pipeline.make_stage("train_xgboost_external", train_xgboost_external, ["ingest"], {"dataset_path": DATASET_PATH, "time_cycle_fields": TIME_CYCLE_FIELDS, **categorical},
+                            outputs=["pictures/xgboost_external_evaluation.json"], code=["models.xgboost", "utils.evaluation"]),
+        pipeline.make_stage("export_bundle", export_bundle, ["train_catboost", "time_encode"], {"bundle_path": BUNDLE_PATH, **categorical},
+                            outputs=[BUNDLE_PATH], code=["utils.serving", "utils.tree_evaluator"]),
+        pipeline.make_stage("register_xgboost", register, ["train_xgboost", "time_encode", "category_encode"], {"backend": "xgboost", **categorical},
+                            code=["utils.model_registry"]),
+        pipeline.make_stage("register_xgboost_external", register_xgboost_external, ["train_xgboost_external"], categorical,
+                            code=["utils.model_registry"]),
+        pipeline.make_stage("register_decision_tree", register, ["train_decision_tree", "time_encode", "one_hot_encode"], {"backend": "decision_tree", **categorical},
+                            code=["utils.model_registry"]),
+        pipeline.make_stage("register_catboost", register, ["train_catboost", "time_encode"], {"backend": "catboost", **categorical},
+                            code=["utils.model_registry", "utils.tree_evaluator"]),
+    ]
+
+STAGES = build_stages()
+# The XGBoost and decision tree stages, in memory or out of core, are defined
+# but not run by default.
+TARGETS = ["plot", "export_bundle", "register_catboost"]
+
+if __name__ == '__main__':
+    instrumentation.start_trace(TRACE_PATH, PROFILE_STAGES)
+    pipeline.run_pipeline(STAGES, TARGETS, force=FORCE_STAGES)
+    instrumentation.stop_trace(CHROME_TRACE_PATH)
+    print(f"Stage trace saved in the following paths: {TRACE_PATH}, {CHROME_TRACE_PATH}")
@@ -1,3 +1,19 @@
-from .decision_tree import *
-from .xgboost import *
-from .catboost import *
\ No newline at end of file
+import importlib
+
+# Backends are imported on first use, `models.xgboost` for instance, so that
+# importing the package does not load xgboost, catboost and sklearn.
+BACKENDS = {
+    "xgboost": "models.xgboost",
+    "catboost": "models.catboost",
+    "decision_tree": "models.decision_tree",
+}
+
+def get_backend(name:str):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend: {name}")
+    return importlib.import_module(BACKENDS[name])
+
+def __getattr__(name:str):
+    if name in BACKENDS:
+        return get_backend(name)
+    raise AttributeError(f"module 'models' has no attribute '{name}'")
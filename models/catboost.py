@@ -1,28 +1,53 @@
-import numpy as np
-from utils import data_analyzer
-from catboost import CatBoostClassifier
-from sklearn.model_selection import train_test_split
-from sklearn.model_selection import StratifiedKFold, GridSearchCV
-import time
-
-def train_and_save_results(X, categorical_columns=None, path_img="catboost"):
-    print("Démarrage de l'entraînement du classifieur CatBoost avec GridSearchCV")
-    y = X['collision_severity']
-    X = X.drop('collision_severity', axis=1)
-
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
-
-    param_grid = {
-        'n_estimators': [100, 200],
-        'max_depth': [ 5, None],
-        'learning_rate': [0.1, 0.5],
-    }
-    print(f"Grille de paramètres définie avec {len(param_grid['n_estimators']) * len(param_grid['max_depth']) * len(param_grid['learning_rate'])} combinaisons possibles")
-
-    pos_class_weight = ((len(y) - np.sum(y)) / np.sum(y))
-    print(f"Poids de la classe positive : {pos_class_weight:.4f}")
-
-    base_model = CatBoostClassifier(
+from functools import partial
+from catboost import CatBoostClassifier, Pool
+from models import training
+
+PARAM_GRID = {
+    'n_estimators': [100, 200],
+    'max_depth': [ 5, None],
+    'learning_rate': [0.1, 0.5],
+}
+
+class CatBoostBackend:
+    truncatable = True
+    threaded = True
+
+    def __init__(self, **base_params):
+        self.base_params = base_params
+        # Threads per fit, set by models.scheduler; None uses every core.
+        self.threads = None
+
+    def estimator(self, params):
+        return CatBoostClassifier(**self.base_params, **params, thread_count=self.threads or -1)
+
+    def prepare(self, X_train, y_train, train_weight, X_test, valid=None):
+        cat_features = self.base_params.get("cat_features")
+        thread_count = self.threads or -1
+        train_pool = Pool(X_train, y_train, cat_features=cat_features, weight=train_weight, thread_count=thread_count)
+        train_pool.quantize()
+        valid_pool = None
+        if valid is not None:
+            valid_pool = Pool(valid[0], valid[1], cat_features=cat_features, weight=valid[2], thread_count=thread_count)
+        return train_pool, Pool(X_test, cat_features=cat_features, thread_count=thread_count), valid_pool
+
+    def fit(self, data, params, n_estimators=None, early_stopping_rounds=None):
+        if n_estimators:
+            params = {**params, "n_estimators": n_estimators}
+        estimator = self.estimator(params)
+        if early_stopping_rounds:
+            return estimator.fit(data[0], eval_set=data[2], early_stopping_rounds=early_stopping_rounds)
+        return estimator.fit(data[0])
+
+    def fitted_rounds(self, model):
+        # Trees kept by early stopping, None without it.
+        best_iteration = model.get_best_iteration()
+        return best_iteration + 1 if best_iteration is not None else None
+
+    def predict(self, model, data, n_estimators=None):
+        return model.predict_proba(data[1], ntree_end=n_estimators or 0)[:, 1]
+
+def make_backend(pos_class_weight, categorical_columns=None):
+    return CatBoostBackend(
         objective='Logloss',
         scale_pos_weight=pos_class_weight,
         random_state=42,
@@ -30,38 +55,8 @@ def train_and_save_results(X, categorical_columns=None, path_img="catboost"):
         cat_features=categorical_columns
     )
 
-    skf = StratifiedKFold(n_splits=5, shuffle=True, random_state=42)
-    print("Initialisation de StratifiedKFold avec 5 plis")
-
-    grid_search = GridSearchCV(
-        estimator=base_model,
-        param_grid=param_grid,
-        cv=skf,
-        scoring='roc_auc',
-        n_jobs=4,
-        verbose=2
-    )
-
-    print("Lancement de la recherche par grille...")
-    start_time = time.time()
-    grid_search.fit(X_train, y_train)
-    end_time = time.time()
-    print(f"Temps d'entraînement : {end_time - start_time:.2f} secondes")
-    print("Recherche par grille terminée")
-
-    print(f"Meilleurs paramètres : {grid_search.best_params_}")
-    print(f"Meilleur score CV : {grid_search.best_score_:.4f}")
-
-    best_model = grid_search.best_estimator_
-    y_pred_proba = best_model.predict_proba(X_test)[:, 1]
-
-    print("Sauvegarde de la matrice de confusion")
-    data_analyzer.plot_confusion_matrix(y_pred_proba, y_test, path_img)
-    print("Sauvegarde de la courbe ROC")
-    data_analyzer.plot_roc_curve(y_pred_proba, y_test, path_img)
-    print("Sauvegarde des features importances")
-    data_analyzer.plot_feature_importance(best_model, X.columns, path_img)
-
-    print("Processus d'entraînement du classifieur CatBoost avec GridSearch achevé")
-
-    return best_model
\ No newline at end of file
+def train_and_save_results(X, categorical_columns=None, path_img="catboost", compressed=False, strategy="grid", **search_params):
+    return training.train_and_save_results(
+        partial(make_backend, categorical_columns=categorical_columns),
+        X, PARAM_GRID, path_img, "CatBoost", compressed, strategy, **search_params
+    )
\ No newline at end of file
@@ -0,0 +1,108 @@
+import time
+import numpy as np
+import pandas as pd
+from utils import data_loader, evaluation, instrumentation, model_registry, serving, tree_evaluator
+
+# Refresh of a deployed boosted model when new years are ingested: the trees
+# of the registered version are kept and REFRESH_ROUNDS trees are added,
+# fitted on the new rows only with the registered hyperparameters. The most
+# recent months are held out; the refreshed model is registered and pinned
+# only if its AUC on them is not below the deployed model's.
+
+REFRESH_ROUNDS = 100
+HOLDOUT_MONTHS = 2
+AUC_TOLERANCE = 0.0
+# Parameters setting the number of trees, replaced by the refresh rounds.
+ROUND_PARAMS = ["n_estimators", "iterations", "num_boost_round", "num_trees"]
+
+def continue_xgboost(model, params:dict, X, y, sample_weight, rounds:int):
+    # The saved booster keeps its intercept and objective but not its tree
+    # parameters, which come from the registered hyperparameters.
+    from xgboost import XGBClassifier
+    params = {k: v for k, v in params.items() if k not in ROUND_PARAMS + ["enable_categorical", "feature_types", "base_score"]}
+    estimator = XGBClassifier(**params, n_estimators=rounds, enable_categorical=True)
+    return estimator.fit(X, y, sample_weight=sample_weight, xgb_model=model.get_booster())
+
+def continue_catboost(model, params:dict, X, y, sample_weight, rounds:int):
+    from catboost import CatBoostClassifier, Pool
+    params = {k: v for k, v in params.items() if k not in ROUND_PARAMS}
+    pool = Pool(X, y, cat_features=params.pop("cat_features", None), weight=sample_weight)
+    return CatBoostClassifier(**params, n_estimators=rounds).fit(pool, init_model=model)
+
+# Backends whose models can be boosted further.
+CONTINUATIONS = {
+    "xgboost": continue_xgboost,
+    "catboost": continue_catboost,
+}
+
+def read_years(dataset_path:str, years:list) -> pd.DataFrame:
+    return pd.concat([data_loader.read_clean_dataset(dataset_path, [year]).assign(year=year) for year in years], ignore_index=True)
+
+def recent_holdout(df:pd.DataFrame, months:int=HOLDOUT_MONTHS) -> np.ndarray:
+    # Rows of the `months` most recent (year, month) periods.
+    periods = df["year"].astype(np.int32) * 12 + df["month"].astype(np.int32)
+    return periods.isin(np.sort(periods.unique())[-months:]).to_numpy()
+
+def encoded_patterns(bundle:dict, df:pd.DataFrame) -> tuple:
+    X, y, sample_weight = data_loader.expand_pattern_table(data_loader.compress_dataset(df))
+    return serving.encode_incidents(bundle, X), y, sample_weight
+
+def refresh_model(backend:str, dataset_path:str, years:list=None, rounds:int=REFRESH_ROUNDS, holdout_months:int=HOLDOUT_MONTHS,
+                  registry_dir:str=model_registry.REGISTRY_DIR) -> dict:
+    # `years` defaults to those of the last ingested release.
+    if backend not in CONTINUATIONS:
+        raise ValueError(f"Cannot continue boosting a {backend} model")
+    start = time.perf_counter()
+    bundle = model_registry.load_model(backend, registry_dir=registry_dir)
+    deployed = bundle["metadata"]["version"]
+    if years is None:
+        releases = data_loader.read_manifest(dataset_path)["releases"]
+        years = releases[-1]["years"] if releases else []
+    if not years:
+        raise ValueError(f"No new year to refresh on in {dataset_path}")
+
+    df = read_years(dataset_path, years)
+    holdout = recent_holdout(df, holdout_months)
+    if holdout.all():
+        raise ValueError(f"Years {years} hold no row older than the {holdout_months} held-out months")
+    df = df.drop(columns=["year"])
+    X, y, sample_weight = encoded_patterns(bundle, df[~holdout])
+    X_holdout, y_holdout, holdout_weight = encoded_patterns(bundle, df[holdout])
+    print(f"Rafraîchissement du modèle {backend} version {deployed} sur les années {years} : "
+          f"{int(sample_weight.sum())} lignes d'entraînement, {int(holdout_weight.sum())} lignes de validation récentes")
+
+    with instrumentation.stage("refresh_fit", rows_in=len(X), backend=backend, rounds=rounds):
+        model = CONTINUATIONS[backend](bundle["model"], bundle["metadata"]["params"], X, y, sample_weight, rounds)
+    deployed_evaluation = evaluation.evaluate(bundle["model"].predict_proba(X_holdout)[:, 1], y_holdout, holdout_weight)
+    refreshed_evaluation = evaluation.evaluate(model.predict_proba(X_holdout)[:, 1], y_holdout, holdout_weight)
+    promoted = refreshed_evaluation["roc_auc"] >= deployed_evaluation["roc_auc"] - AUC_TOLERANCE
+    print(f"AUC ROC sur les {holdout_months} derniers mois : déployé {deployed_evaluation['roc_auc']:.4f}, rafraîchi {refreshed_evaluation['roc_auc']:.4f}")
+
+    version = None
+    if promoted:
+        compiled_model = None
+        if bundle["metadata"]["compiled"]:
+            try:
+                compiled_model = tree_evaluator.export_model(model, {field: df[field].unique() for field in bundle["categorical_fields"]})
+            except NotImplementedError as error:
+                print(f"Modèle non compilé, la bibliothèque sera utilisée pour le scoring : {error}")
+        version = model_registry.register_model(backend, model, bundle["feature_names"], bundle["time_cycle_encoder"], bundle["categorical_fields"],
+                                                bundle["categorical_encoder"], compiled_model, evaluation.evaluation_report(refreshed_evaluation),
+                                                registry_dir, parent_version=deployed)
+        model_registry.pin_version(backend, version, registry_dir)
+        print(f"Modèle rafraîchi promu et épinglé : {backend} version {version}")
+    else:
+        print(f"AUC en baisse, la version {deployed} reste déployée")
+
+    elapsed = time.perf_counter() - start
+    print(f"Rafraîchissement terminé en {elapsed:.1f} secondes")
+    return {
+        "backend": backend,
+        "deployed_version": deployed,
+        "version": version,
+        "promoted": promoted,
+        "years": list(years),
+        "deployed_roc_auc": deployed_evaluation["roc_auc"],
+        "refreshed_roc_auc": refreshed_evaluation["roc_auc"],
+        "seconds": elapsed,
+    }
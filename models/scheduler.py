@@ -0,0 +1,68 @@
+import os
+import math
+from contextlib import contextmanager
+
+# Splits the cores available to the process between the parallel CV workers
+# and the threads of every fit, so that workers x threads never exceeds them.
+
+CORES_ENV = "COLLISION_CORES"
+CGROUP_V2_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+CGROUP_V1_QUOTA = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+CGROUP_V1_PERIOD = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+
+def cgroup_cpu_limit() -> float:
+    # CPU quota of the container in cores, None when unlimited.
+    try:
+        with open(CGROUP_V2_CPU_MAX) as f:
+            quota, period = f.read().split()
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(CGROUP_V1_QUOTA) as f:
+            quota = int(f.read())
+        with open(CGROUP_V1_PERIOD) as f:
+            period = int(f.read())
+        return None if quota <= 0 else quota / period
+    except (OSError, ValueError):
+        return None
+
+def available_cores() -> int:
+    # Affinity mask, cgroup quota and the COLLISION_CORES override, whichever
+    # is the smallest.
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cores = min(cores, max(1, math.floor(limit)))
+    if os.environ.get(CORES_ENV):
+        cores = min(cores, int(os.environ[CORES_ENV]))
+    return max(1, cores)
+
+def plan_threads(n_tasks:int, threaded:bool=True, max_workers:int=None, cores:int=None) -> tuple:
+    # Independent fits scale better than threads within a fit: one worker per
+    # task up to the core count, the remaining cores become threads.
+    cores = cores or available_cores()
+    n_workers = max(1, min(n_tasks, cores, max_workers or cores))
+    threads = max(1, cores // n_workers) if threaded else 1
+    return n_workers, threads
+
+def plan_chunks(n_folds:int, n_candidates:int, threaded:bool=True, max_workers:int=None, cores:int=None) -> int:
+    # Chunks the candidates of every fold are split into. Threaded fits take
+    # the cores left by the folds; single-threaded ones need (fold, chunk)
+    # tasks to occupy more cores than there are folds.
+    if threaded:
+        return 1
+    cores = cores or available_cores()
+    cores = min(cores, max_workers or cores)
+    return max(1, min(n_candidates, math.ceil(cores / max(1, n_folds))))
+
+@contextmanager
+def using_threads(backend, threads:int):
+    # Backends read `threads` when they build their estimators and matrices,
+    # including in the joblib workers they are pickled to.
+    previous = getattr(backend, "threads", None)
+    backend.threads = threads
+    try:
+        yield backend
+    finally:
+        backend.threads = previous
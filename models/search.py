@@ -0,0 +1,278 @@
+import time
+import math
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.metrics import roc_auc_score
+from sklearn.model_selection import ParameterGrid
+from utils import instrumentation, shared_frame
+from models import scheduler
+
+VALIDATION_SPLITS = 10
+
+def split_counts(sample_weight, y, n_splits=5, random_state=42):
+    # Each weighted row stands for `sample_weight` identical observations: the
+    # observations themselves are dealt into folds, per class, so a pattern can
+    # contribute to several folds with different counts.
+    rng = np.random.default_rng(random_state)
+    sample_weight = np.asarray(sample_weight, dtype=np.int64)
+    y = np.asarray(y)
+    counts = np.zeros(len(sample_weight) * n_splits, dtype=np.int64)
+    for label in np.unique(y):
+        rows = np.flatnonzero(y == label)
+        owners = np.repeat(rows, sample_weight[rows])
+        folds = rng.permutation(len(owners)) % n_splits
+        counts += np.bincount(owners * n_splits + folds, minlength=len(counts))
+    return counts.reshape(len(sample_weight), n_splits)
+
+def weighted_train_test_split(sample_weight, y, test_size=0.2, random_state=42):
+    test_weight = split_counts(sample_weight, y, round(1 / test_size), random_state)[:, 0]
+    return sample_weight - test_weight, test_weight
+
+def make_folds(X, y, cv, sample_weight=None):
+    if sample_weight is None:
+        return [(train, None, test, None) for train, test in cv.split(X, y)]
+
+    fold_weight = split_counts(sample_weight, y, cv.get_n_splits(), cv.random_state)
+    folds = []
+    for fold in range(fold_weight.shape[1]):
+        train_weight = sample_weight - fold_weight[:, fold]
+        test_weight = fold_weight[:, fold]
+        train = np.flatnonzero(train_weight)
+        test = np.flatnonzero(test_weight)
+        folds.append((train, train_weight[train], test, test_weight[test]))
+    return folds
+
+def prepare_fold(backend, X, y, fold, fraction=1.0, early_stopping_rounds=None, random_state=42):
+    train, train_weight, test, test_weight = fold
+    weighted = train_weight is not None
+    weight = train_weight if weighted else np.ones(len(train), dtype=np.int64)
+    rng = np.random.default_rng(random_state)
+    if fraction < 1:
+        # Row budget: thin the observation counts, which subsamples rows on
+        # plain data and observations on a pattern table.
+        weight = rng.binomial(weight, fraction)
+
+    valid = None
+    if early_stopping_rounds:
+        valid_weight = split_counts(weight, y.iloc[train], VALIDATION_SPLITS, random_state)[:, 0]
+        weight = weight - valid_weight
+        rows = np.flatnonzero(valid_weight)
+        valid = (X.iloc[train[rows]], y.iloc[train[rows]], valid_weight[rows] if weighted else None)
+
+    rows = np.flatnonzero(weight)
+    return backend.prepare(
+        X.iloc[train[rows]], y.iloc[train[rows]], weight[rows] if weighted else None, X.iloc[test], valid
+    )
+
+def prefix_groups(candidates, truncatable):
+    # Candidates that differ only by n_estimators are prefixes of the same
+    # boosted model: they are grouped so that only the largest one is fitted.
+    groups = {}
+    for index, params in enumerate(candidates):
+        if truncatable and params.get("n_estimators") is not None:
+            key = tuple(sorted((k, repr(v)) for k, v in params.items() if k != "n_estimators"))
+        else:
+            key = index
+        groups.setdefault(key, []).append(index)
+    return list(groups.values())
+
+def score_fold(backend, X, y, fold, candidates, verbose=0, fraction=1.0, n_estimators=None, early_stopping_rounds=None, random_state=42):
+    # The backend builds its training structures (DMatrix, Pool, ...) once per
+    # fold; every candidate is then fitted on the same prepared data. X and y
+    # may be shared-memory handles, mapped here without a copy. Returns the
+    # scores and, with early stopping, the number of trees each fit kept.
+    X, y = shared_frame.attach(X), shared_frame.attach(y)
+    train, train_weight, test, test_weight = fold
+    with instrumentation.stage("prepare_fold", rows_in=len(train), fraction=fraction):
+        data = prepare_fold(backend, X, y, fold, fraction, early_stopping_rounds, random_state)
+    y_test = y.iloc[test]
+    truncatable = getattr(backend, "truncatable", False) and n_estimators is None and not early_stopping_rounds
+    scores = [None] * len(candidates)
+    rounds = [None] * len(candidates)
+    for group in prefix_groups(candidates, truncatable):
+        start_time = time.time()
+        largest = max(group, key=lambda index: candidates[index].get("n_estimators") or 0)
+        with instrumentation.stage("fit", rows_in=len(train), params=candidates[largest], fraction=fraction, n_estimators=n_estimators, threads=backend.threads):
+            model = backend.fit(data, candidates[largest], n_estimators, early_stopping_rounds)
+        for index in group:
+            ntree_end = candidates[index]["n_estimators"] if len(group) > 1 else None
+            y_pred_proba = backend.predict(model, data, ntree_end)
+            scores[index] = roc_auc_score(y_test, y_pred_proba, sample_weight=test_weight)
+            if early_stopping_rounds:
+                rounds[index] = backend.fitted_rounds(model)
+            if verbose > 1:
+                print(f"[CV] {candidates[index]}; score={scores[index]:.4f}; {time.time() - start_time:.1f}s")
+    return scores, rounds
+
+def refit(backend, params, X, y, sample_weight=None):
+    if sample_weight is None:
+        rows = np.arange(len(y))
+    else:
+        rows = np.flatnonzero(sample_weight)
+        sample_weight = sample_weight[rows]
+    # A single fit: every core goes to its threads.
+    with instrumentation.stage("refit", rows_in=len(rows), params=params), scheduler.using_threads(backend, scheduler.available_cores()):
+        return backend.estimator(params).fit(X.iloc[rows], y.iloc[rows], sample_weight=sample_weight)
+
+def parallel_folds(backend, n_folds, n_jobs=None):
+    # Workers and threads per fit for `n_folds` folds scored in parallel,
+    # `n_jobs` only caps the number of workers.
+    n_workers, threads = scheduler.plan_threads(n_folds, backend.threaded, n_jobs)
+    return n_workers, scheduler.using_threads(backend, threads)
+
+def fold_tasks(backend, n_folds, n_candidates, n_jobs=None):
+    # (fold, candidate indices) pairs scored by the workers, see plan_chunks.
+    n_chunks = scheduler.plan_chunks(n_folds, n_candidates, backend.threaded, n_jobs)
+    return [(fold, chunk) for fold in range(n_folds) for chunk in np.array_split(np.arange(n_candidates), n_chunks)]
+
+def score_folds(backend, X, y, folds, candidates, n_jobs=None, verbose=0, **options):
+    # Scores and early-stopped rounds of every candidate on every fold, as
+    # (candidates, folds) arrays.
+    tasks = fold_tasks(backend, len(folds), len(candidates), n_jobs)
+    n_workers, threads = parallel_folds(backend, len(tasks), n_jobs)
+    with threads:
+        results = Parallel(n_jobs=n_workers, verbose=verbose)(
+            delayed(score_fold)(backend, X, y, folds[fold], [candidates[i] for i in chunk], verbose, **options)
+            for fold, chunk in tasks
+        )
+    scores = np.full((len(candidates), len(folds)), np.nan)
+    rounds = np.full((len(candidates), len(folds)), np.nan)
+    for (fold, chunk), (chunk_scores, chunk_rounds) in zip(tasks, results):
+        scores[chunk, fold] = chunk_scores
+        rounds[chunk, fold] = np.asarray(chunk_rounds, dtype=float)
+    return scores, rounds
+
+def shares_frames(backend, n_folds, n_candidates, n_jobs=None) -> bool:
+    # Whether several workers will read the training frame.
+    n_workers, _ = scheduler.plan_threads(len(fold_tasks(backend, n_folds, n_candidates, n_jobs)), backend.threaded, n_jobs)
+    return n_workers > 1
+
+class CachedGridSearchCV:
+    def __init__(self, backend, param_grid, cv, n_jobs=None, verbose=2):
+        self.backend = backend
+        self.param_grid = param_grid
+        self.cv = cv
+        self.n_jobs = n_jobs
+        self.verbose = verbose
+
+    def fit(self, X, y, sample_weight=None):
+        folds = make_folds(X, y, self.cv, sample_weight)
+        candidates = list(ParameterGrid(self.param_grid))
+        if self.verbose:
+            print(f"Fitting {len(folds)} folds for each of {len(candidates)} candidates, totalling {len(folds) * len(candidates)} fits")
+
+        enabled = shares_frames(self.backend, len(folds), len(candidates), self.n_jobs)
+        with shared_frame.shared_frames(X, y, enabled=enabled) as (X_shared, y_shared):
+            scores, _ = score_folds(self.backend, X_shared, y_shared, folds, candidates, self.n_jobs, self.verbose)
+
+        self.cv_results_ = {
+            "params": candidates,
+            "mean_test_score": scores.mean(axis=1),
+            "std_test_score": scores.std(axis=1),
+        }
+        for fold in range(len(folds)):
+            self.cv_results_[f"split{fold}_test_score"] = scores[:, fold]
+        self.best_index_ = int(np.argmax(self.cv_results_["mean_test_score"]))
+        self.best_params_ = candidates[self.best_index_]
+        self.best_score_ = float(self.cv_results_["mean_test_score"][self.best_index_])
+        self.best_estimator_ = refit(self.backend, self.best_params_, X, y, sample_weight)
+        return self
+
+class HalvingSearchCV:
+    # Successive halving: every rung scores the surviving candidates with a
+    # budget `factor` times larger than the previous one and keeps the best
+    # 1/factor. The budget is either a fraction of the training rows or a
+    # number of boosting rounds (resource="n_estimators").
+    def __init__(self, backend, param_grid, cv, resource="rows", factor=3, max_resources=None, min_resources=1, early_stopping_rounds=None, prune_margin=None, n_jobs=None, verbose=2):
+        self.backend = backend
+        self.param_grid = param_grid
+        self.cv = cv
+        self.resource = resource
+        self.factor = factor
+        self.max_resources = max_resources
+        self.min_resources = min_resources
+        self.early_stopping_rounds = early_stopping_rounds
+        self.prune_margin = prune_margin
+        self.n_jobs = n_jobs
+        self.verbose = verbose
+
+    def _score_rung(self, folds, candidates, fraction, n_estimators, shared):
+        # `shared` holds the handles of X and y sent to the fold workers.
+        options = dict(
+            n_jobs=self.n_jobs,
+            verbose=self.verbose,
+            fraction=fraction,
+            n_estimators=n_estimators,
+            early_stopping_rounds=self.early_stopping_rounds,
+            random_state=self.cv.random_state,
+        )
+        scores = np.full((len(candidates), len(folds)), np.nan)
+        rounds = np.full((len(candidates), len(folds)), np.nan)
+        # The first fold runs alone, before pruning: its fits get every core,
+        # as threads or as chunks of candidates.
+        scores[:, :1], rounds[:, :1] = score_folds(self.backend, *shared, folds[:1], candidates, **options)
+
+        alive = np.arange(len(candidates))
+        if self.prune_margin is not None:
+            alive = np.flatnonzero(scores[:, 0] >= scores[:, 0].max() - self.prune_margin)
+            if self.verbose and len(alive) < len(candidates):
+                print(f"{len(candidates) - len(alive)} candidates pruned after the first fold")
+
+        if len(folds) > 1:
+            remaining = np.ix_(alive, np.arange(1, len(folds)))
+            scores[remaining], rounds[remaining] = score_folds(self.backend, *shared, folds[1:], [candidates[i] for i in alive], **options)
+        return scores, rounds
+
+    def fit(self, X, y, sample_weight=None):
+        folds = make_folds(X, y, self.cv, sample_weight)
+        param_grid = dict(self.param_grid)
+        max_resources = self.max_resources
+        if self.resource == "n_estimators":
+            max_resources = max_resources or max(param_grid.pop("n_estimators", [100]))
+        elif self.resource != "rows":
+            raise ValueError(f"Unknown resource: {self.resource}")
+
+        candidates = list(ParameterGrid(param_grid))
+        n_rungs = 1 + int(math.log(len(candidates), self.factor) + 1e-9)
+        self.cv_results_ = {"iter": [], "n_resources": [], "params": [], "mean_test_score": [], "std_test_score": []}
+
+        enabled = shares_frames(self.backend, len(folds), len(candidates), self.n_jobs)
+        with shared_frame.shared_frames(X, y, enabled=enabled) as shared:
+            self._fit_rungs(folds, candidates, n_rungs, max_resources, shared)
+
+        self.best_estimator_ = refit(self.backend, self.best_params_, X, y, sample_weight)
+        return self
+
+    def _fit_rungs(self, folds, candidates, n_rungs, max_resources, shared):
+        for rung in range(n_rungs):
+            scale = self.factor ** (rung - n_rungs + 1)
+            if self.resource == "rows":
+                fraction, n_estimators, n_resources = scale, None, scale
+            else:
+                n_estimators = max(self.min_resources, int(round(max_resources * scale)))
+                fraction, n_resources = 1.0, n_estimators
+            if self.verbose:
+                print(f"Rung {rung}: {len(candidates)} candidates, {self.resource} budget {n_resources:g}")
+
+            scores, rounds = self._score_rung(folds, candidates, fraction, n_estimators, shared)
+            complete = ~np.isnan(scores).any(axis=1)
+            means = np.where(complete, np.nan_to_num(scores).mean(axis=1), -np.inf)
+            self.cv_results_["iter"] += [rung] * len(candidates)
+            self.cv_results_["n_resources"] += [n_resources] * len(candidates)
+            self.cv_results_["params"] += candidates
+            self.cv_results_["mean_test_score"] += list(np.where(complete, means, np.nan))
+            self.cv_results_["std_test_score"] += list(np.where(complete, np.nan_to_num(scores).std(axis=1), np.nan))
+
+            order = np.argsort(-means, kind="stable")
+            if rung < n_rungs - 1:
+                n_keep = min(math.ceil(len(candidates) / self.factor), int(complete.sum()))
+                candidates = [candidates[i] for i in order[:max(1, n_keep)]]
+
+        self.best_params_ = dict(candidates[order[0]])
+        self.best_score_ = float(means[order[0]])
+        if self.resource == "n_estimators":
+            self.best_params_["n_estimators"] = n_estimators
+        if self.early_stopping_rounds and not np.isnan(rounds[order[0]]).all():
+            # The folds scored early-stopped models: the refit uses the mean
+            # number of trees they kept, not the full budget.
+            self.best_params_["n_estimators"] = int(round(np.nanmean(rounds[order[0]])))
\ No newline at end of file
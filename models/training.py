@@ -0,0 +1,80 @@
+import time
+import numpy as np
+from utils import data_analyzer, data_loader, evaluation, instrumentation
+from models import search
+from sklearn.model_selection import train_test_split
+from sklearn.model_selection import StratifiedKFold, ParameterGrid
+
+def train_and_save_results(make_backend, X, param_grid, path_img, name, compressed=False, strategy="grid", **search_params):
+    print(f"Démarrage de l'entraînement du classifieur {name} avec recherche par grille ({strategy})")
+    if compressed:
+        X, y, sample_weight = data_loader.expand_pattern_table(X)
+        train_weight, test_weight = search.weighted_train_test_split(sample_weight, y, test_size=0.2, random_state=42)
+        X_train, y_train = X, y
+    else:
+        y = X['collision_severity']
+        X = X.drop('collision_severity', axis=1)
+        sample_weight = np.ones(len(y))
+
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+
+    print(f"Grille de paramètres définie avec {len(ParameterGrid(param_grid))} combinaisons possibles")
+
+    pos_class_weight = ((np.sum(sample_weight) - np.sum(sample_weight * y)) / np.sum(sample_weight * y))
+    print(f"Poids de la classe positive : {pos_class_weight:.4f}")
+
+    backend = make_backend(pos_class_weight)
+
+    skf = StratifiedKFold(n_splits=5, shuffle=True, random_state=42)
+    print("Initialisation de StratifiedKFold avec 5 plis")
+
+    if strategy == "grid":
+        grid_search = search.CachedGridSearchCV(
+            backend=backend,
+            param_grid=param_grid,
+            cv=skf,
+            verbose=2,
+            **search_params
+        )
+    elif strategy == "halving":
+        grid_search = search.HalvingSearchCV(
+            backend=backend,
+            param_grid=param_grid,
+            cv=skf,
+            verbose=2,
+            **search_params
+        )
+    else:
+        raise ValueError(f"Unknown search strategy: {strategy}")
+
+    print("Lancement de la recherche par grille...")
+    start_time = time.time()
+    with instrumentation.stage(f"search_{path_img}", rows_in=len(X_train), strategy=strategy):
+        grid_search.fit(X_train, y_train, sample_weight=train_weight if compressed else None)
+    end_time = time.time()
+    print(f"Temps d'entraînement : {end_time - start_time:.2f} secondes")
+    print("Recherche par grille terminée")
+
+    print(f"Meilleurs paramètres : {grid_search.best_params_}")
+    print(f"Meilleur score CV : {grid_search.best_score_:.4f}")
+
+    best_model = grid_search.best_estimator_
+    if compressed:
+        test_evaluation = evaluation.evaluate(best_model.predict_proba(X)[:, 1], y, test_weight)
+    else:
+        test_evaluation = evaluation.evaluate(best_model.predict_proba(X_test)[:, 1], y_test)
+    evaluation.save_evaluation_report(test_evaluation, f"pictures/{path_img}_evaluation.json")
+    print(f"AUC ROC : {test_evaluation['roc_auc']:.4f} (IC {test_evaluation['confidence_intervals']['roc_auc']})")
+    print(f"Seuil optimal en coût : {test_evaluation['cost_optimal']['threshold']:.4f}")
+
+    print("Sauvegarde de la matrice de confusion, des courbes ROC et précision-rappel et des features importances")
+    data_analyzer.render_figures([
+        (data_analyzer.plot_confusion_matrix, (test_evaluation, path_img), f"pictures/{path_img}_confusion_matrix.png"),
+        (data_analyzer.plot_roc_curve, (test_evaluation, path_img), f"pictures/{path_img}_roc_curve.png"),
+        (data_analyzer.plot_precision_recall_curve, (test_evaluation, path_img), f"pictures/{path_img}_precision_recall.png"),
+        (data_analyzer.plot_feature_importance, (best_model, X.columns, path_img), f"pictures/{path_img}_features_importance.png"),
+    ])
+
+    print(f"Processus d'entraînement du classifieur {name} achevé")
+
+    return best_model
\ No newline at end of file
@@ -1,66 +1,207 @@
+import os
+import shutil
 import numpy as np
-from utils import data_analyzer
+import pandas as pd
+import xgboost as xgb
 from xgboost import XGBClassifier
-from sklearn.model_selection import train_test_split
-from sklearn.model_selection import StratifiedKFold, GridSearchCV
-import time
+from sklearn.model_selection import ParameterGrid
+from models import training
+from utils import data_loader, evaluation, instrumentation
 
-def train_and_save_results(X, path_img="xgboost"):
-    print("Démarrage de l'entraînement du classifieur XGBoost avec GridSearchCV")
-    y = X['collision_severity']
-    X = X.drop('collision_severity', axis=1)
+PARAM_GRID = {
+    'n_estimators': [50, 100, 200],
+    'max_depth': [3, 5, None],
+    'learning_rate': [0.01, 0.1, 0.2, 0.5],
+}
 
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+# Out-of-core mode: the clean parquet dataset is streamed one row group at a
+# time, so only the quantised pages cached on disk grow with the data.
+EXTERNAL_PARAM_GRID = {
+    'max_depth': [3, 5, 7],
+    'learning_rate': [0.1, 0.2],
+}
+EXTERNAL_MAX_ROUNDS = 500
+# Share of the training row groups held out for early stopping, the scored
+# fold staying unseen until its predictions.
+EXTERNAL_STOPPING_SPLITS = 10
+EXTERNAL_MEMORY_CACHE = "data/xgboost_cache"
 
-    param_grid = {
-        'n_estimators': [50, 100, 200],
-        'max_depth': [3, 5, None],
-        'learning_rate': [0.01, 0.1, 0.2, 0.5],
-    }
-    # print(f"Grille de paramètres définie avec {len(param_grid['n_estimators']) * len(param_grid['max_depth']) * len(param_grid['learning_rate'])} combinaisons possibles")
+class XGBoostBackend:
+    truncatable = True
+    threaded = True
 
-    pos_class_weight = ((len(y) - np.sum(y)) / np.sum(y))
-    print(f"Poids de la classe positive : {pos_class_weight:.4f}")
+    def __init__(self, **base_params):
+        self.base_params = base_params
+        # Threads per fit, set by models.scheduler; None uses every core.
+        self.threads = None
 
-    base_model = XGBClassifier(
+    def estimator(self, params):
+        return XGBClassifier(**self.base_params, **params, n_jobs=self.threads)
+
+    def prepare(self, X_train, y_train, train_weight, X_test, valid=None):
+        dtrain = xgb.QuantileDMatrix(X_train, y_train, weight=train_weight, enable_categorical=True, nthread=self.threads)
+        dvalid = None
+        if valid is not None:
+            dvalid = xgb.QuantileDMatrix(valid[0], valid[1], weight=valid[2], ref=dtrain, enable_categorical=True, nthread=self.threads)
+        return dtrain, xgb.DMatrix(X_test, enable_categorical=True, nthread=self.threads), dvalid
+
+    def fit(self, data, params, n_estimators=None, early_stopping_rounds=None):
+        estimator = self.estimator(params)
+        xgb_params = estimator.get_xgb_params()
+        evals = []
+        if early_stopping_rounds:
+            xgb_params["eval_metric"] = "auc"
+            evals = [(data[2], "valid")]
+        return xgb.train(
+            xgb_params,
+            data[0],
+            n_estimators or estimator.get_num_boosting_rounds(),
+            evals=evals,
+            early_stopping_rounds=early_stopping_rounds,
+            verbose_eval=False,
+        )
+
+    def fitted_rounds(self, model):
+        # Trees kept by early stopping, None without it.
+        return model.best_iteration + 1 if model.attr("best_iteration") is not None else None
+
+    def predict(self, model, data, n_estimators=None):
+        if n_estimators:
+            return model.predict(data[1], iteration_range=(0, n_estimators))
+        if model.attr("best_iteration") is not None:
+            return model.predict(data[1], iteration_range=(0, model.best_iteration + 1))
+        return model.predict(data[1])
+
+def make_backend(pos_class_weight):
+    return XGBoostBackend(
         objective='binary:logistic',
         scale_pos_weight=pos_class_weight,
         max_delta_step=1,
+        enable_categorical=True,
         random_state=42
     )
 
-    skf = StratifiedKFold(n_splits=5, shuffle=True, random_state=42)
-    print("Initialisation de StratifiedKFold avec 5 plis")
-
-    grid_search = GridSearchCV(
-        estimator=base_model,
-        param_grid=param_grid,
-        cv=skf,
-        scoring='roc_auc',
-        n_jobs=4,
-        verbose=2
+def train_and_save_results(X, path_img="xgboost", compressed=False, strategy="grid", **search_params):
+    return training.train_and_save_results(
+        make_backend, X, PARAM_GRID, path_img, "XGBoost", compressed, strategy, **search_params
     )
 
-    print("Lancement de la recherche par grille...")
-    start_time = time.time()
-    grid_search.fit(X_train, y_train)
-    end_time = time.time()
-    print(f"Temps d'entraînement : {end_time - start_time:.2f} secondes")
-    print("Recherche par grille terminée")
+class RowGroupIter(xgb.DataIter):
+    # One batch per row group of the clean dataset, encoded on the fly.
+    def __init__(self, row_groups:list, encode, cache_prefix:str):
+        self.row_groups = row_groups
+        self.encode = encode
+        self.position = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data) -> bool:
+        if self.position == len(self.row_groups):
+            return False
+        X, y = self.encode(data_loader.read_row_group(self.row_groups[self.position]))
+        input_data(data=X, label=y)
+        self.position += 1
+        return True
+
+    def reset(self):
+        self.position = 0
+
+def scan_row_groups(row_groups:list, fields:list, target:str=data_loader.TARGET_FIELD) -> tuple:
+    # One pass over the target and the encoded fields: rows and positives of
+    # every row group, and a small frame holding every value seen per field,
+    # on which the encoders are fitted.
+    stats = np.zeros((len(row_groups), 2), dtype=np.int64)
+    values = {field: set() for field in fields}
+    for i, row_group in enumerate(row_groups):
+        df = data_loader.read_row_group(row_group, [target] + fields)
+        stats[i] = len(df), int(df[target].sum())
+        for field in fields:
+            values[field].update(df[field].unique().tolist())
+    size = max(len(v) for v in values.values())
+    domains = pd.DataFrame({field: np.resize(np.array(sorted(v)), size) for field, v in values.items()})
+    return stats, domains
+
+def stratified_row_group_folds(stats:np.ndarray, n_folds:int) -> np.ndarray:
+    # Row groups ranked by positive rate are dealt to the folds in turn, so
+    # that every fold gets a similar share of rows and of severe collisions.
+    rate = stats[:, 1] / np.maximum(stats[:, 0], 1)
+    folds = np.empty(len(stats), dtype=np.int64)
+    folds[np.argsort(rate, kind="stable")] = np.arange(len(stats)) % n_folds
+    return folds
+
+def predict_row_groups(booster, row_groups:list, encode) -> tuple:
+    scores, labels = [], []
+    iteration_range = (0, booster.best_iteration + 1) if booster.attr("best_iteration") is not None else (0, 0)
+    for row_group in row_groups:
+        X, y = encode(data_loader.read_row_group(row_group))
+        scores.append(booster.predict(xgb.DMatrix(X, enable_categorical=True), iteration_range=iteration_range))
+        labels.append(y.to_numpy())
+    return np.concatenate(scores), np.concatenate(labels)
+
+def external_matrices(train_groups:list, valid_groups:list, encode, cache_prefix:str) -> tuple:
+    dtrain = xgb.ExtMemQuantileDMatrix(RowGroupIter(train_groups, encode, f"{cache_prefix}-train"), enable_categorical=True)
+    dvalid = None
+    if valid_groups:
+        dvalid = xgb.ExtMemQuantileDMatrix(RowGroupIter(valid_groups, encode, f"{cache_prefix}-valid"), ref=dtrain, enable_categorical=True)
+    return dtrain, None, dvalid
+
+def train_external_memory(dataset_path:str, categorical_fields:list, time_cycle_fields:list, param_grid:dict=EXTERNAL_PARAM_GRID,
+                          n_folds:int=5, early_stopping_rounds:int=20, cache_dir:str=EXTERNAL_MEMORY_CACHE, path_img:str="xgboost_external") -> tuple:
+    # Cross-validated search over row-group folds, then a refit on every row
+    # group with the mean best number of rounds. Early stopping watches a
+    # slice of the training row groups, never the scored fold. Returns the
+    # model and the encoders fitted during the first pass.
+    print("Démarrage de l'entraînement XGBoost hors mémoire")
+    row_groups = data_loader.list_row_groups(dataset_path)
+    stats, domains = scan_row_groups(row_groups, categorical_fields + time_cycle_fields)
+    if len(row_groups) <= n_folds:
+        raise ValueError(f"{len(row_groups)} row groups cannot be split into {n_folds} folds and an early stopping slice")
+    time_cycle_encoder = data_loader.fit_sin_cos_encoder(domains, time_cycle_fields)
+    category_encoder = data_loader.fit_category_encoder(domains, categorical_fields)
 
-    print(f"Meilleurs paramètres : {grid_search.best_params_}")
-    print(f"Meilleur score CV : {grid_search.best_score_:.4f}")
+    def encode(df):
+        y = df.pop(data_loader.TARGET_FIELD)
+        return category_encoder.transform(time_cycle_encoder.transform(df)), y
 
-    best_model = grid_search.best_estimator_
-    y_pred_proba = best_model.predict_proba(X_test)[:, 1]
+    rows, positives = stats.sum(axis=0)
+    print(f"{rows} lignes réparties en {len(row_groups)} groupes de lignes")
+    backend = make_backend((rows - positives) / positives)
+    folds = stratified_row_group_folds(stats, n_folds)
+    os.makedirs(cache_dir, exist_ok=True)
 
-    print("Sauvegarde de la matrice de confusion")
-    data_analyzer.plot_confusion_matrix(y_pred_proba, y_test, path_img)
-    print("Sauvegarde de la courbe ROC")
-    data_analyzer.plot_roc_curve(y_pred_proba, y_test, path_img)
-    print("Sauvegarde des features importances")
-    data_analyzer.plot_feature_importance(best_model, X.columns, path_img)
+    best = None
+    try:
+        for params in ParameterGrid(param_grid):
+            aucs, rounds, out_of_fold = [], [], []
+            for fold in range(n_folds):
+                train = np.flatnonzero(folds != fold)
+                stopping = train[stratified_row_group_folds(stats[train], EXTERNAL_STOPPING_SPLITS) == 0]
+                train = np.setdiff1d(train, stopping)
+                valid_groups = [g for g, f in zip(row_groups, folds) if f == fold]
+                with instrumentation.stage("fit", rows_in=int(stats[train, 0].sum()), params=params, external_memory=True):
+                    data = external_matrices([row_groups[i] for i in train], [row_groups[i] for i in stopping], encode, os.path.join(cache_dir, f"fold{fold}"))
+                    booster = backend.fit(data, params, EXTERNAL_MAX_ROUNDS, early_stopping_rounds)
+                    # The cache pages are removed with the matrices.
+                    del data
+                y_score, y_true = predict_row_groups(booster, valid_groups, encode)
+                aucs.append(evaluation.evaluate(y_score, y_true, n_replicates=0)["roc_auc"])
+                rounds.append(booster.best_iteration + 1)
+                out_of_fold.append((y_score, y_true))
+            print(f"{params} : AUC CV {np.mean(aucs):.4f}")
+            if best is None or np.mean(aucs) > best[1]:
+                best = (params, np.mean(aucs), int(np.mean(rounds)), out_of_fold)
 
-    print("Processus d'entraînement du classifieur XGBoost avec GridSearch achevé")
+        params, score, n_estimators, out_of_fold = best
+        print(f"Meilleurs paramètres : {params}, {n_estimators} arbres")
+        print(f"Meilleur score CV : {score:.4f}")
+        with instrumentation.stage("refit", rows_in=int(rows), params=params, external_memory=True):
+            booster = backend.fit(external_matrices(row_groups, [], encode, os.path.join(cache_dir, "refit")), params, n_estimators)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
 
-    return best_model
\ No newline at end of file
+    y_score = np.concatenate([s for s, _ in out_of_fold])
+    y_true = np.concatenate([t for _, t in out_of_fold])
+    evaluation.save_evaluation_report(evaluation.evaluate(y_score, y_true), f"pictures/{path_img}_evaluation.json")
+    model = XGBClassifier()
+    model.load_model(bytearray(booster.save_raw("ubj")))
+    print("Processus d'entraînement XGBoost hors mémoire achevé")
+    return model, time_cycle_encoder, category_encoder
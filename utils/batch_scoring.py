@@ -0,0 +1,147 @@
+import os
+import time
+import queue
+import threading
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from utils import data_loader, serving, instrumentation
+
+# Scores a whole collision.csv / vehicle.csv extract with a trained bundle.
+# The collision table, filtered by the push-down rules, is read once and
+# indexed by collision_index; the vehicle file is then streamed in blocks
+# through three threads joined by bounded queues: reading and joining (the
+# pyarrow CSV parser releases the GIL), cleaning, encoding and scoring, and
+# writing the parquet row groups. At most QUEUE_SIZE blocks wait between two
+# stages, so memory stays bounded whatever the size of the extract.
+# Throughput is counted on the vehicle rows read from the CSV, before the
+# push-down rules, the join and the cleaning.
+
+BATCH_BLOCK_SIZE = 16 * 1024 * 1024
+QUEUE_SIZE = 4
+OUTPUT_SCHEMA = pa.schema([
+    ("collision_index", pa.string()),
+    ("collision_severity", pa.int8()),
+    ("probability", pa.float64()),
+])
+DONE = None
+
+def put(blocks:queue.Queue, item, stop:threading.Event):
+    # Gives up when the other side of the queue has stopped.
+    while not stop.is_set():
+        try:
+            blocks.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+def join_block(collisions:pd.DataFrame, collision_keys:pd.Index, vehicles:pd.DataFrame) -> pd.DataFrame:
+    # Inner join on collision_index against the prebuilt index of the
+    # collision table, one row per vehicle as in read_merged_dataset.
+    keys = vehicles[data_loader.JOIN_KEY]
+    if keys.dtype != collision_keys.dtype:
+        # A block of non-integer keys against integer collision keys, or the
+        # reverse: both sides compared as strings.
+        collision_keys, keys = data_loader.comparable_keys(collision_keys.to_series(), keys)
+        collision_keys = pd.Index(collision_keys)
+    positions = collision_keys.get_indexer(keys)
+    matched = np.flatnonzero(positions >= 0)
+    return pd.concat([
+        collisions.iloc[positions[matched]].reset_index(drop=True),
+        vehicles.iloc[matched].drop(columns=[data_loader.JOIN_KEY]).reset_index(drop=True),
+    ], axis=1)
+
+def read_blocks(collision_path:str, vehicle_path:str, blocks:queue.Queue, stop:threading.Event, block_size:int, pushed_down:dict):
+    # `pushed_down` receives the rows rejected while reading, complete once
+    # DONE is queued.
+    try:
+        with instrumentation.stage("load_collision", engine="arrow") as record:
+            collisions = data_loader.scan_csv_arrow(collision_path, data_loader.COLLISION_FIELD, data_loader.DTYPES_COLLISION, rejections=pushed_down)
+            record["rows_out"] = len(collisions)
+        collision_keys = pd.Index(collisions[data_loader.JOIN_KEY])
+        if not collision_keys.is_unique:
+            raise ValueError(f"Duplicated collision_index in {collision_path}")
+        for rows_read, vehicles in data_loader.iter_csv_arrow(vehicle_path, data_loader.VEHICLE_FIELDS, data_loader.DTYPES_VEHICLE, block_size, rejections=pushed_down):
+            if stop.is_set():
+                return
+            put(blocks, (rows_read, join_block(collisions, collision_keys, vehicles)), stop)
+        put(blocks, DONE, stop)
+    except BaseException as error:
+        put(blocks, error, stop)
+
+def write_tables(output_path:str, tables:queue.Queue, stop:threading.Event, errors:list):
+    try:
+        with pq.ParquetWriter(output_path, OUTPUT_SCHEMA) as writer:
+            while (table := tables.get()) is not DONE:
+                writer.write_table(table)
+    except BaseException as error:
+        errors.append(error)
+        stop.set()
+
+def score_block(bundle:dict, merged:pd.DataFrame) -> tuple:
+    # The clean frame keeps the positional labels of the merged block.
+    clean, rejections = data_loader.clean_dataset(merged)
+    probability = serving.score_frame(bundle, clean) if len(clean) else np.empty(0)
+    table = pa.table({
+        "collision_index": pc.cast(pa.array(merged[data_loader.JOIN_KEY].iloc[clean.index]), pa.string()),
+        "collision_severity": clean["collision_severity"].to_numpy(),
+        "probability": np.asarray(probability, dtype=np.float64),
+    }, schema=OUTPUT_SCHEMA)
+    return table, rejections
+
+def score_extract(bundle:dict, collision_path:str, vehicle_path:str, output_path:str, block_size:int=BATCH_BLOCK_SIZE) -> dict:
+    # Writes collision_index, the observed binary severity and the predicted
+    # probability of every vehicle row kept by the cleaning rules. The output
+    # file appears once complete.
+    partial_path = f"{output_path}.partial"
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    blocks, tables = queue.Queue(QUEUE_SIZE), queue.Queue(QUEUE_SIZE)
+    stop, errors, pushed_down = threading.Event(), [], {}
+    reader = threading.Thread(target=read_blocks, args=(collision_path, vehicle_path, blocks, stop, block_size, pushed_down), daemon=True)
+    writer = threading.Thread(target=write_tables, args=(partial_path, tables, stop, errors), daemon=True)
+    rows_read, rows_joined, rows_scored, rejected = 0, 0, 0, None
+    start = time.perf_counter()
+    with instrumentation.stage("batch_score") as record:
+        reader.start()
+        writer.start()
+        try:
+            while (item := blocks.get()) is not DONE:
+                if isinstance(item, BaseException):
+                    raise item
+                block_rows, block = item
+                with instrumentation.stage("score_block", rows_in=len(block)) as block_record:
+                    table, rejections = score_block(bundle, block)
+                    block_record["rows_out"] = table.num_rows
+                rejected = rejections if rejected is None else rejected + rejections
+                if table.num_rows:
+                    put(tables, table, stop)
+                if errors:
+                    raise errors[0]
+                rows_read += block_rows
+                rows_joined += len(block)
+                rows_scored += table.num_rows
+                elapsed = time.perf_counter() - start
+                print(f"{rows_read} vehicle rows read, {rows_joined} joined, {rows_scored} scored, {rows_read / elapsed:,.0f} rows/s")
+            put(tables, DONE, stop)
+            writer.join()
+            if errors:
+                raise errors[0]
+        except BaseException:
+            put(tables, DONE, stop)
+            stop.set()
+            writer.join()
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        os.replace(partial_path, output_path)
+        record["rows_in"] = rows_read
+        record["rows_out"] = rows_scored
+
+    elapsed = time.perf_counter() - start
+    if rejected is not None:
+        print(data_loader.add_rejections(rejected, pushed_down).to_string())
+    print(f"{rows_read} vehicle rows read, {rows_scored} scored in {elapsed:.1f}s ({rows_read / elapsed:,.0f} rows/s), saved in the following path: {output_path}")
+    return {"rows_read": rows_read, "rows_joined": rows_joined, "rows_scored": rows_scored, "seconds": elapsed,
+            "rows_per_second": rows_read / elapsed, "output_path": output_path}
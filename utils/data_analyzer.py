@@ -1,18 +1,159 @@
+import os
+import json
+import math
+import hashlib
 import numpy as np
 import pandas as pd
-import seaborn as sns
-import plotly.express as px
-import matplotlib.pyplot as plt
-from sklearn.metrics import confusion_matrix, precision_recall_curve, auc, roc_curve
-
-
-def generate_plots(dataset: pd.DataFrame):
-    pivot_table = pd.crosstab(
-        dataset["day"],
-        dataset["month"],
-        values=dataset["collision_severity"],
-        aggfunc=lambda x: (x == 1).sum() / len(x) * 100,
-    )
+from joblib import Parallel, delayed
+from utils import evaluation, pipeline
+
+TARGET_FIELD = "collision_severity"
+PATTERN_TOTAL = "total"
+PATTERN_SEVERE = "severe"
+RENDER_MANIFEST = "pictures/.render_manifest.json"
+QUALITY_PROFILES = {
+    "draft": {"max_dpi": 100, "image_scale": 1},
+    "publication": {"max_dpi": None, "image_scale": None},
+}
+QUALITY = "publication"
+CUBE_VIEWS = {
+    "time": ["day", "month", "hour"],
+    "driver_age": ["age_of_driver"],
+    "vehicle_age": ["age_of_vehicle"],
+    "weather": ["weather_conditions", "light_conditions"],
+    "road": ["speed_limit", "road_type"],
+}
+
+def aggregate_counts(dataset: pd.DataFrame, dimensions: list, target: str = TARGET_FIELD) -> pd.DataFrame:
+    # Grouped count over the small integer domains of the dimensions, one row
+    # per non-empty cell in cell order. `dataset` is either raw rows or a
+    # table of counts (total and severe columns), such as the pattern table or
+    # another aggregate.
+    offsets = [int(dataset[d].min()) for d in dimensions]
+    shape = [int(dataset[d].max()) - offset + 1 for d, offset in zip(dimensions, offsets)]
+    cell = np.zeros(len(dataset), dtype=np.int64)
+    for d, offset, size in zip(dimensions, offsets, shape):
+        cell = cell * size + (dataset[d].to_numpy().astype(np.int64) - offset)
+    # Cells are counted densely when there are fewer of them than rows, else
+    # the non-empty ones are numbered first.
+    dense = math.prod(shape) <= len(dataset)
+    codes, present = (cell, None) if dense else pd.factorize(cell, sort=True)
+    n_cells = math.prod(shape) if dense else len(present)
+    if PATTERN_TOTAL in dataset.columns:
+        total = np.bincount(codes, weights=dataset[PATTERN_TOTAL].to_numpy(), minlength=n_cells)
+        severe = np.bincount(codes, weights=dataset[PATTERN_SEVERE].to_numpy(), minlength=n_cells)
+    else:
+        total = np.bincount(codes, minlength=n_cells)
+        severe = np.bincount(codes, weights=dataset[target].to_numpy() == 1, minlength=n_cells)
+    if dense:
+        present = np.flatnonzero(total)
+        total, severe = total[present], severe[present]
+    view = {d: index + offset for d, index, offset in zip(dimensions, np.unravel_index(present, shape), offsets)}
+    view[PATTERN_TOTAL] = total.astype(np.int64)
+    view[PATTERN_SEVERE] = severe.astype(np.int64)
+    return pd.DataFrame(view)
+
+def build_aggregation_cube(dataset: pd.DataFrame, views: dict = CUBE_VIEWS) -> dict:
+    # Raw rows are counted once on every dimension used by the views, and each
+    # view sums those cells. A table of counts, such as the pattern table, is
+    # summed directly.
+    if PATTERN_TOTAL not in dataset.columns:
+        dimensions = list(dict.fromkeys(d for view_dimensions in views.values() for d in view_dimensions))
+        dataset = aggregate_counts(dataset, dimensions)
+    return {name: aggregate_counts(dataset, view_dimensions) for name, view_dimensions in views.items()}
+
+def save_aggregation_cube(cube: dict, cube_path: str):
+    os.makedirs(cube_path, exist_ok=True)
+    for name, view in cube.items():
+        view.to_parquet(os.path.join(cube_path, f"{name}.parquet"), index=False)
+
+def load_aggregation_cube(cube_path: str, views: dict = CUBE_VIEWS) -> dict:
+    return {name: pd.read_parquet(os.path.join(cube_path, f"{name}.parquet")) for name in views}
+
+def set_quality(profile: str):
+    global QUALITY
+    if profile not in QUALITY_PROFILES:
+        raise ValueError(f"Unknown quality profile: {profile}")
+    QUALITY = profile
+
+def figure_dpi(dpi: int) -> int:
+    max_dpi = QUALITY_PROFILES[QUALITY]["max_dpi"]
+    return dpi if max_dpi is None else min(dpi, max_dpi)
+
+def image_scale(scale: float) -> float:
+    return QUALITY_PROFILES[QUALITY]["image_scale"] or scale
+
+def input_digest(value, hasher=None) -> str:
+    hasher = hasher or hashlib.sha256()
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        hasher.update(pd.util.hash_pandas_object(value).to_numpy().tobytes())
+        hasher.update(repr(list(value.columns) if isinstance(value, pd.DataFrame) else value.name).encode())
+    elif isinstance(value, np.ndarray):
+        hasher.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        for key in sorted(value):
+            hasher.update(repr(key).encode())
+            input_digest(value[key], hasher)
+    elif isinstance(value, (list, tuple, pd.Index)):
+        for item in value:
+            input_digest(item, hasher)
+    elif hasattr(value, "feature_importances_"):
+        input_digest(np.asarray(value.feature_importances_), hasher)
+    else:
+        hasher.update(repr(value).encode())
+    return hasher.hexdigest()
+
+def render_figure(function, args: tuple, quality: str):
+    set_quality(quality)
+    function(*args)
+
+def render_figures(tasks: list, n_jobs: int = None, force: bool = False) -> list:
+    # `tasks` holds (function, args, output) triples. A figure whose output
+    # exists and whose code, inputs and quality profile are unchanged since the
+    # last render is skipped, the others are drawn in parallel worker processes.
+    # The code is the whole source of this module and of the function's, so
+    # the shared helpers and style constants are covered too.
+    manifest = {}
+    if os.path.exists(RENDER_MANIFEST):
+        with open(RENDER_MANIFEST) as f:
+            manifest = json.load(f)
+    pending = []
+    for function, args, output in tasks:
+        code = pipeline.code_digest(sorted({__name__, function.__module__}))
+        digest = input_digest([function.__name__, code, QUALITY, args])
+        if force or manifest.get(output) != digest or not os.path.exists(output):
+            pending.append((function, args, output, digest))
+    if pending:
+        n_jobs = n_jobs or min(len(pending), os.cpu_count() or 1)
+        Parallel(n_jobs=n_jobs)(delayed(render_figure)(function, args, QUALITY) for function, args, _, _ in pending)
+        manifest.update({output: digest for _, _, output, digest in pending})
+        os.makedirs(os.path.dirname(RENDER_MANIFEST), exist_ok=True)
+        with open(RENDER_MANIFEST, "w") as f:
+            json.dump(manifest, f, indent=2)
+    return [output for _, _, output, _ in pending]
+
+def generate_plots(dataset: pd.DataFrame = None, cube_path: str = None, n_jobs: int = None, force: bool = False, cube: dict = None):
+    # The raw rows are scanned once into the aggregation cube, every figure is
+    # drawn from it. Without a dataset, the given cube or the one saved in
+    # `cube_path` is reused.
+    if cube is None and dataset is not None:
+        cube = build_aggregation_cube(dataset)
+        if cube_path is not None:
+            save_aggregation_cube(cube, cube_path)
+    elif cube is None:
+        cube = load_aggregation_cube(cube_path)
+
+    tasks = [
+        (function, ({view: cube[view] for view in views},), output)
+        for function, views, output in EDA_FIGURES
+    ]
+    return render_figures(tasks, n_jobs, force)
+
+def plot_seasonality(cube: dict):
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+    time_view = cube["time"].groupby(["day", "month"])[["total", "severe"]].sum()
+    pivot_table = (time_view["severe"] / time_view["total"] * 100).unstack("month")
 
     jours_map = {
         0: "Lundi",
@@ -60,7 +201,7 @@ def generate_plots(dataset: pd.DataFrame):
     mois_presents = [m for m in mois_ordre if m in pivot_table.columns]
     pivot_table = pivot_table.reindex(index=jours_presents, columns=mois_presents)
 
-    plt.figure(figsize=(12, 7), dpi=700)
+    plt.figure(figsize=(12, 7), dpi=figure_dpi(700))
     ax = sns.heatmap(
         pivot_table,
         annot=True,
@@ -77,10 +218,12 @@ def generate_plots(dataset: pd.DataFrame):
     plt.savefig("pictures/seasonality.png", bbox_inches="tight")
     plt.close()
 
-    dataset_filtered = dataset[(dataset["age_of_driver"] >= 18) & (dataset["age_of_driver"] <= 85)]
-    severity_by_age = dataset_filtered.groupby("age_of_driver")["collision_severity"].agg(
-        total="count", severe=lambda x: (x == 1).sum()
-    )
+def plot_driver_age(cube: dict):
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+    driver_view = cube["driver_age"]
+    driver_view = driver_view[(driver_view["age_of_driver"] >= 18) & (driver_view["age_of_driver"] <= 85)]
+    severity_by_age = driver_view.set_index("age_of_driver")[["total", "severe"]]
     severity_by_age["percentage"] = (
         severity_by_age["severe"] / severity_by_age["total"]
     ) * 100
@@ -88,7 +231,7 @@ def generate_plots(dataset: pd.DataFrame):
         severity_by_age["percentage"].rolling(window=5, center=True).mean()
     )
     sns.set_theme(style="whitegrid", palette="muted")
-    plt.figure(figsize=(14, 7), dpi=500)
+    plt.figure(figsize=(14, 7), dpi=figure_dpi(500))
     sns.lineplot(
         data=severity_by_age,
         x=severity_by_age.index,
@@ -115,18 +258,17 @@ def generate_plots(dataset: pd.DataFrame):
     plt.savefig("pictures/driver_age.png", bbox_inches="tight")
     plt.close()
 
-    severity_by_age = (
-        dataset.groupby("age_of_vehicle")["collision_severity"]
-        .agg(total="count", severe=lambda x: (x == 1).sum())
-        .sort_index()
-    )
+def plot_vehicle_age(cube: dict):
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+    severity_by_age = cube["vehicle_age"].set_index("age_of_vehicle").sort_index()
     severity_by_age_filtered = severity_by_age[severity_by_age["total"] > 10].copy()
     severity_by_age_filtered["percentage"] = (
         severity_by_age_filtered["severe"] / severity_by_age_filtered["total"]
     ) * 100
     severity_by_age_plot = severity_by_age_filtered.reset_index()
     sns.set_theme(style="whitegrid")
-    plt.figure(figsize=(16, 8), dpi=300)
+    plt.figure(figsize=(16, 8), dpi=figure_dpi(300))
     palette = "Spectral_r"
     scatter_plot = sns.scatterplot(
         data=severity_by_age_plot,
@@ -163,12 +305,16 @@ def generate_plots(dataset: pd.DataFrame):
     plt.savefig("pictures/vehicle_age.png", bbox_inches="tight")
     plt.close()
 
-    first_tree_map_data = (
-        dataset.groupby(["weather_conditions", "light_conditions"])
-        .agg({"collision_severity": ["mean", "count"]})
-        .reset_index()
-    )
-    first_tree_map_data.columns = ["Météo", "Visibilité", "pct", "nombre"]
+def treemap_data(view: pd.DataFrame, dimensions: list, names: list) -> pd.DataFrame:
+    data = view[dimensions].copy()
+    data["pct"] = view["severe"] / view["total"]
+    data["nombre"] = view["total"]
+    data.columns = names + ["pct", "nombre"]
+    return data
+
+def plot_weather_treemap(cube: dict):
+    import plotly.express as px
+    first_tree_map_data = treemap_data(cube["weather"], ["weather_conditions", "light_conditions"], ["Météo", "Visibilité"])
 
     weather_map = {
         1: "Beau temps",
@@ -202,14 +348,11 @@ def generate_plots(dataset: pd.DataFrame):
         ),
     )
     fig.update_layout(margin=dict(t=10, l=10, r=10, b=10))
-    fig.write_image("pictures/meteo.png", format="png", width=800, height=450, scale=4)
+    fig.write_image("pictures/meteo.png", format="png", width=800, height=450, scale=image_scale(4))
 
-    first_tree_map_data = (
-        dataset.groupby(["speed_limit", "road_type"])
-        .agg({"collision_severity": ["mean", "count"]})
-        .reset_index()
-    )
-    first_tree_map_data.columns = ["Limite de vitesse", "Type de route", "pct", "nombre"]
+def plot_road_treemap(cube: dict):
+    import plotly.express as px
+    first_tree_map_data = treemap_data(cube["road"], ["speed_limit", "road_type"], ["Limite de vitesse", "Type de route"])
 
     road_type_map = {
         1: "Rond-point",
@@ -250,16 +393,20 @@ def generate_plots(dataset: pd.DataFrame):
     )
     fig.update_layout(margin=dict(t=50, l=25, r=25, b=25))
     fig.update_layout(margin=dict(t=10, l=10, r=10, b=10))
-    fig.write_image("pictures/route.png", format="png", width=800, height=450, scale=4)
+    fig.write_image("pictures/route.png", format="png", width=800, height=450, scale=image_scale(4))
 
-    dataset_grouped = dataset.groupby(["month","day","hour"])["collision_severity"].mean().reset_index()
+def plot_hour_heatmap(cube: dict):
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+    # Unweighted mean over the months of the (month, day, hour) severity rates.
+    dataset_grouped = cube["time"].assign(collision_severity=cube["time"]["severe"] / cube["time"]["total"])
 
     pivot_dataset_grouped = dataset_grouped.pivot_table(index='day', 
                                                         columns='hour', 
                                                         values='collision_severity', 
                                                         aggfunc='mean')
 
-    plt.figure(figsize=(12, 6), dpi=300)
+    plt.figure(figsize=(12, 6), dpi=figure_dpi(300))
     sns.heatmap(pivot_dataset_grouped, cmap='RdYlBu_r', annot=False, cbar_kws={'label': 'Pourcentage d\'accidents graves'})
     plt.title('Gravité des collisions : Jour de la semaine vs. Heure de la journée', fontsize=14)
     plt.ylabel('Jour de la semaine', fontsize=12)
@@ -269,9 +416,18 @@ def generate_plots(dataset: pd.DataFrame):
     plt.savefig("pictures/hour.png", bbox_inches="tight")
     plt.close()
 
-def plot_confusion_matrix(y_test_proba, y_test, img_path, threshold=0.5):
-    y_pred_threshold = (y_test_proba >= threshold).astype(int)
-    cm = confusion_matrix(y_test, y_pred_threshold)
+EDA_FIGURES = [
+    (plot_seasonality, ["time"], "pictures/seasonality.png"),
+    (plot_driver_age, ["driver_age"], "pictures/driver_age.png"),
+    (plot_vehicle_age, ["vehicle_age"], "pictures/vehicle_age.png"),
+    (plot_weather_treemap, ["weather"], "pictures/meteo.png"),
+    (plot_road_treemap, ["road"], "pictures/route.png"),
+    (plot_hour_heatmap, ["time"], "pictures/hour.png"),
+]
+
+def plot_confusion_matrix(test_evaluation, img_path, threshold=0.5):
+    import matplotlib.pyplot as plt
+    cm = evaluation.confusion_at(test_evaluation, threshold)
 
     print("Confusion Matrix:")
     print(cm)
@@ -282,7 +438,7 @@ def plot_confusion_matrix(y_test_proba, y_test, img_path, threshold=0.5):
     print(f"False Negatives: {cm[1, 0]}")
     print(f"True Positives: {cm[1, 1]}")
 
-    fig, ax = plt.subplots(figsize=(7, 6), dpi=500)
+    fig, ax = plt.subplots(figsize=(7, 6), dpi=figure_dpi(500))
     im = ax.imshow(cm, interpolation='nearest', cmap=plt.cm.Blues)
     ax.figure.colorbar(im, ax=ax)
 
@@ -307,11 +463,12 @@ def plot_confusion_matrix(y_test_proba, y_test, img_path, threshold=0.5):
     plt.savefig(f"pictures/{img_path}_confusion_matrix.png")
     plt.close()
 
-def plot_precision_recall_curve(y_pred_proba, y_test, path):
-    precision, recall, thresholds_pr = precision_recall_curve(y_test, y_pred_proba)
-    auc_pr = auc(recall, precision)
+def plot_precision_recall_curve(test_evaluation, path):
+    import matplotlib.pyplot as plt
+    precision, recall = test_evaluation["precision"], test_evaluation["recall"]
+    auc_pr = test_evaluation["pr_auc"]
     
-    plt.figure(figsize=(7, 6), dpi=500)
+    plt.figure(figsize=(7, 6), dpi=figure_dpi(500))
     plt.plot(recall, precision, color='#FF6B35', linewidth=2.5, label=f'AUC-PR = {auc_pr:.4f}')
     plt.fill_between(recall, precision, color='#FF6B35', alpha=0.1)
     plt.xlabel('Rappel', fontsize=13)
@@ -327,11 +484,12 @@ def plot_precision_recall_curve(y_pred_proba, y_test, path):
     plt.savefig(f"pictures/{path}_precision_recall.png")
     plt.close()
 
-def plot_roc_curve(y_pred_proba, y_test, path):
-    fpr, tpr, thresholds_roc = roc_curve(y_test, y_pred_proba)
-    auc_roc = auc(fpr, tpr)
+def plot_roc_curve(test_evaluation, path):
+    import matplotlib.pyplot as plt
+    fpr, tpr = test_evaluation["fpr"], test_evaluation["tpr"]
+    auc_roc = test_evaluation["roc_auc"]
     
-    plt.figure(figsize=(7, 6), dpi=500)
+    plt.figure(figsize=(7, 6), dpi=figure_dpi(500))
     plt.plot(fpr, tpr, color='#2A9D8F', linewidth=2.5, label=f'AUC-ROC = {auc_roc:.4f}')
     plt.plot([0, 1], [0, 1], color='gray', linestyle='--', linewidth=1)
     plt.fill_between(fpr, tpr, color='#2A9D8F', alpha=0.1)
@@ -349,6 +507,7 @@ def plot_roc_curve(y_pred_proba, y_test, path):
     plt.close()
 
 def plot_feature_importance(model, feature_names, path, top_n=20):
+    import matplotlib.pyplot as plt
     importance = model.feature_importances_
     indices = np.argsort(importance)[::-1][:top_n]
     
@@ -359,7 +518,7 @@ def plot_feature_importance(model, feature_names, path, top_n=20):
     for i, (feature, imp) in enumerate(zip(selected_features, selected_importance), 1):
         print(f"{i:2d}. {feature:<30} {imp:.6f}")
 
-    plt.figure(figsize=(10, 8), dpi=500)
+    plt.figure(figsize=(10, 8), dpi=figure_dpi(500))
     plt.barh(range(len(selected_importance)), selected_importance, color='#1f77b4')
     plt.yticks(range(len(selected_importance)), selected_features)
     plt.gca().invert_yaxis()
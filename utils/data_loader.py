@@ -1,6 +1,16 @@
+import os
+import glob
+import json
+import shutil
+import hashlib
 import numpy as np
 import pandas as pd
-from sklearn.preprocessing import OneHotEncoder
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from utils import instrumentation
 
 pd.options.display.max_columns = None
 
@@ -13,7 +23,7 @@ VEHICLE_FIELDS = [
     "sex_of_driver",
 ]
 DTYPES_VEHICLE = {
-    "collision_index": "object",
+    "collision_index": "string[pyarrow]",
     "vehicle_type": "int8",
     "age_of_driver": "int8",
     "age_of_vehicle": "int8",
@@ -33,7 +43,7 @@ COLLISION_FIELD = [
     "time"
 ]
 DTYPES_COLLISION = {
-    "collision_index": "object",
+    "collision_index": "string[pyarrow]",
     "road_type": "int8",
     "light_conditions": "int8",
     "weather_conditions": "int8",
@@ -41,6 +51,7 @@ DTYPES_COLLISION = {
     "urban_or_rural_area": "int8",
     "weather_conditions": "int8",
     "speed_limit": "float32",
+    "local_authority_ons_district": "string[pyarrow]",
 }
 DAY_MAPPING = {
     "Monday": 0,
@@ -56,87 +67,579 @@ TARGETED_MOTORCYCLES = [2, 3, 4, 5, 23, 97, 103, 104, 105, 106]
 PROPULSION_THERMIQUE = [1, 2, 5, 6, 7, 9, 10]
 PROPULSTION_ECTRIQUE_HYBRIDE = [3, 8, 11, 12]
 
-def load_datset(collison_path:str, vehicle_path:str, save_path:str)->pd.DataFrame:
-    df_vehicle = pd.read_csv(
-        vehicle_path, usecols=VEHICLE_FIELDS, dtype=DTYPES_VEHICLE
-    )
-    df_collision = pd.read_csv(
-        collison_path, usecols=COLLISION_FIELD, dtype=DTYPES_COLLISION
-    )
+VALUE_REMAPS = {
+    "vehicle_type": {1: TARGETED_CARS, 0: TARGETED_MOTORCYCLES},
+}
+# (column, kind, argument), evaluated in order. Rules on a remapped column
+# see the remapped codes, codes absent from the remap become -1.
+CLEANING_RULES = [
+    ("local_authority_ons_district", "prefix", "E"),
+    ("urban_or_rural_area", "isin", [1, 2]),
+    ("vehicle_type", "isin", [1, 0]),
+    ("propulsion_code", "isin", PROPULSION_THERMIQUE + PROPULSTION_ECTRIQUE_HYBRIDE),
+    ("light_conditions", "isin", [1, 4, 5, 6]),
+    ("road_type", "notin", [9, -1]),
+    ("weather_conditions", "notin", [8, 9, -1]),
+    ("sex_of_driver", "notin", [3, -1]),
+    ("speed_limit", "isin", [30, 60, 40, 70, 50, 20]),
+    ("age_of_driver", "between", (17, 87)),
+    ("age_of_vehicle", "between", (0, 22)),
+    ("vehicle_type", "isin", [1]),
+]
+DROPPED_FIELDS = [
+    "date",
+    "collision_index",
+    "local_authority_ons_district",
+    "time",
+    "vehicle_type",
+    "propulsion_code",
+]
+
+JOIN_KEY = "collision_index"
+# Canonical decimal indexes (no sign, no leading zero) round-trip through
+# int64, which is what the STATS19 releases use.
+INTEGER_KEY_PATTERN = r"^[1-9][0-9]{0,17}$"
+
+CSV_BLOCK_SIZE = 64 * 1024 * 1024
+ARROW_TYPES = {
+    "object": pa.string(),
+    "string[pyarrow]": pa.string(),
+    "int8": pa.int8(),
+    "float32": pa.float32(),
+}
+MANIFEST_NAME = "_manifest.json"
+# Rows per parquet row group of the clean dataset: the unit streamed by the
+# out-of-core trainers and assigned to cross-validation folds.
+ROW_GROUP_SIZE = 64 * 1024
+TARGET_FIELD = "collision_severity"
+PATTERN_TOTAL = "total"
+PATTERN_SEVERE = "severe"
+# Pattern table of every year partition, keyed by the checksum of its files.
+PATTERN_CACHE_DIR = "data/pattern_cache"
+
+def remap_values(values:np.ndarray, mapping:dict) -> np.ndarray:
+    remapped = np.full(len(values), -1, dtype=np.int8)
+    for target, codes in mapping.items():
+        remapped[np.isin(values, codes)] = target
+    return remapped
 
-    df = pd.merge(df_collision, df_vehicle, on="collision_index", how="inner")
-    df = df.dropna()
-    df = df[df.local_authority_ons_district != -1]
-    df = df[df.local_authority_ons_district.apply(lambda x: x[0] == "E")]
-    df = df[df.local_authority_ons_district.apply(lambda x: x[0] == "E")]
+def rule_mask(values, kind:str, argument) -> np.ndarray:
+    if kind == "isin":
+        return np.isin(values, argument)
+    if kind == "notin":
+        return ~np.isin(values, argument)
+    if kind == "between":
+        return (values >= argument[0]) & (values <= argument[1])
+    if kind == "prefix":
+        return values.str.startswith(argument).fillna(False).to_numpy(dtype=bool)
+    if kind == "year_notin":
+        years = pd.to_datetime(values, format="%d/%m/%Y", errors="coerce").dt.year
+        return ~years.isin(argument).to_numpy()
+    raise ValueError(f"Unknown rule kind: {kind}")
 
-    df = df[df.urban_or_rural_area.isin([1, 2])]
+def compile_cleaning_mask(df:pd.DataFrame, rules:list=CLEANING_RULES, remaps:dict=VALUE_REMAPS) -> tuple:
+    remapped = {
+        column: remap_values(df[column].to_numpy(), mapping)
+        for column, mapping in remaps.items()
+    }
+    mask = df.notna().all(axis=1).to_numpy()
+    rejections = {"missing values": len(df) - int(mask.sum())}
+    for column, kind, argument in rules:
+        if column in remapped:
+            values = remapped[column]
+        elif kind in ("prefix", "year_notin"):
+            values = df[column]
+        else:
+            values = df[column].to_numpy()
+        before = int(mask.sum())
+        mask &= rule_mask(values, kind, argument)
+        rejections[f"{column} {kind} {argument}"] = before - int(mask.sum())
+    return mask, pd.Series(rejections, name="rejected_rows")
 
-    df = df[df.vehicle_type.isin(TARGETED_CARS + TARGETED_MOTORCYCLES)]
-    df["vehicle_type"] = df["vehicle_type"].replace(TARGETED_CARS, 1)
-    df["vehicle_type"] = df["vehicle_type"].replace(TARGETED_MOTORCYCLES, 0)
+def clean_dataset(df:pd.DataFrame, rules:list=CLEANING_RULES, remaps:dict=VALUE_REMAPS, keep_year:bool=False) -> tuple:
+    with instrumentation.stage("filter", rows_in=len(df)) as record:
+        clean, rejections = _clean_dataset(df, rules, remaps, keep_year)
+        record["rows_out"] = len(clean)
+    return clean, rejections
 
-    df = df[df.propulsion_code.isin(PROPULSION_THERMIQUE + PROPULSTION_ECTRIQUE_HYBRIDE)]
-    df = df.drop(columns=["propulsion_code"])
+def _clean_dataset(df:pd.DataFrame, rules:list, remaps:dict, keep_year:bool) -> tuple:
+    mask, rejections = compile_cleaning_mask(df, rules, remaps)
+    rows = np.flatnonzero(mask)
+    kept = [df.columns.get_loc(c) for c in df.columns if c not in DROPPED_FIELDS]
+    clean = df.iloc[rows, kept]
 
-    df["date"] = pd.to_datetime(df["date"], format="%d/%m/%Y")
-    df["day"] = df["date"].dt.day_name()
-    df["month"] = df["date"].dt.month.astype("int8")
+    date = pd.to_datetime(df["date"].to_numpy()[rows], format="%d/%m/%Y")
+    hour = pd.to_datetime(df["time"].to_numpy()[rows], format="%H:%M")
+    clean.collision_severity = (clean.collision_severity != 3).astype("int8")
+    clean.speed_limit = clean.speed_limit.astype("int8")
+    clean["day"] = date.dayofweek.astype("int8")
+    clean["month"] = date.month.astype("int8")
+    clean["hour"] = hour.hour.astype("int8")
+    if keep_year:
+        clean["year"] = date.year.astype("int16")
+    return clean, rejections
 
-    df = df[df.light_conditions.isin([1, 4, 5, 6])]
-    df = df[~df.road_type.isin([9, -1])]
-    df = df[~df.weather_conditions.isin([8, 9, -1])]
-    df = df[~df.age_of_vehicle.isin([-1])]
-    df = df[~df.age_of_driver.isin([-1])]
-    df = df[~df.sex_of_driver.isin([3, -1])]
-    df = df[df.speed_limit.isin([30, 60, 40, 70, 50, 20])]
+def count_rejections(rejections:dict, key:str, before:int, mask:pa.Array) -> int:
+    # Adds the rows `mask` drops out of the `before` kept so far, and returns
+    # the rows it keeps.
+    kept = pc.sum(mask).as_py() or 0
+    if rejections is not None:
+        rejections[key] = rejections.get(key, 0) + before - kept
+    return kept
 
-    df = df[df.age_of_driver >= 17]
-    df = df[df.age_of_driver <= 87]
+def arrow_rule_mask(batch:pa.RecordBatch, rules:list=CLEANING_RULES, remaps:dict=VALUE_REMAPS, rejections:dict=None) -> pa.Array:
+    # `rejections`, when given, accumulates the rows rejected by each rule
+    # under the labels of compile_cleaning_mask, the rules being pushed down
+    # before the join and no longer rejecting anything after it.
+    mask = pa.array(np.ones(batch.num_rows, dtype=bool))
+    for column in batch.columns:
+        mask = pc.and_(mask, pc.is_valid(column))
+    kept = count_rejections(rejections, "missing values", batch.num_rows, mask)
+    for column, kind, argument in rules:
+        if column not in batch.schema.names:
+            continue
+        key = f"{column} {kind} {argument}"
+        values = batch[column]
+        if column in remaps:
+            if kind != "isin":
+                raise ValueError(f"Cannot push down {kind} on remapped column {column}")
+            argument = [code for target in argument for code in remaps[column].get(target, [])]
+        if kind == "isin":
+            rule = pc.is_in(values, pa.array(argument, values.type))
+        elif kind == "notin":
+            rule = pc.invert(pc.is_in(values, pa.array(argument, values.type)))
+        elif kind == "between":
+            rule = pc.and_(pc.greater_equal(values, argument[0]), pc.less_equal(values, argument[1]))
+        elif kind == "prefix":
+            rule = pc.starts_with(values, argument)
+        elif kind == "year_notin":
+            years = pc.cast(pc.utf8_slice_codeunits(values, -4), pa.int16())
+            rule = pc.invert(pc.is_in(years, pa.array(argument, pa.int16())))
+        else:
+            raise ValueError(f"Unknown rule kind: {kind}")
+        mask = pc.and_(mask, rule)
+        kept = count_rejections(rejections, key, kept, mask)
+    return pc.fill_null(mask, False)
 
-    df = df[df.age_of_vehicle >= 0]
-    df = df[df.age_of_vehicle <= 22]
+def add_rejections(rejections:pd.Series, pushed_down:dict) -> pd.Series:
+    # Report of clean_dataset plus the rows rejected before the join.
+    return rejections + pd.Series(pushed_down, dtype=np.int64).reindex(rejections.index, fill_value=0)
 
-    df['hour'] = df['time'].str.split(':').str[0].astype("int8")
+def open_csv_arrow(path:str, fields:list, dtypes:dict, block_size:int=CSV_BLOCK_SIZE) -> pv.CSVStreamingReader:
+    file_order = [c for c in pd.read_csv(path, nrows=0).columns if c in fields]
+    return pv.open_csv(
+        path,
+        read_options=pv.ReadOptions(block_size=block_size),
+        convert_options=pv.ConvertOptions(
+            include_columns=file_order,
+            column_types={f: ARROW_TYPES[dtypes.get(f, "object")] for f in file_order},
+            strings_can_be_null=True,
+        ),
+    )
+
+def parse_join_key(keys) -> pd.Series:
+    # collision_index as int64 when every index is a canonical decimal number,
+    # else as Arrow-backed strings: neither creates a Python object per row.
+    keys = pa.array(keys) if isinstance(keys, pd.Series) else keys
+    keys = pa.chunked_array([keys]) if isinstance(keys, pa.Array) else keys
+    keys = keys if pa.types.is_string(keys.type) else keys.cast(pa.string())
+    if keys.null_count == 0 and pc.all(pc.match_substring_regex(keys, INTEGER_KEY_PATTERN)).as_py() is not False:
+        return pd.Series(pc.cast(keys, pa.int64()).to_numpy(), name=JOIN_KEY)
+    return pd.Series(pd.arrays.ArrowStringArray(keys), name=JOIN_KEY)
+
+def arrow_to_pandas(table:pa.Table, dtypes:dict) -> pd.DataFrame:
+    key = table.schema.get_field_index(JOIN_KEY)
+    if key < 0:
+        df = table.to_pandas()
+    else:
+        df = table.drop_columns([JOIN_KEY]).to_pandas()
+        df.insert(key, JOIN_KEY, parse_join_key(table[JOIN_KEY]))
+    return df.astype({f: d for f, d in dtypes.items() if d == "string[pyarrow]" and f != JOIN_KEY})
+
+def scan_csv_arrow(path:str, fields:list, dtypes:dict, block_size:int=CSV_BLOCK_SIZE, rules:list=CLEANING_RULES, rejections:dict=None) -> pd.DataFrame:
+    reader = open_csv_arrow(path, fields, dtypes, block_size)
+    batches = [batch.filter(arrow_rule_mask(batch, rules, rejections=rejections)) for batch in reader]
+    return arrow_to_pandas(pa.Table.from_batches(batches, schema=reader.schema), dtypes)
 
-    df.speed_limit = df.speed_limit.astype("int8")
+def iter_csv_arrow(path:str, fields:list, dtypes:dict, block_size:int=CSV_BLOCK_SIZE, rules:list=CLEANING_RULES, rejections:dict=None):
+    # Same as scan_csv_arrow, one frame per CSV block, with the number of rows
+    # read from the block before the rules.
+    for batch in open_csv_arrow(path, fields, dtypes, block_size):
+        yield batch.num_rows, arrow_to_pandas(pa.Table.from_batches([batch.filter(arrow_rule_mask(batch, rules, rejections=rejections))]), dtypes)
 
-    df.day = df.day.map(DAY_MAPPING).astype("int8")
+def comparable_keys(left:pd.Series, right:pd.Series) -> tuple:
+    # Integer keys on both sides are compared as is; otherwise both sides are
+    # compared as strings, lossless for the canonical integer keys.
+    if left.dtype.kind == "i" and right.dtype.kind == "i":
+        return left, right
+    return left.astype("string[pyarrow]"), right.astype("string[pyarrow]")
+
+def join_key_codes(left:pd.Series, right:pd.Series) -> tuple:
+    # Integer codes of both sides in the same key space, with the key values
+    # of the codes (None when the codes are the integer keys themselves).
+    # Right keys absent from the left side get -1.
+    left, right = comparable_keys(left, right)
+    if left.dtype.kind == "i":
+        return left.to_numpy(), right.to_numpy(), None
+    codes, uniques = pd.factorize(left)
+    return codes, pd.Index(uniques).get_indexer(right), uniques
+
+def merge_on_join_key(df_left:pd.DataFrame, df_right:pd.DataFrame) -> pd.DataFrame:
+    # Same rows, columns and order as pd.merge on the raw string keys. pandas
+    # joins int64 keys by factorizing them and counting-sorting the rows;
+    # non-integer keys are replaced by shared integer codes for the join and
+    # come back as a categorical.
+    left_codes, right_codes, uniques = join_key_codes(df_left[JOIN_KEY], df_right[JOIN_KEY])
+    if uniques is None:
+        return pd.merge(df_left, df_right, on=JOIN_KEY, how="inner")
+    df_left, df_right = df_left.copy(deep=False), df_right.copy(deep=False)
+    df_left[JOIN_KEY], df_right[JOIN_KEY] = left_codes, right_codes
+    df = pd.merge(df_left, df_right, on=JOIN_KEY, how="inner")
+    df[JOIN_KEY] = pd.Categorical.from_codes(df[JOIN_KEY], categories=uniques)
+    return df
 
-    df.collision_severity = (df.collision_severity != 3).astype("int8")
+def read_merged_dataset(collison_path:str, vehicle_path:str, engine:str="pandas", block_size:int=CSV_BLOCK_SIZE, rules:list=CLEANING_RULES,
+                        rejections:dict=None) -> pd.DataFrame:
+    # On the arrow engine, `rejections` receives the rows rejected by the
+    # pushed-down rules (see arrow_rule_mask).
+    if engine not in ("pandas", "arrow"):
+        raise ValueError(f"Unknown engine: {engine}")
+    with instrumentation.stage("load_vehicle", engine=engine) as record:
+        if engine == "pandas":
+            df_vehicle = pd.read_csv(
+                vehicle_path, usecols=VEHICLE_FIELDS, dtype=DTYPES_VEHICLE
+            )
+            df_vehicle[JOIN_KEY] = parse_join_key(df_vehicle[JOIN_KEY])
+        else:
+            df_vehicle = scan_csv_arrow(vehicle_path, VEHICLE_FIELDS, DTYPES_VEHICLE, block_size, rules, rejections)
+        record["rows_out"] = len(df_vehicle)
+    with instrumentation.stage("load_collision", engine=engine) as record:
+        if engine == "pandas":
+            df_collision = pd.read_csv(
+                collison_path, usecols=COLLISION_FIELD, dtype=DTYPES_COLLISION
+            )
+            df_collision[JOIN_KEY] = parse_join_key(df_collision[JOIN_KEY])
+        else:
+            df_collision = scan_csv_arrow(collison_path, COLLISION_FIELD, DTYPES_COLLISION, block_size, rules, rejections)
+        record["rows_out"] = len(df_collision)
 
-    df.drop_duplicates()
+    with instrumentation.stage("merge", rows_in=len(df_collision) + len(df_vehicle)) as record:
+        df = merge_on_join_key(df_collision, df_vehicle)
+        record["rows_out"] = len(df)
+    return df
 
-    df = df.drop(columns=["date", "collision_index", "local_authority_ons_district","time"])
-    df = df[df.vehicle_type == 1].drop(columns=["vehicle_type"])
+def load_datset(collison_path:str, vehicle_path:str, save_path:str, engine:str="pandas", block_size:int=CSV_BLOCK_SIZE)->pd.DataFrame:
+    pushed_down = {}
+    df = read_merged_dataset(collison_path, vehicle_path, engine, block_size, rejections=pushed_down)
+    df, rejections = clean_dataset(df)
+    print(add_rejections(rejections, pushed_down).to_string())
 
     df.to_parquet(save_path)
 
     print(df.info())
     return df
 
-def one_hot_encode_dataset(dataset_to_encode:pd.DataFrame, features_to_encode:list) -> pd.DataFrame:
-    encoder = OneHotEncoder()
-    encoder = OneHotEncoder(sparse_output=False, dtype=np.int8)
-    one_hot_encoded = encoder.fit_transform(dataset_to_encode[features_to_encode])
-    one_hot_df = pd.DataFrame(one_hot_encoded, 
-                            columns=encoder.get_feature_names_out(features_to_encode))
-    df_one_hot_encoded = pd.concat([dataset_to_encode.drop(features_to_encode, axis=1).reset_index(drop=True), one_hot_df.reset_index(drop=True)], axis=1)
-    return df_one_hot_encoded
-
-def sin_cos_encode_dataset(dataset_to_encode:pd.DataFrame, features_to_encode:list) -> pd.DataFrame:
-    df = dataset_to_encode.copy()
-    
-    for feature in features_to_encode:
-        max_val = df[feature].max()
-        min_val = df[feature].min()
-        range_val = max_val - min_val
-        
-        df[f'{feature}_sin'] = np.sin(2 * np.pi * (df[feature] - min_val) / range_val)
-        df[f'{feature}_cos'] = np.cos(2 * np.pi * (df[feature] - min_val) / range_val)
-        df[f'{feature}_sin'] = df[f'{feature}_sin'].astype("float16")
-        df[f'{feature}_cos'] = df[f'{feature}_cos'].astype("float16")
-        
-        df = df.drop(columns=[feature])
-    
-    return df
\ No newline at end of file
+def file_checksum(path:str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+def read_manifest(dataset_path:str) -> dict:
+    manifest_path = os.path.join(dataset_path, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {"years": [], "releases": []}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def cleaning_digest() -> str:
+    # Source of this module and the rules in force: partitions cleaned under
+    # another digest are stale.
+    hasher = hashlib.sha256()
+    with open(__file__, "rb") as f:
+        hasher.update(f.read())
+    hasher.update(repr((CLEANING_RULES, VALUE_REMAPS, DROPPED_FIELDS)).encode())
+    return hasher.hexdigest()
+
+def rebuild_clean_dataset(dataset_path:str, manifest:dict, engine:str="arrow", block_size:int=CSV_BLOCK_SIZE):
+    # The partitions are dropped and every recorded release is ingested again,
+    # in order, with the current cleaning.
+    for release in manifest["releases"]:
+        paths = (release["collision_path"], release["vehicle_path"])
+        if not all(os.path.exists(path) for path in paths) or \
+                {"collision": file_checksum(paths[0]), "vehicle": file_checksum(paths[1])} != release["sources"]:
+            raise ValueError(f"Cleaning changed but {paths} no longer match the ingested release, rebuild {dataset_path} from scratch")
+    print("Cleaning rules changed, rebuilding the clean dataset from its releases.")
+    for year in manifest["years"]:
+        shutil.rmtree(os.path.join(dataset_path, f"year={year}"), ignore_errors=True)
+    os.remove(os.path.join(dataset_path, MANIFEST_NAME))
+    for release in manifest["releases"]:
+        update_clean_dataset(release["collision_path"], release["vehicle_path"], dataset_path, engine, block_size)
+
+def update_clean_dataset(collison_path:str, vehicle_path:str, dataset_path:str, engine:str="arrow", block_size:int=CSV_BLOCK_SIZE) -> list:
+    manifest = read_manifest(dataset_path)
+    if manifest["releases"] and manifest.get("cleaning") != cleaning_digest():
+        rebuild_clean_dataset(dataset_path, manifest, engine, block_size)
+        manifest = read_manifest(dataset_path)
+    sources = {
+        "collision": file_checksum(collison_path),
+        "vehicle": file_checksum(vehicle_path),
+    }
+    if any(release["sources"] == sources for release in manifest["releases"]):
+        print("Release already ingested, nothing to update.")
+        return []
+
+    # Years already on disk are append-only: their rows are dropped before the
+    # join so that a cumulative release only costs the new years.
+    rules = CLEANING_RULES + [("date", "year_notin", manifest["years"])]
+    pushed_down = {}
+    df = read_merged_dataset(collison_path, vehicle_path, engine, block_size, rules, pushed_down)
+    df, rejections = clean_dataset(df, rules, keep_year=True)
+    print(add_rejections(rejections, pushed_down).to_string())
+
+    new_years = []
+    with instrumentation.stage("write_partitions", rows_in=len(df)):
+        for year, partition in df.groupby("year", sort=True):
+            partition_path = os.path.join(dataset_path, f"year={year}")
+            os.makedirs(partition_path, exist_ok=True)
+            partition.drop(columns=["year"]).to_parquet(
+                os.path.join(partition_path, f"part-{sources['collision'][:16]}.parquet"), index=False, row_group_size=ROW_GROUP_SIZE
+            )
+            new_years.append(int(year))
+
+    manifest["years"] = sorted(manifest["years"] + new_years)
+    manifest["rows"] = manifest.get("rows", 0) + len(df)
+    manifest["cleaning"] = cleaning_digest()
+    manifest["releases"].append({
+        "collision_path": collison_path,
+        "vehicle_path": vehicle_path,
+        "sources": sources,
+        "years": new_years,
+        "rows": len(df),
+    })
+    os.makedirs(dataset_path, exist_ok=True)
+    with open(os.path.join(dataset_path, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Appended {len(df)} rows for years {new_years}.")
+    return new_years
+
+def read_clean_dataset(dataset_path:str, years:list=None, columns:list=None) -> pd.DataFrame:
+    dataset = ds.dataset(dataset_path, format="parquet", partitioning="hive")
+    if columns is None:
+        columns = [c for c in dataset.schema.names if c != "year"]
+    row_filter = ds.field("year").isin(years) if years is not None else None
+    return dataset.to_table(columns=columns, filter=row_filter).to_pandas()
+
+def list_row_groups(dataset_path:str) -> list:
+    # (file, row group index) of every row group of the clean dataset, in a
+    # stable order.
+    row_groups = []
+    for fragment in sorted(ds.dataset(dataset_path, format="parquet", partitioning="hive").files):
+        row_groups.extend((fragment, i) for i in range(pq.ParquetFile(fragment).num_row_groups))
+    return row_groups
+
+def read_row_group(row_group:tuple, columns:list=None) -> pd.DataFrame:
+    path, index = row_group
+    return pq.ParquetFile(path).read_row_group(index, columns=columns).to_pandas()
+
+def compress_dataset(df:pd.DataFrame, target:str=TARGET_FIELD) -> pd.DataFrame:
+    features = [c for c in df.columns if c != target]
+    with instrumentation.stage("compress", rows_in=len(df)) as record:
+        patterns = df.groupby(features, sort=False)[target].agg(
+            **{PATTERN_TOTAL: "size", PATTERN_SEVERE: "sum"}
+        ).reset_index()
+        record["rows_out"] = len(patterns)
+    patterns[PATTERN_TOTAL] = patterns[PATTERN_TOTAL].astype("int32")
+    patterns[PATTERN_SEVERE] = patterns[PATTERN_SEVERE].astype("int32")
+    print(f"{len(df)} rows compressed into {len(patterns)} unique patterns.")
+    return patterns
+
+def merge_pattern_tables(tables:list) -> pd.DataFrame:
+    # Pattern tables are counts: the same pattern in several tables is summed.
+    features = [c for c in tables[0].columns if c not in (PATTERN_TOTAL, PATTERN_SEVERE)]
+    patterns = pd.concat(tables, ignore_index=True).groupby(features, sort=False)[[PATTERN_TOTAL, PATTERN_SEVERE]].sum().reset_index()
+    return patterns.astype({PATTERN_TOTAL: "int32", PATTERN_SEVERE: "int32"})
+
+def year_patterns(dataset_path:str, year:int, cache_dir:str=PATTERN_CACHE_DIR, target:str=TARGET_FIELD) -> pd.DataFrame:
+    # Checksumming the partition files costs far less than decoding and
+    # grouping them: years unchanged since the last run are read back.
+    hasher = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(dataset_path, f"year={year}", "*.parquet"))):
+        hasher.update(file_checksum(path).encode())
+    cache_path = os.path.join(cache_dir, f"year={year}-{hasher.hexdigest()[:16]}.parquet")
+    if os.path.exists(cache_path):
+        return pd.read_parquet(cache_path)
+    patterns = compress_dataset(read_clean_dataset(dataset_path, [year]), target)
+    os.makedirs(cache_dir, exist_ok=True)
+    for stale_path in glob.glob(os.path.join(cache_dir, f"year={year}-*.parquet")):
+        os.remove(stale_path)
+    patterns.to_parquet(cache_path, index=False)
+    return patterns
+
+def compress_clean_dataset(dataset_path:str, cache_dir:str=PATTERN_CACHE_DIR, target:str=TARGET_FIELD) -> pd.DataFrame:
+    # Only new or re-cleaned years are compressed, one partition in memory at
+    # a time; the yearly pattern tables are then merged.
+    years = read_manifest(dataset_path)["years"]
+    if not years:
+        raise ValueError(f"No year ingested in {dataset_path}")
+    with instrumentation.stage("compress_years", years=years) as record:
+        patterns = merge_pattern_tables([year_patterns(dataset_path, year, cache_dir, target) for year in years])
+        record["rows_out"] = len(patterns)
+    print(f"{int(patterns[PATTERN_TOTAL].sum())} rows compressed into {len(patterns)} unique patterns over all years.")
+    return patterns
+
+def expand_pattern_table(patterns:pd.DataFrame, target:str=TARGET_FIELD) -> tuple:
+    features = patterns.drop(columns=[PATTERN_TOTAL, PATTERN_SEVERE])
+    severe = patterns[PATTERN_SEVERE].to_numpy()
+    slight = patterns[PATTERN_TOTAL].to_numpy() - severe
+    X = pd.concat([features[severe > 0], features[slight > 0]], ignore_index=True)
+    y = pd.Series(
+        np.concatenate([np.ones((severe > 0).sum()), np.zeros((slight > 0).sum())]).astype("int8"),
+        name=target,
+    )
+    sample_weight = np.concatenate([severe[severe > 0], slight[slight > 0]]).astype(np.int64)
+    return X, y, sample_weight
+
+def fit_one_hot_encoder(dataset:pd.DataFrame, features_to_encode:list, sparse:bool=False):
+    # sklearn is imported here only: the scoring path never fits an encoder.
+    from sklearn.preprocessing import OneHotEncoder
+    encoder = OneHotEncoder(sparse_output=sparse, dtype=np.int8, handle_unknown="ignore")
+    return encoder.fit(dataset[features_to_encode])
+
+def one_hot_encode_dataset(dataset_to_encode:pd.DataFrame, features_to_encode:list, encoder=None) -> pd.DataFrame:
+    if encoder is None:
+        encoder = fit_one_hot_encoder(dataset_to_encode, features_to_encode)
+    names = iter(encoder.get_feature_names_out(features_to_encode))
+    kept = [c for c in dataset_to_encode.columns if c not in features_to_encode]
+    if encoder.sparse_output:
+        # Every column is sparse so that sklearn turns the frame into a CSR
+        # matrix instead of densifying it. scipy has no float16 support.
+        columns = {}
+        for c in kept:
+            values = dataset_to_encode[c].to_numpy()
+            columns[c] = pd.arrays.SparseArray(values.astype(np.float32) if values.dtype == np.float16 else values, fill_value=0)
+        one_hot_df = pd.DataFrame.sparse.from_spmatrix(encoder.transform(dataset_to_encode[features_to_encode]))
+        columns.update({next(names): one_hot_df[i].array for i in one_hot_df.columns})
+    else:
+        columns = {c: dataset_to_encode[c].to_numpy() for c in kept}
+        for feature, categories in zip(features_to_encode, encoder.categories_):
+            values = dataset_to_encode[feature].to_numpy()
+            for category in categories:
+                columns[next(names)] = (values == category).view(np.int8)
+    return pd.DataFrame(columns, copy=False)
+
+def to_matrix(dataset:pd.DataFrame, dtype=np.float32):
+    if isinstance(dataset, pd.DataFrame) and len(dataset.columns) and all(isinstance(t, pd.SparseDtype) for t in dataset.dtypes):
+        return dataset.sparse.to_coo().tocsr().astype(dtype)
+    if isinstance(dataset, pd.DataFrame):
+        # Column by column into the final matrix: np.asarray first interleaves
+        # the blocks into their common dtype, an intermediate copy as large as
+        # the result in every cross-validation worker.
+        matrix = np.empty(dataset.shape, dtype=dtype, order="F")
+        for i in range(dataset.shape[1]):
+            matrix[:, i] = dataset.iloc[:, i].to_numpy()
+        return matrix
+    return np.asarray(dataset, dtype=dtype)
+
+class CategoryEncoder:
+    # Keeps the categorical fields as int8 codes of a pandas categorical so
+    # that XGBoost and CatBoost split on them natively, without one-hot columns.
+    def __init__(self, features_to_encode:list):
+        self.features_to_encode = list(features_to_encode)
+
+    def fit(self, dataset:pd.DataFrame):
+        self.categories_ = {feature: np.sort(dataset[feature].unique()) for feature in self.features_to_encode}
+        return self
+
+    def transform(self, dataset:pd.DataFrame) -> pd.DataFrame:
+        columns = {c: dataset[c] for c in dataset.columns}
+        for feature in self.features_to_encode:
+            # Categories unseen during fit become missing values.
+            dtype = pd.CategoricalDtype(self.categories_[feature])
+            columns[feature] = pd.Series(pd.Categorical(dataset[feature].to_numpy(), dtype=dtype), index=dataset.index)
+        return pd.DataFrame(columns, copy=False)
+
+def fit_category_encoder(dataset:pd.DataFrame, features_to_encode:list) -> CategoryEncoder:
+    return CategoryEncoder(features_to_encode).fit(dataset)
+
+def category_encode_dataset(dataset_to_encode:pd.DataFrame, features_to_encode:list, encoder:CategoryEncoder=None) -> pd.DataFrame:
+    if encoder is None:
+        encoder = fit_category_encoder(dataset_to_encode, features_to_encode)
+    return encoder.transform(dataset_to_encode)
+
+def encode_categorical_dataset(dataset_to_encode:pd.DataFrame, features_to_encode:list, encoder) -> pd.DataFrame:
+    if isinstance(encoder, CategoryEncoder):
+        return encoder.transform(dataset_to_encode)
+    return one_hot_encode_dataset(dataset_to_encode, features_to_encode, encoder)
+
+def matrix_nbytes(matrix) -> int:
+    if hasattr(matrix, "indptr"):
+        return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+    return matrix.nbytes
+
+def encoding_memory_report(dataset:pd.DataFrame, features_to_encode:list) -> dict:
+    # Peak allocation while encoding, size of the encoded frame and size of the
+    # float32 matrix handed to the tree trainers, for each encoding path.
+    import tracemalloc
+    def concat_one_hot(df):
+        encoder = fit_one_hot_encoder(df, features_to_encode)
+        one_hot_df = pd.DataFrame(encoder.transform(df[features_to_encode]), columns=encoder.get_feature_names_out(features_to_encode))
+        return pd.concat([df.drop(features_to_encode, axis=1).reset_index(drop=True), one_hot_df.reset_index(drop=True)], axis=1)
+    paths = {
+        "one_hot_concat": concat_one_hot,
+        "one_hot_dense": lambda df: one_hot_encode_dataset(df, features_to_encode, fit_one_hot_encoder(df, features_to_encode)),
+        "one_hot_sparse": lambda df: one_hot_encode_dataset(df, features_to_encode, fit_one_hot_encoder(df, features_to_encode, sparse=True)),
+        "native_categorical": lambda df: category_encode_dataset(df, features_to_encode),
+    }
+    report = {"input_bytes": int(dataset.memory_usage(deep=True).sum())}
+    for name, encode in paths.items():
+        tracemalloc.start()
+        encoded = encode(dataset)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        report[name] = {
+            "encode_peak_bytes": peak,
+            "frame_bytes": int(encoded.memory_usage(deep=True).sum()),
+            "n_columns": len(encoded.columns),
+        }
+        if name != "native_categorical":
+            report[name]["trainer_matrix_bytes"] = matrix_nbytes(to_matrix(encoded))
+        del encoded
+    return report
+
+class SinCosEncoder:
+    # Cyclic fields only take a few integer values (12 months, 7 days, 24
+    # hours), so their sin/cos pairs are looked up in a table fitted once.
+    def __init__(self, features_to_encode:list):
+        self.features_to_encode = list(features_to_encode)
+
+    def fit(self, dataset:pd.DataFrame):
+        self.bounds_ = {feature: (int(dataset[feature].min()), int(dataset[feature].max())) for feature in self.features_to_encode}
+        self.tables_ = {}
+        for feature, (min_val, max_val) in self.bounds_.items():
+            # Both bounds are values of the cycle: 1..12 is a period of 12,
+            # December and January stay one step apart.
+            period = max_val - min_val + 1
+            angle = 2 * np.pi * np.arange(period) / period
+            self.tables_[feature] = (np.sin(angle).astype("float16"), np.cos(angle).astype("float16"))
+        return self
+
+    def get_feature_names_out(self) -> list:
+        return [f"{feature}_{part}" for feature in self.features_to_encode for part in ("sin", "cos")]
+
+    def transform(self, dataset:pd.DataFrame) -> pd.DataFrame:
+        columns = {c: dataset[c] for c in dataset.columns if c not in self.features_to_encode}
+        for feature in self.features_to_encode:
+            min_val, max_val = self.bounds_[feature]
+            sin_table, cos_table = self.tables_[feature]
+            # The tables cover one period, values outside the fitted bounds wrap around.
+            position = (dataset[feature].to_numpy().astype(np.int64) - min_val) % len(sin_table)
+            columns[f"{feature}_sin"] = pd.Series(sin_table[position], index=dataset.index)
+            columns[f"{feature}_cos"] = pd.Series(cos_table[position], index=dataset.index)
+        return pd.DataFrame(columns, copy=False)
+
+def fit_sin_cos_encoder(dataset:pd.DataFrame, features_to_encode:list) -> SinCosEncoder:
+    return SinCosEncoder(features_to_encode).fit(dataset)
+
+def sin_cos_encode_dataset(dataset_to_encode:pd.DataFrame, features_to_encode:list, encoder:SinCosEncoder=None) -> pd.DataFrame:
+    if encoder is None:
+        encoder = fit_sin_cos_encoder(dataset_to_encode, features_to_encode)
+    return encoder.transform(dataset_to_encode)
\ No newline at end of file
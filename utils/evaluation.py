@@ -0,0 +1,137 @@
+import json
+import numpy as np
+
+# Every metric is derived from the cumulative class counts of the test scores
+# sorted once in decreasing order: ROC and precision-recall curves, their
+# areas and the confusion matrix at any threshold.
+
+COST_FALSE_NEGATIVE = 5.0
+COST_FALSE_POSITIVE = 1.0
+SWEEP_THRESHOLDS = np.round(np.linspace(0, 1, 101), 2)
+BOOTSTRAP_REPLICATES = 200
+BOOTSTRAP_CHUNK = 50
+CONFIDENCE_LEVEL = 0.95
+
+def sort_scores(y_score:np.ndarray, y_true:np.ndarray, sample_weight:np.ndarray=None) -> tuple:
+    y_score = np.asarray(y_score, dtype=np.float64)
+    y_true = np.asarray(y_true) == 1
+    sample_weight = np.ones(len(y_score)) if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)
+    order = np.argsort(-y_score, kind="stable")
+    y_score, y_true, sample_weight = y_score[order], y_true[order], sample_weight[order]
+    # Last position of every distinct score: one point of the curves each.
+    distinct = np.r_[np.flatnonzero(np.diff(y_score)), len(y_score) - 1]
+    return y_score, y_true, sample_weight, distinct
+
+def cumulative_counts(y_true:np.ndarray, sample_weight:np.ndarray, distinct:np.ndarray) -> tuple:
+    tps = np.cumsum(sample_weight * y_true)[distinct]
+    fps = np.cumsum(sample_weight * ~y_true)[distinct]
+    return tps, fps
+
+def roc_auc(tps:np.ndarray, fps:np.ndarray) -> np.ndarray:
+    tpr = np.concatenate([np.zeros(tps.shape[:-1] + (1,)), tps], axis=-1) / tps[..., -1:]
+    fpr = np.concatenate([np.zeros(fps.shape[:-1] + (1,)), fps], axis=-1) / fps[..., -1:]
+    return np.trapezoid(tpr, fpr, axis=-1)
+
+def precision_recall(tps:np.ndarray, fps:np.ndarray) -> tuple:
+    predicted = tps + fps
+    precision = np.divide(tps, predicted, out=np.ones_like(tps), where=predicted > 0)
+    recall = tps / tps[..., -1:]
+    return precision, recall
+
+def pr_auc(tps:np.ndarray, fps:np.ndarray) -> np.ndarray:
+    # Curve stopped at the first full recall and anchored at (recall 0,
+    # precision 1), as sklearn.metrics.precision_recall_curve does.
+    precision, recall = precision_recall(tps, fps)
+    full = np.argmax(tps >= tps[..., -1:], axis=-1)
+    keep = np.arange(tps.shape[-1]) <= full[..., None]
+    recall = np.where(keep, recall, 1.0)
+    precision = np.where(keep, precision, np.take_along_axis(precision, full[..., None], axis=-1))
+    recall = np.concatenate([np.zeros(recall.shape[:-1] + (1,)), recall], axis=-1)
+    precision = np.concatenate([np.ones(precision.shape[:-1] + (1,)), precision], axis=-1)
+    return np.trapezoid(precision, recall, axis=-1)
+
+def confusion_at(evaluation:dict, threshold:float) -> np.ndarray:
+    # Scores >= threshold are predicted positive.
+    thresholds = evaluation["thresholds"]
+    position = np.searchsorted(-thresholds, -threshold, side="right") - 1
+    tp = evaluation["tps"][position] if position >= 0 else 0.0
+    fp = evaluation["fps"][position] if position >= 0 else 0.0
+    positives, negatives = evaluation["positives"], evaluation["negatives"]
+    return np.array([[negatives - fp, fp], [positives - tp, tp]]).round().astype(np.int64)
+
+def cost_optimal_threshold(evaluation:dict, cost_false_negative:float=COST_FALSE_NEGATIVE, cost_false_positive:float=COST_FALSE_POSITIVE) -> dict:
+    # Candidate operating points: every distinct score, plus predicting nothing.
+    tps = np.r_[0.0, evaluation["tps"]]
+    fps = np.r_[0.0, evaluation["fps"]]
+    thresholds = np.r_[np.inf, evaluation["thresholds"]]
+    cost = cost_false_negative * (evaluation["positives"] - tps) + cost_false_positive * fps
+    best = int(np.argmin(cost))
+    return {
+        "threshold": float(thresholds[best]),
+        "expected_cost": float(cost[best]),
+        "cost_false_negative": cost_false_negative,
+        "cost_false_positive": cost_false_positive,
+        "confusion_matrix": confusion_at(evaluation, thresholds[best]).tolist(),
+    }
+
+def bootstrap_intervals(tps:np.ndarray, fps:np.ndarray, n_replicates:int=BOOTSTRAP_REPLICATES, level:float=CONFIDENCE_LEVEL, random_state:int=42) -> dict:
+    # Poisson bootstrap: every observation is drawn Poisson(1) times, so the
+    # positives and negatives sharing a score are redrawn together as one
+    # Poisson count and the replicates keep the order of the single sort.
+    rng = np.random.default_rng(random_state)
+    positives, negatives = np.diff(tps, prepend=0.0), np.diff(fps, prepend=0.0)
+    metrics = {"roc_auc": [], "pr_auc": []}
+    for start in range(0, n_replicates, BOOTSTRAP_CHUNK):
+        size = (min(BOOTSTRAP_CHUNK, n_replicates - start), len(tps))
+        replicate_tps = np.cumsum(rng.poisson(positives, size), axis=1).astype(np.float64)
+        replicate_fps = np.cumsum(rng.poisson(negatives, size), axis=1).astype(np.float64)
+        metrics["roc_auc"].append(roc_auc(replicate_tps, replicate_fps))
+        metrics["pr_auc"].append(pr_auc(replicate_tps, replicate_fps))
+    tail = (1 - level) / 2 * 100
+    return {
+        metric: [float(v) for v in np.nanpercentile(np.concatenate(values), [tail, 100 - tail])]
+        for metric, values in metrics.items()
+    }
+
+def evaluate(y_score:np.ndarray, y_true:np.ndarray, sample_weight:np.ndarray=None, n_replicates:int=BOOTSTRAP_REPLICATES) -> dict:
+    y_score, y_true, sample_weight, distinct = sort_scores(y_score, y_true, sample_weight)
+    tps, fps = cumulative_counts(y_true, sample_weight, distinct)
+    precision, recall = precision_recall(tps, fps)
+    evaluation = {
+        "thresholds": y_score[distinct],
+        "tps": tps,
+        "fps": fps,
+        "positives": float(tps[-1]),
+        "negatives": float(fps[-1]),
+        "fpr": np.r_[0.0, fps / fps[-1]],
+        "tpr": np.r_[0.0, tps / tps[-1]],
+        "precision": np.r_[1.0, precision],
+        "recall": np.r_[0.0, recall],
+        "roc_auc": float(roc_auc(tps, fps)),
+        "pr_auc": float(pr_auc(tps, fps)),
+        "average_precision": float(np.sum(np.diff(np.r_[0.0, recall]) * precision)),
+    }
+    evaluation["cost_optimal"] = cost_optimal_threshold(evaluation)
+    evaluation["confidence_intervals"] = bootstrap_intervals(tps, fps, n_replicates) if n_replicates else {}
+    return evaluation
+
+def evaluation_report(evaluation:dict) -> dict:
+    sweep = []
+    for threshold in SWEEP_THRESHOLDS:
+        (tn, fp), (fn, tp) = confusion_at(evaluation, threshold)
+        sweep.append({"threshold": float(threshold), "tn": int(tn), "fp": int(fp), "fn": int(fn), "tp": int(tp)})
+    return {
+        "positives": evaluation["positives"],
+        "negatives": evaluation["negatives"],
+        "roc_auc": evaluation["roc_auc"],
+        "pr_auc": evaluation["pr_auc"],
+        "average_precision": evaluation["average_precision"],
+        "confidence_level": CONFIDENCE_LEVEL,
+        "confidence_intervals": evaluation["confidence_intervals"],
+        "cost_optimal": evaluation["cost_optimal"],
+        "threshold_sweep": sweep,
+    }
+
+def save_evaluation_report(evaluation:dict, path:str):
+    with open(path, "w") as f:
+        json.dump(evaluation_report(evaluation), f, indent=2)
@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import signal
+import shutil
+import cProfile
+import resource
+import threading
+import subprocess
+from contextlib import contextmanager
+
+# Stage-level trace of a pipeline run. Every stage appends one JSON line with
+# its wall and CPU time, peak RSS and row counts. The trace file is shared
+# with the joblib workers through the environment, and the Chrome trace is
+# built from it when the run ends.
+
+TRACE_ENV = "COLLISION_TRACE_PATH"
+PROFILE_ENV = "COLLISION_PROFILE_STAGES"
+PROFILE_DIR = "profiles"
+# Sampling profiler attached to the process for the profiled stages. When it
+# is not installed, cProfile is used instead.
+SAMPLING_PROFILER = ["py-spy", "record", "--pid", "{pid}", "--output", "{output}", "--format", "speedscope", "--rate", "100"]
+
+_local = threading.local()
+# Stages open in the process, in any thread: the peak RSS is process-wide, so
+# it is only reset when no other stage is measuring it.
+_open_stages = 0
+_open_lock = threading.Lock()
+
+def start_trace(trace_path:str, profile_stages:list=()):
+    os.makedirs(os.path.dirname(trace_path) or ".", exist_ok=True)
+    open(trace_path, "w").close()
+    os.environ[TRACE_ENV] = os.path.abspath(trace_path)
+    os.environ[PROFILE_ENV] = ",".join(profile_stages)
+
+def stop_trace(chrome_trace_path:str=None) -> list:
+    trace_path = os.environ.pop(TRACE_ENV, None)
+    os.environ.pop(PROFILE_ENV, None)
+    if trace_path is None:
+        return []
+    records = read_trace(trace_path)
+    if chrome_trace_path is not None:
+        write_chrome_trace(records, chrome_trace_path)
+    return records
+
+def read_trace(trace_path:str) -> list:
+    with open(trace_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def write_chrome_trace(records:list, chrome_trace_path:str):
+    events = [{
+        "name": record["name"],
+        "ph": "X",
+        "ts": record["start"] * 1e6,
+        "dur": record["wall_seconds"] * 1e6,
+        "pid": record["pid"],
+        "tid": record["depth"],
+        "args": {k: v for k, v in record.items() if k not in ("name", "start", "pid")},
+    } for record in records]
+    with open(chrome_trace_path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+def reset_peak_rss() -> bool:
+    # Linux only: writing 5 to clear_refs resets VmHWM, the peak RSS.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss_bytes() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+@contextmanager
+def sampling_profile(name:str):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    output = os.path.join(PROFILE_DIR, f"{name}-{os.getpid()}")
+    if shutil.which(SAMPLING_PROFILER[0]):
+        command = [part.format(pid=os.getpid(), output=f"{output}.speedscope.json") for part in SAMPLING_PROFILER]
+        profiler = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            yield
+        finally:
+            profiler.send_signal(signal.SIGINT)
+            profiler.wait()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(f"{output}.prof")
+
+@contextmanager
+def stage(name:str, rows_in:int=None, **attributes):
+    # Yields the stage record: the caller sets record["rows_out"] and any extra
+    # field before the block ends. Without an active trace only the record is
+    # returned, nothing is measured.
+    record = {"name": name, "rows_in": rows_in, **attributes}
+    trace_path = os.environ.get(TRACE_ENV)
+    if trace_path is None:
+        yield record
+        return
+
+    # Only a top-level stage of the main thread resets the peak RSS. Nested and
+    # threaded stages leave it to their parent and report by how much they
+    # raised it.
+    global _open_stages
+    stack = _local.__dict__.setdefault("stack", [])
+    depth = len(stack)
+    stack.append(name)
+    with _open_lock:
+        root = _open_stages == 0 and threading.current_thread() is threading.main_thread()
+        _open_stages += 1
+    profiled = name in os.environ.get(PROFILE_ENV, "").split(",")
+    peak_reset = root and reset_peak_rss()
+    peak_start = peak_rss_bytes()
+    start = time.time()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        if profiled:
+            with sampling_profile(name):
+                yield record
+        else:
+            yield record
+    finally:
+        peak = peak_rss_bytes()
+        stack.pop()
+        with _open_lock:
+            _open_stages -= 1
+        record.update({
+            "start": start,
+            "wall_seconds": time.perf_counter() - wall_start,
+            "cpu_seconds": time.process_time() - cpu_start,
+            "peak_rss_bytes": peak,
+            "peak_rss_delta_bytes": peak - peak_start,
+            "peak_rss_scope": "stage" if peak_reset else "parent" if not root else "process",
+            "pid": os.getpid(),
+            "depth": depth,
+        })
+        with open(trace_path, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
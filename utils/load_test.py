@@ -0,0 +1,54 @@
+import json
+import time
+import argparse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+def random_incident(rng:np.random.Generator) -> dict:
+    return {
+        "road_type": int(rng.choice([1, 2, 3, 6, 7, 12])),
+        "speed_limit": int(rng.choice([20, 30, 40, 50, 60, 70])),
+        "light_conditions": int(rng.choice([1, 4, 5, 6])),
+        "weather_conditions": int(rng.integers(1, 8)),
+        "urban_or_rural_area": int(rng.integers(1, 3)),
+        "sex_of_driver": int(rng.integers(1, 3)),
+        "age_of_driver": int(rng.integers(17, 88)),
+        "age_of_vehicle": int(rng.integers(0, 23)),
+        "timestamp": f"2024-{rng.integers(1, 13):02d}-{rng.integers(1, 29):02d}T{rng.integers(0, 24):02d}:{rng.integers(0, 60):02d}:00",
+    }
+
+def post_incident(url:str, incident:dict) -> float:
+    request = urllib.request.Request(
+        f"{url}/score", data=json.dumps(incident).encode(), headers={"Content-Type": "application/json"}
+    )
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        response.read()
+    return time.perf_counter() - start
+
+def run_load_test(url:str, n_requests:int=2000, concurrency:int=32, seed:int=42) -> dict:
+    rng = np.random.default_rng(seed)
+    incidents = [random_incident(rng) for _ in range(n_requests)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = np.array(list(pool.map(lambda incident: post_incident(url, incident), incidents))) * 1000
+    elapsed = time.perf_counter() - start
+    with urllib.request.urlopen(f"{url}/metrics") as response:
+        server_metrics = json.loads(response.read())
+    return {
+        "requests": n_requests,
+        "concurrency": concurrency,
+        "throughput_rps": n_requests / elapsed,
+        "client_latency_p50_ms": float(np.percentile(latencies, 50)),
+        "client_latency_p99_ms": float(np.percentile(latencies, 99)),
+        "server": server_metrics,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test for the local scoring service")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+    print(json.dumps(run_load_test(args.url, args.requests, args.concurrency), indent=2))
@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import joblib
+import pandas as pd
+
+# Versioned store of the trained models. Every version directory holds the
+# model in the native format of its library, the fitted encoders and the
+# metadata (feature order, metrics, parameters). Loading reads the native
+# files directly and memory-maps the numpy arrays of the joblib artifacts,
+# so scoring processes start without retraining or copying the trees.
+
+REGISTRY_DIR = "data/model_registry"
+PINS_NAME = "pins.json"
+METADATA_NAME = "metadata.json"
+ENCODERS_NAME = "encoders.joblib"
+COMPILED_NAME = "compiled.joblib"
+COMPARED_METRICS = ["roc_auc", "pr_auc", "average_precision", "cost_optimal_threshold", "expected_cost"]
+
+def save_xgboost(model, path:str):
+    model.save_model(path)
+
+def load_xgboost(path:str):
+    from xgboost import XGBClassifier
+    model = XGBClassifier()
+    model.load_model(path)
+    return model
+
+def save_catboost(model, path:str):
+    model.save_model(path, format="cbm")
+
+def load_catboost(path:str):
+    from catboost import CatBoostClassifier
+    return CatBoostClassifier().load_model(path, format="cbm")
+
+def save_joblib(model, path:str):
+    joblib.dump(model, path)
+
+def load_joblib(path:str):
+    return joblib.load(path, mmap_mode="r")
+
+# Native model file, saver and loader of every backend.
+MODEL_FORMATS = {
+    "xgboost": ("model.ubj", save_xgboost, load_xgboost),
+    "catboost": ("model.cbm", save_catboost, load_catboost),
+    "decision_tree": ("model.joblib", save_joblib, load_joblib),
+}
+
+def file_sha256(path:str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+def model_metrics(evaluation_report:dict) -> dict:
+    if not evaluation_report:
+        return {}
+    return {
+        "roc_auc": evaluation_report["roc_auc"],
+        "pr_auc": evaluation_report["pr_auc"],
+        "average_precision": evaluation_report["average_precision"],
+        "confidence_intervals": evaluation_report["confidence_intervals"],
+        "cost_optimal_threshold": evaluation_report["cost_optimal"]["threshold"],
+        "expected_cost": evaluation_report["cost_optimal"]["expected_cost"],
+    }
+
+def register_model(backend:str, model, feature_names:list, time_cycle_encoder, categorical_fields:list, categorical_encoder=None,
+                   compiled_model=None, evaluation_report:dict=None, registry_dir:str=REGISTRY_DIR, parent_version:str=None) -> str:
+    # `parent_version` is the version a refreshed model continues from.
+    if backend not in MODEL_FORMATS:
+        raise ValueError(f"Unknown backend: {backend}")
+    version = time.strftime("%Y%m%d-%H%M%S")
+    version_dir = os.path.join(registry_dir, backend, version)
+    suffix = 1
+    while os.path.exists(version_dir):
+        version_dir = os.path.join(registry_dir, backend, f"{version}-{suffix}")
+        suffix += 1
+    version = os.path.basename(version_dir)
+    os.makedirs(version_dir)
+
+    model_name, save, _ = MODEL_FORMATS[backend]
+    save(model, os.path.join(version_dir, model_name))
+    joblib.dump({
+        "time_cycle_encoder": time_cycle_encoder,
+        "categorical_encoder": categorical_encoder,
+    }, os.path.join(version_dir, ENCODERS_NAME))
+    if compiled_model is not None:
+        joblib.dump(compiled_model, os.path.join(version_dir, COMPILED_NAME))
+
+    params = model.get_params() if hasattr(model, "get_params") else {}
+    metadata = {
+        "backend": backend,
+        "version": version,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "model_file": model_name,
+        "model_sha256": file_sha256(os.path.join(version_dir, model_name)),
+        "feature_names": list(feature_names),
+        "categorical_fields": list(categorical_fields),
+        "compiled": compiled_model is not None,
+        "parent_version": parent_version,
+        "metrics": model_metrics(evaluation_report),
+        "params": {k: v for k, v in params.items() if isinstance(v, (str, int, float, bool, type(None), list))},
+    }
+    with open(os.path.join(version_dir, METADATA_NAME), "w") as f:
+        json.dump(metadata, f, indent=2)
+    print(f"Modèle {backend} enregistré dans le registre, version {version}")
+    return version
+
+def read_pins(registry_dir:str=REGISTRY_DIR) -> dict:
+    pins_path = os.path.join(registry_dir, PINS_NAME)
+    if not os.path.exists(pins_path):
+        return {}
+    with open(pins_path) as f:
+        return json.load(f)
+
+def pin_version(backend:str, version:str=None, registry_dir:str=REGISTRY_DIR):
+    # Without a version the pin is removed and the latest version is served.
+    pins = read_pins(registry_dir)
+    if version is None:
+        pins.pop(backend, None)
+    elif not os.path.exists(os.path.join(registry_dir, backend, version, METADATA_NAME)):
+        raise ValueError(f"Unknown {backend} version: {version}")
+    else:
+        pins[backend] = version
+    os.makedirs(registry_dir, exist_ok=True)
+    with open(os.path.join(registry_dir, PINS_NAME), "w") as f:
+        json.dump(pins, f, indent=2)
+
+def list_versions(backend:str=None, registry_dir:str=REGISTRY_DIR) -> list:
+    # Metadata of every registered version, oldest first.
+    pins = read_pins(registry_dir)
+    backends = [backend] if backend is not None else sorted(MODEL_FORMATS)
+    versions = []
+    for name in backends:
+        backend_dir = os.path.join(registry_dir, name)
+        if not os.path.isdir(backend_dir):
+            continue
+        for version in sorted(os.listdir(backend_dir)):
+            metadata_path = os.path.join(backend_dir, version, METADATA_NAME)
+            if os.path.exists(metadata_path):
+                with open(metadata_path) as f:
+                    metadata = json.load(f)
+                metadata["pinned"] = pins.get(name) == version
+                versions.append(metadata)
+    return versions
+
+def resolve_version(backend:str, version:str=None, registry_dir:str=REGISTRY_DIR) -> str:
+    if version is not None:
+        return version
+    pinned = read_pins(registry_dir).get(backend)
+    if pinned is not None:
+        return pinned
+    versions = list_versions(backend, registry_dir)
+    if not versions:
+        raise ValueError(f"No {backend} model in the registry: {registry_dir}")
+    return versions[-1]["version"]
+
+def load_model(backend:str, version:str=None, registry_dir:str=REGISTRY_DIR) -> dict:
+    # Returns a scoring bundle, as utils.serving.load_scoring_bundle does, for
+    # the given version, else the pinned one, else the latest one.
+    version_dir = os.path.join(registry_dir, backend, resolve_version(backend, version, registry_dir))
+    with open(os.path.join(version_dir, METADATA_NAME)) as f:
+        metadata = json.load(f)
+    _, _, load = MODEL_FORMATS[backend]
+    encoders = joblib.load(os.path.join(version_dir, ENCODERS_NAME))
+    compiled_path = os.path.join(version_dir, COMPILED_NAME)
+    return {
+        "model": load(os.path.join(version_dir, metadata["model_file"])),
+        "feature_names": metadata["feature_names"],
+        "time_cycle_encoder": encoders["time_cycle_encoder"],
+        "categorical_fields": metadata["categorical_fields"],
+        "categorical_encoder": encoders["categorical_encoder"],
+        "compiled_model": joblib.load(compiled_path, mmap_mode="r") if os.path.exists(compiled_path) else None,
+        "metadata": metadata,
+    }
+
+def compare_versions(backend:str=None, versions:list=None, registry_dir:str=REGISTRY_DIR) -> pd.DataFrame:
+    rows = []
+    for metadata in list_versions(backend, registry_dir):
+        if versions is not None and metadata["version"] not in versions:
+            continue
+        rows.append({
+            "backend": metadata["backend"],
+            "version": metadata["version"],
+            "pinned": metadata["pinned"],
+            **{metric: metadata["metrics"].get(metric) for metric in COMPARED_METRICS},
+        })
+    return pd.DataFrame(rows, columns=["backend", "version", "pinned"] + COMPARED_METRICS)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Model registry")
+    parser.add_argument("--registry", default=REGISTRY_DIR)
+    commands = parser.add_subparsers(dest="command", required=True)
+    list_parser = commands.add_parser("list")
+    list_parser.add_argument("--backend", choices=sorted(MODEL_FORMATS))
+    pin_parser = commands.add_parser("pin")
+    pin_parser.add_argument("backend", choices=sorted(MODEL_FORMATS))
+    pin_parser.add_argument("version", nargs="?", help="omit to unpin")
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("--backend", choices=sorted(MODEL_FORMATS))
+    compare_parser.add_argument("versions", nargs="*")
+    args = parser.parse_args()
+    if args.command == "list":
+        for metadata in list_versions(args.backend, args.registry):
+            print(f"{metadata['backend']:<15} {metadata['version']:<20} {'pinned' if metadata['pinned'] else ''}")
+    elif args.command == "pin":
+        pin_version(args.backend, args.version, args.registry)
+    else:
+        print(compare_versions(args.backend, args.versions or None, args.registry).to_string(index=False))
@@ -0,0 +1,172 @@
+import os
+import json
+import hashlib
+import joblib
+import inspect
+import importlib.util
+from utils import instrumentation
+
+# Small DAG of pipeline stages backed by a content-addressed artifact cache.
+# The key of a stage hashes its name, parameters, input files, the source of
+# the modules it runs and the keys of its dependencies, so a change anywhere
+# upstream gives new keys to every stage below it and to those only.
+
+CACHE_DIR = "data/cache"
+INDEX_NAME = "index.json"
+CHECKSUMS_NAME = "checksums.json"
+
+def make_stage(name:str, function, deps:list=(), params:dict=None, files:list=(), outputs:list=(), code:list=()) -> dict:
+    # `function` is called with the dependency results in `deps` order, then
+    # `params` as keywords. `outputs` are files written by the stage: a cache
+    # hit is only valid while they exist. `code` lists the modules whose
+    # source invalidates the stage, besides the source of `function` itself.
+    return {
+        "name": name,
+        "function": function,
+        "deps": list(deps),
+        "params": params or {},
+        "files": list(files),
+        "outputs": list(outputs),
+        "code": list(code),
+    }
+
+def file_checksums(paths:list, cache_dir:str=CACHE_DIR) -> dict:
+    # Checksums are memoised on (size, mtime) so that multi-GB releases are
+    # only hashed again when they change on disk.
+    memo_path = os.path.join(cache_dir, CHECKSUMS_NAME)
+    memo = {}
+    if os.path.exists(memo_path):
+        with open(memo_path) as f:
+            memo = json.load(f)
+    checksums = {}
+    for path in paths:
+        stat = os.stat(path)
+        entry = memo.get(os.path.abspath(path))
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+            with open(path, "rb") as f:
+                entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha256": hashlib.file_digest(f, "sha256").hexdigest()}
+            memo[os.path.abspath(path)] = entry
+        checksums[path] = entry["sha256"]
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(memo_path, "w") as f:
+        json.dump(memo, f, indent=2)
+    return checksums
+
+def code_digest(modules:list) -> str:
+    # Modules are located without being imported, backends are loaded lazily.
+    hasher = hashlib.sha256()
+    for name in modules:
+        spec = importlib.util.find_spec(name)
+        path = spec.origin if spec is not None else None
+        if path is None:
+            hasher.update(name.encode())
+            continue
+        with open(path, "rb") as f:
+            hasher.update(f.read())
+    return hasher.hexdigest()
+
+def stage_keys(stages:list, cache_dir:str=CACHE_DIR) -> dict:
+    # Keys only depend on the stage definitions and the input files, so the
+    # whole DAG is keyed before any stage runs.
+    checksums = file_checksums(sorted({path for stage in stages for path in stage["files"]}), cache_dir)
+    keys = {}
+    for stage in stages:
+        missing = [dep for dep in stage["deps"] if dep not in keys]
+        if missing:
+            raise ValueError(f"Stage {stage['name']} depends on undefined or later stages: {missing}")
+        definition = json.dumps([
+            stage["name"],
+            stage["params"],
+            [checksums[path] for path in stage["files"]],
+            inspect.getsource(stage["function"]),
+            code_digest(stage["code"]),
+            [keys[dep] for dep in stage["deps"]],
+        ], sort_keys=True, default=repr)
+        keys[stage["name"]] = hashlib.sha256(definition.encode()).hexdigest()
+    return keys
+
+def artifact_rows(artifact) -> int:
+    # Rows of a stage result: a frame or an array, the frame of an (encoder,
+    # frame) pair, the views of a dict of frames, or the "rows" a mapping
+    # reports (the clean dataset manifest). None for anything else.
+    shape = getattr(artifact, "shape", None)
+    if isinstance(shape, tuple) and shape:
+        return int(shape[0])
+    if isinstance(artifact, tuple):
+        rows = [artifact_rows(item) for item in artifact]
+        return next((count for count in rows if count is not None), None)
+    if isinstance(artifact, dict):
+        if isinstance(artifact.get("rows"), int):
+            return artifact["rows"]
+        rows = [artifact_rows(value) for value in artifact.values()]
+        return sum(rows) if rows and None not in rows else None
+    return None
+
+def dependency_rows(artifacts:list) -> int:
+    rows = [count for count in map(artifact_rows, artifacts) if count is not None]
+    return sum(rows) if rows else None
+
+def artifact_path(cache_dir:str, name:str, key:str) -> str:
+    return os.path.join(cache_dir, f"{name}-{key[:16]}.joblib")
+
+def run_pipeline(stages:list, targets:list=None, cache_dir:str=CACHE_DIR, force:list=()) -> dict:
+    # Runs the stages needed by `targets`, by default the stages nothing else
+    # depends on. A stage whose artifact is cached is skipped, and its
+    # artifact is only loaded if a stage below it has to run. Returns the
+    # result of every target.
+    by_name = {stage["name"]: stage for stage in stages}
+    keys = stage_keys(stages, cache_dir)
+    if targets is None:
+        used = {dep for stage in stages for dep in stage["deps"]}
+        targets = [name for name in by_name if name not in used]
+
+    needed = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(by_name[name]["deps"])
+
+    results = {}
+    def result(name):
+        if name not in results:
+            results[name] = joblib.load(artifact_path(cache_dir, name, keys[name]))
+        return results[name]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for stage in stages:
+        name = stage["name"]
+        if name not in needed:
+            continue
+        path = artifact_path(cache_dir, name, keys[name])
+        cached = (
+            name not in force
+            and os.path.exists(path)
+            and all(os.path.exists(output) for output in stage["outputs"])
+        )
+        with instrumentation.stage(name, cached=cached, key=keys[name][:16]) as record:
+            if cached:
+                print(f"Étape {name} inchangée, artefact réutilisé : {path}")
+                continue
+            inputs = [result(dep) for dep in stage["deps"]]
+            record["rows_in"] = dependency_rows(inputs)
+            results[name] = stage["function"](*inputs, **stage["params"])
+            record["rows_out"] = artifact_rows(results[name])
+            joblib.dump(results[name], path)
+
+    with open(os.path.join(cache_dir, INDEX_NAME), "w") as f:
+        json.dump({name: keys[name] for name in by_name}, f, indent=2)
+    return {name: result(name) for name in targets}
+
+def prune_cache(cache_dir:str=CACHE_DIR) -> list:
+    # Drops the artifacts that are not referenced by the last run.
+    with open(os.path.join(cache_dir, INDEX_NAME)) as f:
+        index = json.load(f)
+    keep = {os.path.basename(artifact_path(cache_dir, name, key)) for name, key in index.items()}
+    removed = []
+    for file in os.listdir(cache_dir):
+        if file.endswith(".joblib") and file not in keep:
+            os.remove(os.path.join(cache_dir, file))
+            removed.append(file)
+    return removed
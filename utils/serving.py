@@ -0,0 +1,251 @@
+import json
+import time
+import queue
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import joblib
+import numpy as np
+import pandas as pd
+from utils import data_loader, model_registry, tree_evaluator
+
+INCIDENT_FIELDS = [
+    "road_type",
+    "speed_limit",
+    "light_conditions",
+    "weather_conditions",
+    "urban_or_rural_area",
+    "sex_of_driver",
+    "age_of_driver",
+    "age_of_vehicle",
+]
+
+def save_scoring_bundle(path:str, model, feature_names:list, time_cycle_encoder:data_loader.SinCosEncoder, categorical_fields:list, categorical_encoder=None, compiled_model=None):
+    joblib.dump({
+        "model": model,
+        "feature_names": list(feature_names),
+        "time_cycle_encoder": time_cycle_encoder,
+        "categorical_fields": categorical_fields,
+        "categorical_encoder": categorical_encoder,
+        "compiled_model": compiled_model,
+    }, path)
+
+def load_scoring_bundle(path:str) -> dict:
+    return joblib.load(path)
+
+def validate_incidents(df:pd.DataFrame) -> pd.DataFrame:
+    # Codes are checked before the int8 cast, which would wrap 200 into -56,
+    # then against the cleaning rules: only values the models were trained
+    # on are scored.
+    missing = [field for field in ["timestamp"] + INCIDENT_FIELDS if field not in df.columns]
+    if missing:
+        raise ValueError(f"Missing fields: {missing}")
+    values = df[INCIDENT_FIELDS].apply(pd.to_numeric, errors="coerce")
+    valid = values.notna() & (values == values.round()) & (values >= -128) & (values <= 127)
+    for column, kind, argument in data_loader.CLEANING_RULES:
+        if column in INCIDENT_FIELDS:
+            valid[column] &= data_loader.rule_mask(values[column].to_numpy(), kind, argument)
+    invalid = {field: df.loc[~valid[field], field].tolist() for field in INCIDENT_FIELDS if not valid[field].all()}
+    if invalid:
+        raise ValueError(f"Invalid values: {invalid}")
+    return values
+
+def incidents_to_frame(incidents:list) -> pd.DataFrame:
+    # Raw incidents carry a timestamp instead of the day/month/hour columns
+    # produced by load_datset.
+    df = pd.DataFrame(incidents)
+    values = validate_incidents(df)
+    timestamp = pd.to_datetime(df["timestamp"])
+    df = values.astype("int8")
+    df["day"] = timestamp.dt.dayofweek.astype("int8")
+    df["month"] = timestamp.dt.month.astype("int8")
+    df["hour"] = timestamp.dt.hour.astype("int8")
+    return df
+
+def encode_incidents(bundle:dict, df:pd.DataFrame) -> pd.DataFrame:
+    df = bundle["time_cycle_encoder"].transform(df)
+    if bundle["categorical_encoder"] is not None:
+        df = data_loader.encode_categorical_dataset(df, bundle["categorical_fields"], bundle["categorical_encoder"])
+    return df[bundle["feature_names"]]
+
+def score_incidents(bundle:dict, incidents:list) -> np.ndarray:
+    return score_frame(bundle, incidents_to_frame(incidents))
+
+def score_frame(bundle:dict, df:pd.DataFrame) -> np.ndarray:
+    # `df` holds the clean columns of load_datset (day, month, hour included).
+    X = encode_incidents(bundle, df)
+    if bundle.get("compiled_model") is not None:
+        try:
+            return tree_evaluator.predict_proba(bundle["compiled_model"], X)[:, 1]
+        except ValueError:
+            # Categories never seen in training are left to the library model.
+            pass
+    return bundle["model"].predict_proba(X)[:, 1]
+
+class LatencyStats:
+    def __init__(self, window:int=10000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.requests = 0
+        self.started = time.perf_counter()
+
+    def record_request(self, latency:float):
+        with self.lock:
+            self.latencies.append(latency)
+            self.requests += 1
+
+    def record_batch(self, size:int):
+        with self.lock:
+            self.batch_sizes.append(size)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = np.array(self.batch_sizes)
+            requests = self.requests
+        elapsed = time.perf_counter() - self.started
+        return {
+            "requests": requests,
+            "throughput_rps": requests / elapsed if elapsed else 0.0,
+            "latency_p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "latency_p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            "mean_batch_size": float(batch_sizes.mean()) if len(batch_sizes) else None,
+        }
+
+class MicroBatcher:
+    # Requests arriving within `max_wait_ms` of each other are scored with a
+    # single predict_proba call, up to `max_batch_size` incidents. Requests
+    # are submitted as frames built by incidents_to_frame, so a malformed one
+    # is rejected by its own handler before it can join a batch.
+    def __init__(self, bundle:dict, stats:LatencyStats, max_batch_size:int=64, max_wait_ms:float=2.0):
+        self.bundle = bundle
+        self.stats = stats
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, df:pd.DataFrame) -> Future:
+        future = Future()
+        self.requests.put((df, future))
+        return future
+
+    def _collect(self) -> list:
+        batch = [self.requests.get()]
+        size = len(batch[0][0])
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+            size += len(batch[-1][0])
+        return batch
+
+    def _score_alone(self, batch:list):
+        # Fallback when the batch fails: each request is scored on its own, so
+        # only the faulty ones get the error.
+        for request, future in batch:
+            try:
+                future.set_result(score_frame(self.bundle, request).tolist())
+            except Exception as error:
+                future.set_exception(error)
+            self.stats.record_batch(len(request))
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                probabilities = score_frame(self.bundle, pd.concat([request for request, _ in batch], ignore_index=True))
+            except Exception:
+                self._score_alone(batch)
+                continue
+            self.stats.record_batch(len(probabilities))
+            start = 0
+            for request, future in batch:
+                future.set_result(probabilities[start:start + len(request)].tolist())
+                start += len(request)
+
+class ScoringServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+def make_handler(batcher:MicroBatcher, stats:LatencyStats, timeout:float=5.0):
+    class ScoringHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status:int, payload:dict):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send_json(200, {"status": "ok"})
+            elif self.path == "/metrics":
+                self._send_json(200, stats.snapshot())
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/score":
+                self._send_json(404, {"error": "not found"})
+                return
+            start = time.perf_counter()
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                df = incidents_to_frame(payload if isinstance(payload, list) else [payload])
+            except Exception as error:
+                self._send_json(400, {"error": str(error)})
+                return
+            try:
+                probabilities = batcher.submit(df).result(timeout=timeout)
+            except TimeoutError:
+                # Overloaded: the request may succeed if retried.
+                self._send_json(503, {"error": f"not scored within {timeout}s"})
+                return
+            except Exception as error:
+                self._send_json(500, {"error": str(error)})
+                return
+            stats.record_request(time.perf_counter() - start)
+            if isinstance(payload, list):
+                self._send_json(200, {"probabilities": probabilities})
+            else:
+                self._send_json(200, {"probability": probabilities[0]})
+
+        def log_message(self, format, *args):
+            pass
+
+    return ScoringHandler
+
+def serve(bundle_path:str, host:str="127.0.0.1", port:int=8000, max_batch_size:int=64, max_wait_ms:float=2.0, backend:str=None, version:str=None):
+    # With a backend, the model is loaded from the registry instead of the bundle.
+    if backend is not None:
+        bundle = model_registry.load_model(backend, version)
+    else:
+        bundle = load_scoring_bundle(bundle_path)
+    stats = LatencyStats()
+    batcher = MicroBatcher(bundle, stats, max_batch_size, max_wait_ms)
+    server = ScoringServer((host, port), make_handler(batcher, stats))
+    print(f"Scoring service listening on http://{host}:{port}")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collision severity scoring service")
+    parser.add_argument("--bundle", default="data/scoring_bundle.joblib")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--max-wait-ms", type=float, default=2.0)
+    parser.add_argument("--backend", choices=sorted(model_registry.MODEL_FORMATS), help="serve from the model registry")
+    parser.add_argument("--version", help="registry version, default: pinned or latest")
+    args = parser.parse_args()
+    serve(args.bundle, args.host, args.port, args.max_batch_size, args.max_wait_ms, args.backend, args.version)
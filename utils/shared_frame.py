@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+# Training frames shared with the joblib workers through memory-mapped .npy
+# files, one per column, in /dev/shm when it has room. Workers receive a small
+# picklable handle and map the columns read-only: the pages are shared by
+# every process instead of being pickled and copied into each of them.
+
+SHARED_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+# Free space required beyond the size of the frames: Docker's default
+# /dev/shm is 64 MB, and running out of it halfway through share aborts
+# the search.
+SHARED_HEADROOM = 1.5
+SHARED_MIN_FREE = 256 * 1024 * 1024
+
+class SharedFrame:
+    def __init__(self, path:str, columns:list, categories:dict, series:bool=False):
+        self.path = path
+        self.columns = columns
+        self.categories = categories
+        self.series = series
+
+    def attach(self):
+        columns = {}
+        for i, column in enumerate(self.columns):
+            values = np.load(os.path.join(self.path, f"{i}.npy"), mmap_mode="r")
+            if column in self.categories:
+                values = pd.Categorical.from_codes(values, dtype=self.categories[column])
+            columns[column] = values
+        frame = pd.DataFrame(columns, copy=False)
+        return frame.iloc[:, 0] if self.series else frame
+
+def shareable(data) -> bool:
+    # Plain numpy and categorical columns only, on a default index: fold
+    # indices are positional.
+    frame = data.to_frame() if isinstance(data, pd.Series) else data
+    return isinstance(frame.index, pd.RangeIndex) and frame.index.start == 0 and frame.index.step == 1 and all(
+        isinstance(dtype, pd.CategoricalDtype) or (isinstance(dtype, np.dtype) and dtype.kind in "biuf")
+        for dtype in frame.dtypes
+    )
+
+def share(data, path:str) -> SharedFrame:
+    frame = data.to_frame() if isinstance(data, pd.Series) else data
+    os.makedirs(path)
+    categories = {}
+    for i, column in enumerate(frame.columns):
+        values = frame[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            categories[column] = values.dtype
+            values = values.cat.codes
+        np.save(os.path.join(path, f"{i}.npy"), values.to_numpy())
+    return SharedFrame(path, list(frame.columns), categories, isinstance(data, pd.Series))
+
+def frame_nbytes(data) -> int:
+    return int(data.memory_usage(index=False).sum()) if isinstance(data, pd.DataFrame) else int(data.memory_usage(index=False))
+
+def shared_directory(nbytes:int) -> str:
+    # /dev/shm when it has room, else the temporary directory, whose pages the
+    # workers still share through the page cache. None when neither has room.
+    for directory in (SHARED_DIR, tempfile.gettempdir()):
+        if directory is not None and shutil.disk_usage(directory).free >= nbytes * SHARED_HEADROOM + SHARED_MIN_FREE:
+            return directory
+    return None
+
+def attach(data):
+    return data.attach() if isinstance(data, SharedFrame) else data
+
+@contextmanager
+def shared_frames(*frames, enabled:bool=True):
+    # Yields a handle per frame, or the frame itself when it cannot be shared
+    # or `enabled` is False (a single worker gains nothing from the copy).
+    if not enabled or not all(shareable(frame) for frame in frames):
+        yield frames
+        return
+    directory = shared_directory(sum(frame_nbytes(frame) for frame in frames))
+    if directory is None:
+        yield frames
+        return
+    path = tempfile.mkdtemp(prefix="collision-cv-", dir=directory)
+    try:
+        yield tuple(share(frame, os.path.join(path, str(i))) for i, frame in enumerate(frames))
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
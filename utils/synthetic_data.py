@@ -0,0 +1,114 @@
+import os
+import argparse
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+from utils import data_loader
+
+# Synthetic collision.csv / vehicle.csv pairs with the columns, codes and
+# formats of the government releases read by data_loader. Every code domain
+# mixes the values kept by CLEANING_RULES with the ones it rejects, so the
+# cleaning, join and training stages see a realistic workload.
+
+CHUNK_COLLISIONS = 1_000_000
+YEARS = [2020, 2021, 2022, 2023, 2024]
+LOCAL_AUTHORITIES = {"E06000001": 0.35, "E08000025": 0.3, "E09000033": 0.2, "W06000015": 0.06, "S12000033": 0.07, "-1": 0.02}
+COLLISION_CODES = {
+    "road_type": {1: 0.07, 2: 0.02, 3: 0.15, 6: 0.72, 7: 0.02, 9: 0.01, 12: 0.005, -1: 0.005},
+    "speed_limit": {20: 0.12, 30: 0.55, 40: 0.08, 50: 0.04, 60: 0.14, 70: 0.06, -1: 0.01},
+    "light_conditions": {1: 0.72, 4: 0.2, 5: 0.01, 6: 0.05, 7: 0.015, -1: 0.005},
+    "weather_conditions": {1: 0.8, 2: 0.1, 3: 0.005, 4: 0.01, 5: 0.01, 6: 0.002, 7: 0.005, 8: 0.02, 9: 0.047, -1: 0.001},
+    "urban_or_rural_area": {1: 0.66, 2: 0.33, 3: 0.005, -1: 0.005},
+}
+VEHICLE_CODES = {
+    "vehicle_type": {
+        **{code: 0.78 / len(data_loader.TARGETED_CARS) for code in data_loader.TARGETED_CARS},
+        **{code: 0.07 / len(data_loader.TARGETED_MOTORCYCLES) for code in data_loader.TARGETED_MOTORCYCLES},
+        1: 0.06, 11: 0.04, 21: 0.03, 90: 0.02,
+    },
+    "propulsion_code": {
+        **{code: 0.7 / len(data_loader.PROPULSION_THERMIQUE) for code in data_loader.PROPULSION_THERMIQUE},
+        **{code: 0.12 / len(data_loader.PROPULSTION_ECTRIQUE_HYBRIDE) for code in data_loader.PROPULSTION_ECTRIQUE_HYBRIDE},
+        -1: 0.18,
+    },
+    "sex_of_driver": {1: 0.62, 2: 0.26, 3: 0.07, -1: 0.05},
+}
+# Severity logit offsets: fast, rural and dark roads produce more severe
+# collisions, so that the models have a signal to learn.
+SEVERITY_EFFECTS = {
+    "speed_limit": {20: -0.3, 30: 0.0, 40: 0.2, 50: 0.35, 60: 0.6, 70: 0.4},
+    "urban_or_rural_area": {2: 0.3},
+    "light_conditions": {4: 0.15, 5: 0.3, 6: 0.45},
+}
+SEVERITY_BASE_LOGIT = -1.8
+VEHICLES_PER_COLLISION = 0.85
+
+def draw_codes(rng:np.random.Generator, codes:dict, size:int) -> np.ndarray:
+    probabilities = np.array(list(codes.values()))
+    return rng.choice(np.array(list(codes.keys())), size, p=probabilities / probabilities.sum())
+
+def collision_chunk(rng:np.random.Generator, start:int, size:int) -> pa.Table:
+    years = rng.choice(YEARS, size)
+    days = rng.integers(0, 365, size).astype("timedelta64[D]")
+    dates = (years - 1970).astype("datetime64[Y]").astype("datetime64[D]") + days
+    minutes = rng.integers(0, 24 * 60, size)
+    columns = {
+        "collision_index": np.char.add(years.astype(str), np.char.zfill(np.arange(start, start + size).astype(str), 9)),
+        "date": pc.strftime(pa.array(dates.astype("datetime64[s]")), "%d/%m/%Y"),
+        "time": pc.strftime(pa.array(minutes.astype("timedelta64[m]") + np.datetime64("1970-01-01", "s")), "%H:%M"),
+        "local_authority_ons_district": draw_codes(rng, LOCAL_AUTHORITIES, size),
+    }
+    for field, codes in COLLISION_CODES.items():
+        columns[field] = draw_codes(rng, codes, size)
+
+    logit = np.full(size, SEVERITY_BASE_LOGIT)
+    for field, effects in SEVERITY_EFFECTS.items():
+        for code, effect in effects.items():
+            logit += effect * (columns[field] == code)
+    logit += 0.25 * ((minutes < 6 * 60) | (minutes >= 22 * 60))
+    severe = rng.random(size) < 1 / (1 + np.exp(-logit))
+    columns["collision_severity"] = np.where(severe, np.where(rng.random(size) < 0.12, 1, 2), 3)
+    columns["collision_year"] = years
+    return pa.table({field: columns[field] for field in data_loader.COLLISION_FIELD + ["collision_year"]})
+
+def vehicle_chunk(rng:np.random.Generator, collision_index:pa.Array) -> pa.Table:
+    counts = 1 + rng.poisson(VEHICLES_PER_COLLISION, len(collision_index))
+    size = int(counts.sum())
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    columns = {
+        "collision_index": pc.take(collision_index, np.repeat(np.arange(len(counts)), counts)),
+        "vehicle_reference": np.arange(size) - first + 1,
+    }
+    for field, codes in VEHICLE_CODES.items():
+        columns[field] = draw_codes(rng, codes, size)
+    columns["age_of_driver"] = np.where(rng.random(size) < 0.12, -1, np.clip(rng.normal(42, 16, size), 10, 99).astype(np.int64))
+    columns["age_of_vehicle"] = np.where(rng.random(size) < 0.2, -1, np.minimum(rng.geometric(0.11, size) - 1, 99))
+    return pa.table({field: columns[field] for field in data_loader.VEHICLE_FIELDS + ["vehicle_reference"]})
+
+def generate_synthetic_csvs(output_dir:str, n_collisions:int, seed:int=42, chunk_size:int=CHUNK_COLLISIONS) -> tuple:
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    collision_path = os.path.join(output_dir, "collision.csv")
+    vehicle_path = os.path.join(output_dir, "vehicle.csv")
+    collision_writer = vehicle_writer = None
+    for start in range(0, n_collisions, chunk_size):
+        collisions = collision_chunk(rng, start, min(chunk_size, n_collisions - start))
+        vehicles = vehicle_chunk(rng, collisions["collision_index"].combine_chunks())
+        if collision_writer is None:
+            collision_writer = pv.CSVWriter(collision_path, collisions.schema)
+            vehicle_writer = pv.CSVWriter(vehicle_path, vehicles.schema)
+        collision_writer.write_table(collisions)
+        vehicle_writer.write_table(vehicles)
+    collision_writer.close()
+    vehicle_writer.close()
+    return collision_path, vehicle_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic collision/vehicle CSV generator")
+    parser.add_argument("--output", default="data/synthetic")
+    parser.add_argument("--collisions", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    paths = generate_synthetic_csvs(args.output, args.collisions, args.seed)
+    print(f"Synthetic release written to {paths[0]} and {paths[1]}")
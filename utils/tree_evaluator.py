@@ -0,0 +1,322 @@
+import os
+import json
+import time
+import tempfile
+import itertools
+import numpy as np
+
+# Tree ensembles flattened into NumPy arrays. Scoring only needs numpy: the
+# exporters read the fitted objects through their own methods and never import
+# xgboost, catboost or sklearn.
+
+BATCH_SIZE = 4096
+# Largest difference with the library's probabilities accepted by check_parity.
+PARITY_TOLERANCE = 1e-5
+
+def sigmoid(margin:np.ndarray) -> np.ndarray:
+    return 1 / (1 + np.exp(-margin))
+
+def as_matrix(X, feature_names:list) -> np.ndarray:
+    if hasattr(X, "columns"):
+        X = X[feature_names].to_numpy()
+    # Every library compares float32 inputs against its thresholds.
+    return np.asarray(X, dtype=np.float32)
+
+class CompiledTrees:
+    # Binary trees stored node by node across the whole ensemble. Leaves have
+    # feature == -1 and hold their contribution in `value`.
+    kind = "trees"
+
+    def __init__(self, feature_names, roots, feature, threshold, left, right, default_left, value, base_score, link, strict):
+        self.feature_names = list(feature_names)
+        self.roots = np.asarray(roots, dtype=np.int32)
+        self.feature = np.array(feature, dtype=np.int32)
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        self.left = np.array(left, dtype=np.int32)
+        self.right = np.array(right, dtype=np.int32)
+        self.leaf = self.feature < 0
+        self.default_left = np.asarray(default_left, dtype=bool)
+        self.value = np.asarray(value, dtype=np.float64)
+        self.base_score = float(base_score)
+        self.link = link
+        self.strict = bool(strict)
+        self.max_depth = self._max_depth()
+        nodes = np.flatnonzero(self.leaf)
+        self.feature[nodes] = 0
+        self.left[nodes] = nodes
+        self.right[nodes] = nodes
+        self.children = np.column_stack([self.right, self.left]).ravel()
+
+    def _max_depth(self) -> int:
+        nodes = self.roots
+        max_depth = 0
+        while len(nodes):
+            nodes = nodes[self.feature[nodes] >= 0]
+            if len(nodes):
+                max_depth += 1
+            nodes = np.concatenate([self.left[nodes], self.right[nodes]])
+        return max_depth
+
+    def _margin(self, X:np.ndarray) -> np.ndarray:
+        # Leaves point back to themselves, so every row can walk max_depth
+        # levels without checking where it stopped.
+        offsets = (np.arange(len(X), dtype=np.int32) * X.shape[1])[:, None]
+        flat = X.ravel()
+        missing = np.isnan(flat).any()
+        node = np.broadcast_to(self.roots, (len(X), len(self.roots)))
+        for _ in range(self.max_depth):
+            x = flat[offsets + self.feature[node]]
+            threshold = self.threshold[node]
+            go_left = x < threshold if self.strict else x <= threshold
+            if missing:
+                go_left |= np.isnan(x) & self.default_left[node]
+            node = self.children[2 * node + go_left]
+        return self.value[node].sum(axis=1) + self.base_score
+
+    def arrays(self) -> dict:
+        return {
+            "roots": self.roots,
+            "feature": np.where(self.leaf, -1, self.feature),
+            "threshold": self.threshold,
+            "left": np.where(self.leaf, -1, self.left),
+            "right": np.where(self.leaf, -1, self.right),
+            "default_left": self.default_left,
+            "value": self.value,
+        }
+
+    def metadata(self) -> dict:
+        return {"base_score": self.base_score, "link": self.link, "strict": self.strict}
+
+class CompiledObliviousTrees:
+    # CatBoost symmetric trees: every level of a tree applies the same split,
+    # and the bits of the splits form the leaf index. Splits on categorical
+    # values are stored as lookup tables over the categorical combinations.
+    kind = "oblivious"
+
+    def __init__(self, feature_names, split_feature, split_border, split_table, leaf_values, categorical_features, categorical_domains, scale, bias):
+        self.feature_names = list(feature_names)
+        self.split_feature = np.asarray(split_feature, dtype=np.int32)
+        self.split_border = np.asarray(split_border, dtype=np.float64)
+        self.split_table = np.asarray(split_table, dtype=np.int32)
+        self.leaf_values = np.asarray(leaf_values, dtype=np.float64)
+        self.categorical_features = list(categorical_features)
+        self.categorical_domains = [np.asarray(domain, dtype=np.float64) for domain in categorical_domains]
+        self.scale = float(scale)
+        self.bias = float(bias)
+        self.link = "logit"
+
+    def categorical_combination(self, X:np.ndarray) -> np.ndarray:
+        combination = np.zeros(len(X), dtype=np.int64)
+        for feature, domain in zip(self.categorical_features, self.categorical_domains):
+            position = np.searchsorted(domain, X[:, feature])
+            position = np.minimum(position, len(domain) - 1)
+            if not (domain[position] == X[:, feature]).all():
+                raise ValueError(f"Unknown category for feature {self.feature_names[feature]}")
+            combination = combination * len(domain) + position
+        return combination
+
+    def _margin(self, X:np.ndarray) -> np.ndarray:
+        n_trees, depth = self.split_feature.shape
+        combination = self.categorical_combination(X) if self.categorical_features else None
+        leaf = np.zeros((len(X), n_trees), dtype=np.int64)
+        for level in range(depth):
+            feature = self.split_feature[:, level]
+            table = self.split_table[:, level]
+            bit = X[:, np.maximum(feature, 0)] > self.split_border[:, level]
+            if combination is not None and (table >= 0).any():
+                bit = np.where(table >= 0, self.table_bits[np.maximum(table, 0)][:, combination].T, bit)
+            bit &= (feature >= 0) | (table >= 0)
+            leaf |= bit.astype(np.int64) << level
+        values = np.take_along_axis(self.leaf_values, leaf.T, axis=1).T
+        return self.scale * values.sum(axis=1) + self.bias
+
+    def arrays(self) -> dict:
+        arrays = {
+            "split_feature": self.split_feature,
+            "split_border": self.split_border,
+            "split_table": self.split_table,
+            "leaf_values": self.leaf_values,
+            "table_bits": self.table_bits,
+        }
+        for i, domain in enumerate(self.categorical_domains):
+            arrays[f"categorical_domain_{i}"] = domain
+        return arrays
+
+    def metadata(self) -> dict:
+        return {"categorical_features": self.categorical_features, "scale": self.scale, "bias": self.bias}
+
+def predict_proba(compiled, X, batch_size:int=BATCH_SIZE) -> np.ndarray:
+    X = as_matrix(X, compiled.feature_names)
+    margin = np.concatenate([compiled._margin(X[i:i + batch_size]) for i in range(0, max(len(X), 1), batch_size)])
+    positive = sigmoid(margin) if compiled.link == "logit" else margin
+    return np.column_stack([1 - positive, positive])
+
+def check_parity(model, compiled, X, tolerance:float=PARITY_TOLERANCE) -> float:
+    difference = float(np.abs(model.predict_proba(X)[:, 1] - predict_proba(compiled, X)[:, 1]).max())
+    if difference > tolerance:
+        raise ValueError(f"Compiled model differs from {type(model).__name__} by {difference:.3g}")
+    return difference
+
+def save_compiled(compiled, path:str):
+    metadata = {"kind": compiled.kind, "feature_names": compiled.feature_names, **compiled.metadata()}
+    np.savez(path, metadata=json.dumps(metadata), **compiled.arrays())
+
+def load_compiled(path:str):
+    archive = np.load(path)
+    metadata = json.loads(str(archive["metadata"]))
+    if metadata["kind"] == "trees":
+        return CompiledTrees(
+            metadata["feature_names"], archive["roots"], archive["feature"], archive["threshold"],
+            archive["left"], archive["right"], archive["default_left"], archive["value"],
+            metadata["base_score"], metadata["link"], metadata["strict"],
+        )
+    domains = [archive[f"categorical_domain_{i}"] for i in range(len(metadata["categorical_features"]))]
+    compiled = CompiledObliviousTrees(
+        metadata["feature_names"], archive["split_feature"], archive["split_border"], archive["split_table"],
+        archive["leaf_values"], metadata["categorical_features"], domains, metadata["scale"], metadata["bias"],
+    )
+    compiled.table_bits = archive["table_bits"]
+    return compiled
+
+def export_xgboost(model):
+    booster = model.get_booster() if hasattr(model, "get_booster") else model
+    learner = json.loads(booster.save_raw("json"))["learner"]
+    if learner["objective"]["name"] != "binary:logistic":
+        raise ValueError("Only binary:logistic XGBoost models can be exported")
+    trees = learner["gradient_booster"]["model"]["trees"]
+    best_iteration = booster.attr("best_iteration")
+    if best_iteration is not None:
+        trees = trees[:int(best_iteration) + 1]
+
+    roots, feature, threshold, left, right, default_left, value = [], [], [], [], [], [], []
+    offset = 0
+    for tree in trees:
+        if any(tree["split_type"]):
+            raise NotImplementedError("Categorical XGBoost splits cannot be exported")
+        tree_left = np.asarray(tree["left_children"])
+        leaf = tree_left == -1
+        roots.append(offset)
+        feature.append(np.where(leaf, -1, tree["split_indices"]))
+        # XGBoost splits in float32: a float64 threshold read from the JSON
+        # dump sends the values equal to the split (one-hot 0/1, float16
+        # sin/cos) to the wrong side.
+        threshold.append(np.where(leaf, 0.0, np.asarray(tree["split_conditions"], dtype=np.float32)))
+        left.append(np.where(leaf, -1, tree_left + offset))
+        right.append(np.where(leaf, -1, np.asarray(tree["right_children"]) + offset))
+        default_left.append(np.asarray(tree["default_left"], dtype=bool))
+        value.append(np.where(leaf, tree["split_conditions"], 0.0))
+        offset += len(tree_left)
+
+    base_score = float(str(learner["learner_model_param"]["base_score"]).strip("[]"))
+    return CompiledTrees(
+        booster.feature_names,
+        roots,
+        np.concatenate(feature),
+        np.concatenate(threshold),
+        np.concatenate(left),
+        np.concatenate(right),
+        np.concatenate(default_left),
+        np.concatenate(value),
+        np.log(base_score / (1 - base_score)),
+        link="logit",
+        strict=True,
+    )
+
+def export_sklearn_tree(model):
+    tree = model.tree_
+    leaf = tree.children_left == -1
+    value = tree.value[:, 0, :]
+    positive = value[:, list(model.classes_).index(1)] / value.sum(axis=1)
+    missing_go_to_left = getattr(tree, "missing_go_to_left", np.zeros(tree.node_count, dtype=bool))
+    return CompiledTrees(
+        model.feature_names_in_ if hasattr(model, "feature_names_in_") else [f"f{i}" for i in range(model.n_features_in_)],
+        [0],
+        np.where(leaf, -1, tree.feature),
+        np.where(leaf, 0.0, tree.threshold),
+        tree.children_left,
+        tree.children_right,
+        missing_go_to_left,
+        np.where(leaf, positive, 0.0),
+        0.0,
+        link="identity",
+        strict=False,
+    )
+
+def export_catboost(model, categorical_domains:dict=None):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "model.json")
+        model.save_model(path, format="json")
+        with open(path) as f:
+            dump = json.load(f)
+
+    feature_names = list(model.feature_names_)
+    float_features = {f["feature_index"]: f["flat_feature_index"] for f in dump["features_info"].get("float_features", [])}
+    categorical_features = [f["flat_feature_index"] for f in dump["features_info"].get("categorical_features", [])]
+    for ctr in dump["features_info"].get("ctrs", []):
+        if any("float_feature_index" in element for element in ctr["elements"]):
+            raise NotImplementedError("CTR combinations with float features cannot be exported")
+    if categorical_features and categorical_domains is None:
+        raise ValueError("categorical_domains is required for models with categorical features")
+    domains = [np.sort(np.unique(categorical_domains[feature_names[f]])).astype(np.float64) for f in categorical_features]
+
+    trees = dump["oblivious_trees"]
+    depth = max(len(tree.get("splits") or []) for tree in trees)
+    split_feature = np.full((len(trees), depth), -1, dtype=np.int32)
+    split_border = np.zeros((len(trees), depth))
+    split_table = np.full((len(trees), depth), -1, dtype=np.int32)
+    leaf_values = np.zeros((len(trees), 2 ** depth))
+    categorical_splits = []
+    for t, tree in enumerate(trees):
+        for level, split in enumerate(tree.get("splits") or []):
+            if split["split_type"] == "FloatFeature":
+                split_feature[t, level] = float_features[split["float_feature_index"]]
+                split_border[t, level] = split["border"]
+            else:
+                split_table[t, level] = len(categorical_splits)
+                categorical_splits.append((t, level))
+        leaf_values[t, :len(tree["leaf_values"])] = tree["leaf_values"]
+
+    # Splits on categorical values (one-hot or CTR) are read back from the
+    # model itself: the leaf index of every categorical combination gives the
+    # bit of each of these splits.
+    table_bits = np.zeros((len(categorical_splits), int(np.prod([len(d) for d in domains]))), dtype=bool)
+    if categorical_splits:
+        combinations = np.array(list(itertools.product(*domains)))
+        probe = np.zeros((len(combinations), len(feature_names)))
+        probe[:, categorical_features] = combinations
+        probe = [[int(v) if i in categorical_features else float(v) for i, v in enumerate(row)] for row in probe]
+        leaf_indexes = model.calc_leaf_indexes(probe)
+        for index, (t, level) in enumerate(categorical_splits):
+            table_bits[index] = (leaf_indexes[:, t] >> level) & 1
+
+    compiled = CompiledObliviousTrees(
+        feature_names, split_feature, split_border, split_table, leaf_values,
+        categorical_features, domains, dump["scale_and_bias"][0], dump["scale_and_bias"][1][0],
+    )
+    compiled.table_bits = table_bits
+    return compiled
+
+def export_model(model, categorical_domains:dict=None):
+    name = type(model).__name__
+    if name in ("XGBClassifier", "Booster"):
+        return export_xgboost(model)
+    if name == "DecisionTreeClassifier":
+        return export_sklearn_tree(model)
+    if name == "CatBoostClassifier":
+        return export_catboost(model, categorical_domains)
+    raise ValueError(f"Cannot export model of type {name}")
+
+def benchmark(model, compiled, X, repeats:int=200) -> dict:
+    row = X.iloc[:1] if hasattr(X, "iloc") else X[:1]
+    timings = {}
+    for label, predict in [("library", model.predict_proba), ("compiled", lambda data: predict_proba(compiled, data))]:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            predict(row)
+        single = (time.perf_counter() - start) / repeats
+        start = time.perf_counter()
+        predict(X)
+        batch = time.perf_counter() - start
+        timings[label] = {"single_row_ms": single * 1000, "batch_rows_per_s": len(X) / batch}
+    timings["max_abs_difference"] = float(np.abs(model.predict_proba(X)[:, 1] - predict_proba(compiled, X)[:, 1]).max())
+    return timings